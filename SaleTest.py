@@ -14,17 +14,31 @@ SaleTest_full_part1.py — часть 1/2
 from __future__ import annotations
 
 import os
+import sys
 import json
 import sqlite3
 import requests
 import qrcode
 import io
 import time
+import random
+import bisect
+import threading
+import atexit
+import heapq
+import itertools
+import csv
+import tempfile
 import traceback
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from threading import Thread
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Iterator, Callable
 
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 from flask import Flask, request, jsonify
 import telebot
 from telebot import types
@@ -37,17 +51,116 @@ CRYPTOPAY_API_TOKEN = os.environ.get("CRYPTOPAY_API_TOKEN") or "484313:AAwPvRj3L
 WEB_DOMAIN = os.environ.get("WEB_DOMAIN") or "https://render-jj8d.onrender.com"
 USE_WEBHOOK = os.environ.get("USE_WEBHOOK", "0") == "1"
 
+# Запуск HTTP-сервера (webhook/IPN): dev — встроенный сервер Flask, prefork — N HTTP-процессов на общем сокете
+# и один бот-процесс, который обрабатывает апдейты и держит исходящие/фоновые службы
+SERVE_MODE = os.environ.get("SERVE_MODE") or "dev"
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS") or os.cpu_count() or 1)
+PORT = int(os.environ.get("PORT") or 10000)
+DRAIN_TIMEOUT_SEC = float(os.environ.get("DRAIN_TIMEOUT_SEC") or 20)
+
 ADMIN_IDS = set([int(os.environ.get("ADMIN_ID") or 1942740947)])
 INITIAL_OPERATORS = [7771789412]
 
 CRYPTO_API_BASE = "https://pay.crypt.bot/api"
+CRYPTO_API_MAX_RETRIES = int(os.environ.get("CRYPTO_API_MAX_RETRIES") or 3)
+CRYPTO_API_BREAKER_THRESHOLD = int(os.environ.get("CRYPTO_API_BREAKER_THRESHOLD") or 5)
+CRYPTO_API_BREAKER_RESET_SEC = float(os.environ.get("CRYPTO_API_BREAKER_RESET_SEC") or 30)
+# Срок жизни инвойса (expires_in в createInvoice): после него CryptoBot сам переводит счёт в expired
+INVOICE_TTL_HOURS = float(os.environ.get("INVOICE_TTL_HOURS") or 48)
+# Сверка неоплаченных инвойсов через getInvoices (на случай потерянного IPN)
+RECONCILE_MIN_SEC = float(os.environ.get("RECONCILE_MIN_SEC") or 15)
+RECONCILE_MAX_SEC = float(os.environ.get("RECONCILE_MAX_SEC") or 120)
+RECONCILE_IDLE_SEC = float(os.environ.get("RECONCILE_IDLE_SEC") or 600)
+RECONCILE_BATCH = int(os.environ.get("RECONCILE_BATCH") or 100)
+# raw_payload инвойса с финальным статусом хранится столько часов после создания
+INVOICE_PAYLOAD_KEEP_HOURS = float(os.environ.get("INVOICE_PAYLOAD_KEEP_HOURS") or 48)
+# Обслуживание БД (MaintenanceScheduler): сроки жизни данных и размер пачек
+SWEEP_INTERVAL_SEC = float(os.environ.get("SWEEP_INTERVAL_SEC") or 3600)
+SWEEP_BATCH = int(os.environ.get("SWEEP_BATCH") or 500)
+SWEEP_PAUSE_SEC = float(os.environ.get("SWEEP_PAUSE_SEC") or 0.05)
+CART_TTL_DAYS = float(os.environ.get("CART_TTL_DAYS") or 7)             # открытая корзина без изменений -> expired
+ORDER_PAYMENT_TTL_HOURS = float(os.environ.get("ORDER_PAYMENT_TTL_HOURS") or 72)  # awaiting_payment -> expired
+RETENTION_DAYS = float(os.environ.get("RETENTION_DAYS") or 30)          # закрытые корзины, истёкшие инвойсы, задачи
+VACUUM_STEP_PAGES = int(os.environ.get("VACUUM_STEP_PAGES") or 2000)
 
 DB_FILE = os.environ.get("DB_FILE") or "salebot_full.sqlite"
+# Архив: оплаченные/истёкшие заказы и закрытые обращения старше ARCHIVE_AFTER_DAYS переносятся (ArchiveMover)
+# в отдельный файл, подключённый через ATTACH к каждому соединению. ARCHIVE_DB_FILE=off — без архива.
+ARCHIVE_DB_FILE = os.environ.get("ARCHIVE_DB_FILE") or (os.path.splitext(DB_FILE)[0] + "_archive.sqlite")
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS") or 90)
+ARCHIVE_BATCH = int(os.environ.get("ARCHIVE_BATCH") or 500)
+ARCHIVE_INTERVAL_SEC = float(os.environ.get("ARCHIVE_INTERVAL_SEC") or 6 * 3600)
 IPN_LOG_FILE = os.environ.get("IPN_LOG_FILE") or "ipn_log.jsonl"
+IPN_LOG_MAX_BYTES = int(os.environ.get("IPN_LOG_MAX_BYTES") or 50 * 1024 * 1024)
+IPN_LOG_ROTATE_SEC = int(os.environ.get("IPN_LOG_ROTATE_SEC") or 24 * 3600)
+IPN_LOG_BACKUPS = int(os.environ.get("IPN_LOG_BACKUPS") or 14)
+PROCESSED_INVOICES_CACHE_SIZE = int(os.environ.get("PROCESSED_INVOICES_CACHE_SIZE") or 100000)
+# Кэш известных пользователей: сколько держать в памяти и как часто сбрасывать новые/изменённые в users
+KNOWN_USERS_CACHE_SIZE = int(os.environ.get("KNOWN_USERS_CACHE_SIZE") or 200000)
+USER_FLUSH_SEC = float(os.environ.get("USER_FLUSH_SEC") or 2)
+# Кэш отрисованного профиля (корзина + последние заказы) на чат. В prefork изменения из другого
+# процесса этот процесс не видит, поэтому по умолчанию там кэш выключен (0).
+PROFILE_CACHE_TTL_SEC = float(os.environ.get("PROFILE_CACHE_TTL_SEC") or (0 if SERVE_MODE == "prefork" else 300))
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE") or 10000)
+# Агрегаты корзин (позиции + сумма) в памяти по cart_id; в prefork по умолчанию выключено (0):
+# корзину может изменить другой процесс
+CART_CACHE_SIZE = int(os.environ.get("CART_CACHE_SIZE") or (0 if SERVE_MODE == "prefork" else 5000))
+# /sadm: размер страницы и порог, после которого выгрузка уходит из памяти во временный файл
+ADMIN_PAGE_SIZE = int(os.environ.get("ADMIN_PAGE_SIZE") or 20)
+EXPORT_SPOOL_BYTES = int(os.environ.get("EXPORT_SPOOL_BYTES") or 4 * 1024 * 1024)
+# Уведомления операторам о новых обращениях: окно склейки всплеска и параллельность рассылки
+NOTIFY_DEBOUNCE_SEC = float(os.environ.get("NOTIFY_DEBOUNCE_SEC") or 0.5)
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS") or 8)
+# Исходящие вызовы Telegram: лимиты (сообщений/с) глобально на бота и на чат, повторы после 429
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE") or 28)
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE") or 1)
+TG_GROUP_RATE = float(os.environ.get("TG_GROUP_RATE") or 20 / 60)
+TG_CHAT_BURST = int(os.environ.get("TG_CHAT_BURST") or 3)
+TG_SEND_WORKERS = int(os.environ.get("TG_SEND_WORKERS") or 8)
+TG_SEND_MAX_RETRIES = int(os.environ.get("TG_SEND_MAX_RETRIES") or 5)
+TG_SEND_TIMEOUT_SEC = float(os.environ.get("TG_SEND_TIMEOUT_SEC") or 60)
+
+# Состояние диалогов (ожидание количества/ссылки/ответа): memory | sqlite
+# (в prefork — sqlite: состояние переживает перезапуск и плавную перезагрузку бот-процесса)
+STATE_BACKEND = os.environ.get("STATE_BACKEND") or ("sqlite" if SERVE_MODE == "prefork" else "memory")
+STATE_TTL_SEC = int(os.environ.get("STATE_TTL_SEC") or 3600)
+STATE_MAX_ENTRIES = int(os.environ.get("STATE_MAX_ENTRIES") or 100000)
+
+# Обработка апдейтов в webhook-режиме
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS") or 8)
+UPDATE_QUEUE_MAX = int(os.environ.get("UPDATE_QUEUE_MAX") or 1000)
+# prefork: HTTP-воркеры складывают апдейты и IPN в таблицу inbox, их разбирает один бот-процесс
+INBOX_BATCH = int(os.environ.get("INBOX_BATCH") or 200)
+INBOX_POLL_SEC = float(os.environ.get("INBOX_POLL_SEC") or 1)
+INBOX_LEASE_SEC = float(os.environ.get("INBOX_LEASE_SEC") or 10)
+METRICS_PUBLISH_SEC = float(os.environ.get("METRICS_PUBLISH_SEC") or 10)
+# /metrics отдаётся только с ?token=<METRICS_TOKEN>; пока токен не задан — закрыт
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN") or ""
+
+# SQLite tuning
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS") or 5000)
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB") or 16384)
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE") or 64 * 1024 * 1024)
+
+# QR для ссылок оплаты: inline | thread | process
+QR_RENDER_MODE = os.environ.get("QR_RENDER_MODE") or "thread"
+QR_RENDER_WORKERS = int(os.environ.get("QR_RENDER_WORKERS") or 2)
+QR_CACHE_SIZE = int(os.environ.get("QR_CACHE_SIZE") or 256)
+
+# Очередь создания счетов
+PAYMENT_WORKERS = int(os.environ.get("PAYMENT_WORKERS") or 4)
+PAYMENT_QUEUE_MAX = int(os.environ.get("PAYMENT_QUEUE_MAX") or 200)
 
 # Поддерживаемые валюты (как просили)
 AVAILABLE_ASSETS = ["USDT", "TON", "TRX"]
 
+# Курсы валют (CoinGecko): asset -> id монеты
+COINGECKO_API_BASE = "https://api.coingecko.com/api/v3"
+RATE_ASSET_IDS = {"TON": "toncoin", "TRX": "tron"}
+RATE_TTL_SEC = int(os.environ.get("RATE_TTL_SEC") or 60)
+# старше этого курс не используем — оплату в этой валюте отклоняем
+RATE_MAX_STALE_SEC = int(os.environ.get("RATE_MAX_STALE_SEC") or 900)
+
 # -------------------------
 # SERVICES / PRICE TEMPLATE
 # -------------------------
@@ -102,31 +215,190 @@ if not BOT_TOKEN or ":" not in BOT_TOKEN:
 # -------------------------
 # Bot and Flask init
 # -------------------------
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True)
+# в webhook-режиме параллелизм даёт UpdateDispatcher (с сохранением порядка внутри чата),
+# поэтому встроенный пул потоков TeleBot там не нужен — он перемешал бы апдейты одного чата
+bot = telebot.TeleBot(BOT_TOKEN, threaded=not USE_WEBHOOK)
 app = Flask(__name__)
 
 # -------------------------
-# DB: init and helpers
+# Metrics
 # -------------------------
-def get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
 
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
+class LatencyStats:
+    """Число вызовов, ошибок и гистограмма задержек (мс) одной операции."""
+    __slots__ = ("count", "errors", "total_ms", "max_ms", "buckets", "_lock")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self._lock = threading.Lock()
+
+    def observe(self, ms: float, error: bool = False):
+        i = bisect.bisect_left(LATENCY_BUCKETS_MS, ms)
+        with self._lock:
+            self.count += 1
+            self.errors += 1 if error else 0
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+            self.buckets[i] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            hist = {f"le_{b}": n for b, n in zip(LATENCY_BUCKETS_MS, self.buckets)}
+            hist["inf"] = self.buckets[-1]
+            return {"count": self.count, "errors": self.errors,
+                    "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+                    "max_ms": round(self.max_ms, 2), "histogram": hist}
+
+_metrics: Dict[str, LatencyStats] = {}
+_metrics_lock = threading.Lock()
+_gauges: Dict[str, Callable[[], Any]] = {}
+
+def latency_stats(name: str) -> LatencyStats:
+    st = _metrics.get(name)
+    if st is None:
+        with _metrics_lock:
+            st = _metrics.setdefault(name, LatencyStats())
+    return st
+
+def register_gauge(name: str, fn: Callable[[], Any]):
+    """Мгновенное значение (глубина очереди и т.п.), вычисляется при снятии метрик."""
+    _gauges[name] = fn
+
+def metrics_snapshot() -> Dict[str, Any]:
+    snap: Dict[str, Any] = {name: st.snapshot() for name, st in sorted(_metrics.items())}
+    for name, fn in sorted(_gauges.items()):
+        try:
+            snap[name] = fn()
+        except Exception:
+            snap[name] = None
+    return snap
+
+# -------------------------
+# DB: connection manager
+# -------------------------
+class ConnectionManager:
+    """
+    Долгоживущие соединения SQLite — по одному на поток (TeleBot workers, платёжные потоки, Flask).
+    - WAL и PRAGMA настраиваются один раз при открытии соединения
+    - transaction() — общий контекстный менеджер для всех хелперов;
+      вложенный вызов в том же потоке присоединяется к внешней транзакции
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._on_connect: List[Callable[[sqlite3.Connection], None]] = []
+
+    def _open(self) -> sqlite3.Connection:
+        # isolation_level=None: транзакциями управляем сами через BEGIN/COMMIT
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000.0,
+                               isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # действует только на новый файл (до WAL и первой таблицы); существующий переводит vacuum_db()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        for fn in self._on_connect:
+            fn(conn)
+        return conn
+
+    def on_connect(self, fn: Callable[[sqlite3.Connection], None]):
+        """
+        fn(conn) для каждого нового соединения (ATTACH, TEMP VIEW); уже открытое соединение текущего потока — сразу.
+        Регистрировать при импорте, до старта рабочих потоков.
+        """
+        self._on_connect.append(fn)
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            fn(conn)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # соединение, унаследованное через fork, не используем и не закрываем (см. prefork)
+            conn = self._open()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.depth = 0
+            self._local.after_commit = []
+        return conn
+
+    def execute(self, sql: str, params: Any = ()) -> sqlite3.Cursor:
+        """Чтение / одиночный запрос в режиме autocommit (или внутри текущей транзакции потока)."""
+        return self.connection().execute(sql, params)
+
+    @contextmanager
+    def transaction(self, immediate: bool = True) -> Iterator[sqlite3.Cursor]:
+        """
+        BEGIN IMMEDIATE сразу берёт write-lock, поэтому не бывает
+        "database is locked" при апгрейде read -> write посреди транзакции.
+        """
+        conn = self.connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn.cursor()
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self._local.depth = 1
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.rollback()
+            self._local.after_commit = []
+            raise
+        else:
+            conn.commit()
+        finally:
+            self._local.depth = 0
+        callbacks, self._local.after_commit = self._local.after_commit, []
+        for fn in callbacks:
+            fn()
+
+    def after_commit(self, fn: Callable[[], None]):
+        """fn() после COMMIT внешней транзакции потока (при откате — не вызывается); вне транзакции — сразу."""
+        self.connection()
+        if self._local.depth:
+            self._local.after_commit.append(fn)
+        else:
+            fn()
+
+    def close(self):
+        """Закрывает соединение текущего потока (соединения завершившихся потоков закрывает GC)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+db = ConnectionManager(DB_FILE)
+
+# -------------------------
+# DB: schema migrations
+# -------------------------
+# Базовые таблицы (CREATE ... IF NOT EXISTS — безопасно для уже существующей боевой БД)
+_SCHEMA_V1 = [
     # users
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS users (
         chat_id INTEGER PRIMARY KEY,
         username TEXT,
         first_name TEXT,
         last_name TEXT,
         created_at TEXT
-    )""")
+    )""",
     # orders - completed entries or single-item orders
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS orders (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         chat_id INTEGER,
@@ -140,18 +412,18 @@ def init_db():
         pay_url TEXT,
         created_at TEXT,
         updated_at TEXT
-    )""")
+    )""",
     # carts - one active open cart per user
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS carts (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         chat_id INTEGER,
-        status TEXT, -- open, paid, cancelled
+        status TEXT, -- open, paid, cancelled, expired
         created_at TEXT,
         updated_at TEXT
-    )""")
+    )""",
     # cart_items
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS cart_items (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         cart_id INTEGER,
@@ -161,9 +433,9 @@ def init_db():
         price_usd REAL,
         link TEXT,
         created_at TEXT
-    )""")
+    )""",
     # invoices_map
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS invoices_map (
         invoice_id TEXT PRIMARY KEY,
         chat_id INTEGER,
@@ -171,18 +443,18 @@ def init_db():
         cart_id INTEGER,
         raw_payload TEXT,
         created_at TEXT
-    )""")
+    )""",
     # operators
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS operators (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         chat_id INTEGER UNIQUE,
         username TEXT,
         display_name TEXT,
         created_at TEXT
-    )""")
+    )""",
     # support
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS support_requests (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_chat INTEGER,
@@ -190,8 +462,8 @@ def init_db():
         text TEXT,
         status TEXT,
         created_at TEXT
-    )""")
-    cur.execute("""
+    )""",
+    """
     CREATE TABLE IF NOT EXISTS support_messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         req_id INTEGER,
@@ -199,244 +471,1622 @@ def init_db():
         to_chat INTEGER,
         text TEXT,
         created_at TEXT
-    )""")
+    )""",
     # operator notifications for editing messages
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS operator_notifications (
         operator_chat INTEGER PRIMARY KEY,
         message_id INTEGER,
         created_at TEXT
+    )""",
+]
+
+# Индексы под горячие запросы: корзина пользователя, позиции корзины, заказы пользователя,
+# открытые обращения и переписка по обращению.
+_SCHEMA_V2 = [
+    "CREATE INDEX IF NOT EXISTS idx_carts_chat_open ON carts (chat_id, id) WHERE status = 'open'",
+    "CREATE INDEX IF NOT EXISTS idx_cart_items_cart ON cart_items (cart_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_chat ON orders (chat_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_support_requests_open ON support_requests (id) WHERE status = 'open'",
+    "CREATE INDEX IF NOT EXISTS idx_support_messages_req ON support_messages (req_id, id)",
+    "ANALYZE",
+]
+
+# Очередь задач на создание счетов (см. PaymentJobQueue)
+_SCHEMA_V3 = [
+    """
+    CREATE TABLE IF NOT EXISTS payment_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,       -- cart, order
+        chat_id INTEGER,
+        ref_id INTEGER,  -- cart_id / order_id
+        asset TEXT,
+        status TEXT,     -- pending, running, done, failed
+        attempts INTEGER DEFAULT 0,
+        last_error TEXT,
+        created_at TEXT,
+        updated_at TEXT
+    )""",
+    # не больше одной незавершённой задачи на (чат, корзина/заказ, валюта) — защита от двойного клика
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_jobs_active ON payment_jobs (kind, chat_id, ref_id, asset) WHERE status IN ('pending', 'running')",
+    "CREATE INDEX IF NOT EXISTS idx_payment_jobs_pending ON payment_jobs (id) WHERE status = 'pending'",
+]
+
+# Уже проведённые инвойсы — повторная доставка IPN не создаёт заказы заново
+_SCHEMA_V4 = [
+    """
+    CREATE TABLE IF NOT EXISTS processed_invoices (
+        invoice_id TEXT PRIMARY KEY,
+        chat_id INTEGER,
+        order_id INTEGER,
+        cart_id INTEGER,
+        amount TEXT,
+        asset TEXT,
+        processed_at TEXT
+    )""",
+]
+
+# Состояние диалогов (SQLiteStateStore)
+_SCHEMA_V5 = [
+    """
+    CREATE TABLE IF NOT EXISTS conversation_state (
+        namespace TEXT,
+        key INTEGER,
+        value TEXT,
+        expires_at REAL,
+        PRIMARY KEY (namespace, key)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_conversation_state_expires ON conversation_state (expires_at)",
+]
+
+# Счётчики обращений одной строкой: страницы и уведомления не делают COUNT(*) по таблице.
+# Поддерживаются в тех же транзакциях, что create_support_request / close_request.
+_SCHEMA_V6 = [
+    """
+    CREATE TABLE IF NOT EXISTS support_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        open_count INTEGER NOT NULL DEFAULT 0,
+        closed_count INTEGER NOT NULL DEFAULT 0
+    )""",
+    """
+    INSERT OR REPLACE INTO support_stats (id, open_count, closed_count)
+    SELECT 1,
+           COALESCE(SUM(status = 'open'), 0),
+           COALESCE(SUM(status = 'closed'), 0)
+    FROM support_requests""",
+]
+
+# Индексы под фильтры админского браузера заказов (/sadm): keyset по id внутри статуса/соцсети,
+# диапазон дат -> диапазон id через created_at
+_SCHEMA_V7 = [
+    "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_social ON orders (social, id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)",
+    "ANALYZE",
+]
+
+# Агрегаты заказов по дням: срез orders по (день created_at, соцсеть, услуга, валюта, статус).
+# Поддерживаются дельтами в тех же транзакциях, что создают заказ или меняют его статус,
+# заполняются для старых данных фоновым RollupBackfill (по дню на короткую транзакцию).
+_SCHEMA_V8 = [
+    "ALTER TABLE orders ADD COLUMN asset TEXT",
+    """
+    CREATE TABLE IF NOT EXISTS rollup_daily (
+        day TEXT NOT NULL,
+        social TEXT NOT NULL,
+        service_key TEXT NOT NULL,
+        asset TEXT NOT NULL DEFAULT '',
+        status TEXT NOT NULL,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue_usd REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, social, service_key, asset, status)
+    ) WITHOUT ROWID""",
+    """
+    CREATE TABLE IF NOT EXISTS app_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+    # курсор досчёта: '' — с самого начала; строка удаляется, когда досчитано
+    "INSERT OR REPLACE INTO app_meta (key, value) VALUES ('rollup_backfill', '')",
+]
+
+# Статус инвойса для сверки: NULL — ждём оплаты, 'paid' / 'expired' — сверять больше не нужно
+_SCHEMA_V9 = [
+    "ALTER TABLE invoices_map ADD COLUMN status TEXT",
+    "UPDATE invoices_map SET status = 'paid' WHERE invoice_id IN (SELECT invoice_id FROM processed_invoices)",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_map_pending ON invoices_map (created_at) WHERE status IS NULL",
+]
+
+# Индексы под очистку устаревших данных (MaintenanceScheduler)
+_SCHEMA_V10 = [
+    "CREATE INDEX IF NOT EXISTS idx_carts_open_updated ON carts (updated_at) WHERE status = 'open'",
+    "CREATE INDEX IF NOT EXISTS idx_carts_closed_updated ON carts (updated_at) WHERE status != 'open'",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_map_created ON invoices_map (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_map_cart_pending ON invoices_map (cart_id) WHERE status IS NULL",
+    "CREATE INDEX IF NOT EXISTS idx_payment_jobs_finished ON payment_jobs (updated_at) WHERE status IN ('done', 'failed')",
+]
+
+# Прогрев KnownUsers — последние зарегистрированные пользователи (chat_id — ключ users, rowid порядка регистрации не хранит)
+_SCHEMA_V11 = [
+    "CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)",
+]
+
+_SCHEMA_V12 = [
+    # prefork: апдейты Telegram и IPN, принятые HTTP-воркерами, до разбора бот-процессом
+    """CREATE TABLE IF NOT EXISTS inbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        received_at REAL NOT NULL
+    )""",
+]
+
+# Сверка обходит ожидающие инвойсы по ключу (created_at, invoice_id) — индекс под keyset-выборку
+_SCHEMA_V13 = [
+    "DROP INDEX IF EXISTS idx_invoices_map_pending",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_map_pending_key ON invoices_map (created_at, invoice_id) WHERE status IS NULL",
+]
+
+# (версия, описание, шаги). Новые миграции — только в конец списка, применённые не редактируем.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "base tables", _SCHEMA_V1),
+    (2, "secondary indexes for hot queries", _SCHEMA_V2),
+    (3, "payment job queue", _SCHEMA_V3),
+    (4, "processed invoices for idempotent IPN", _SCHEMA_V4),
+    (5, "conversation state store", _SCHEMA_V5),
+    (6, "support request counters", _SCHEMA_V6),
+    (7, "order browser indexes", _SCHEMA_V7),
+    (8, "daily order rollups", _SCHEMA_V8),
+    (9, "invoice status for reconciliation", _SCHEMA_V9),
+    (10, "maintenance indexes", _SCHEMA_V10),
+    (11, "users by registration time", _SCHEMA_V11),
+    (12, "prefork inbox", _SCHEMA_V12),
+    (13, "keyset index for pending invoices", _SCHEMA_V13),
+]
+
+def get_schema_version() -> int:
+    r = db.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_version").fetchone()
+    return r["v"]
+
+def run_migrations():
+    """
+    Применяет недостающие миграции по порядку, каждую — в своей транзакции.
+    Версия перепроверяется под write-lock, так что параллельный старт нескольких процессов безопасен.
+    """
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT
     )""")
-    conn.commit()
-    conn.close()
+    current = get_schema_version()
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        with db.transaction() as cur:
+            cur.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if cur.fetchone():
+                continue
+            for step in steps:
+                cur.execute(step)
+            cur.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                        (version, description, datetime.utcnow().isoformat()))
+        print(f"DB migration {version} applied: {description}")
+
+def vacuum_db():
+    """
+    Разовая команда оператора (python SaleTest.py vacuum, бот остановлен): переводит файл, созданный
+    до auto_vacuum=INCREMENTAL, в этот режим полным VACUUM. VACUUM переписывает весь файл под
+    эксклюзивной блокировкой и требует столько же свободного места — поэтому при старте не выполняется.
+    """
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:   # 2 = INCREMENTAL
+        print("DB auto_vacuum is already INCREMENTAL, nothing to do")
+        return
+    started = time.perf_counter()
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute("VACUUM")
+    print(f"DB converted to auto_vacuum=INCREMENTAL in {time.perf_counter() - started:.1f}s")
+
+def init_db():
+    run_migrations()
 
 # ensure DB exists
 init_db()
 
+# -------------------------
+# DB: archive (ATTACH)
+# -------------------------
+# Холодные строки этих таблиц лежат в ARCHIVE_DB_FILE (схема archive). Чтения истории (профиль, /sadm, выгрузка,
+# пересчёт rollup) идут через TEMP VIEW all_<таблица> = main UNION ALL archive; горячий путь (оплата,
+# смена статуса, открытые обращения) работает только с основной БД — туда архивные строки уже не попадут.
+ARCHIVED_TABLES = ("orders", "support_requests", "support_messages")
+_ARCHIVE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS archive.idx_orders_chat ON orders (chat_id, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_orders_status ON orders (status, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_orders_social ON orders (social, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_orders_created ON orders (created_at)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_support_messages_req ON support_messages (req_id, id)",
+]
+_archive_synced_pid: Optional[int] = None
+
+def table_columns(conn: sqlite3.Connection, schema: str, table: str) -> List[Tuple[str, str]]:
+    return [(r["name"], r["type"]) for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def _sync_archive_schema(conn: sqlite3.Connection):
+    """
+    Таблицы архива повторяют колонки основных, включая добавленные миграциями позже (ALTER ... ADD COLUMN).
+    Под write-lock, чтобы параллельно стартующие процессы не добавляли одну колонку дважды.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table in ARCHIVED_TABLES:
+            live = table_columns(conn, "main", table)
+            have = {name for name, _ in table_columns(conn, "archive", table)}
+            if not have:
+                cols = ", ".join(f"{name} {type_}" + (" PRIMARY KEY" if name == "id" else "") for name, type_ in live)
+                conn.execute(f"CREATE TABLE archive.{table} ({cols})")
+            for name, type_ in live:
+                if have and name not in have:
+                    conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {name} {type_}")
+        for sql in _ARCHIVE_INDEXES:
+            conn.execute(sql)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def attach_archive(conn: sqlite3.Connection):
+    """ATTACH архива и TEMP VIEW all_<таблица> на новом соединении; без архива view читают только основную БД."""
+    global _archive_synced_pid
+    sources = ["main"]
+    if ARCHIVE_DB_FILE != "off":
+        conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_FILE,))
+        conn.execute("PRAGMA archive.journal_mode=WAL")
+        conn.execute("PRAGMA archive.synchronous=NORMAL")
+        if _archive_synced_pid != os.getpid():
+            _sync_archive_schema(conn)
+            _archive_synced_pid = os.getpid()
+        sources.append("archive")
+    for table in ARCHIVED_TABLES:
+        cols = ", ".join(name for name, _ in table_columns(conn, "main", table))
+        # строка, оставшаяся в обоих файлах после сбоя переноса или возвращённая из архива, видна один раз — из main
+        legs = [f"SELECT {cols} FROM main.{table}"] + \
+               [f"SELECT {cols} FROM {src}.{table} WHERE id NOT IN (SELECT id FROM main.{table})" for src in sources[1:]]
+        conn.execute(f"DROP VIEW IF EXISTS temp.all_{table}")
+        conn.execute(f"CREATE TEMP VIEW all_{table} AS " + " UNION ALL ".join(legs))
+
+# после миграций: архив повторяет уже актуальную схему основных таблиц
+db.on_connect(attach_archive)
+
 # -------------------------
 # DB utility functions
 # -------------------------
+def _user_profile(message: telebot.types.Message) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    u = message.from_user
+    return (getattr(u, "username", None), getattr(u, "first_name", None), getattr(u, "last_name", None))
+
 def ensure_user(chat_id: int, message: Optional[telebot.types.Message] = None):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT chat_id FROM users WHERE chat_id = ?", (chat_id,))
-    if not cur.fetchone() and message is not None:
-        now = datetime.utcnow().isoformat()
-        cur.execute("INSERT INTO users (chat_id, username, first_name, last_name, created_at) VALUES (?, ?, ?, ?, ?)",
-                    (chat_id,
-                     getattr(message.from_user, "username", None),
-                     getattr(message.from_user, "first_name", None),
-                     getattr(message.from_user, "last_name", None),
-                     now))
-        conn.commit()
-    conn.close()
+    """Без обращения к БД: известный пользователь с тем же профилем — no-op, иначе upsert уходит в фоновую пачку."""
+    if message is None:
+        return
+    known_users.touch(chat_id, _user_profile(message))
+
+def upsert_users(rows: List[Tuple[int, Optional[str], Optional[str], Optional[str], str]]):
+    """Пачка (chat_id, username, first_name, last_name, created_at) одной транзакцией; created_at существующих не трогаем."""
+    with db.transaction() as cur:
+        cur.executemany("""
+            INSERT INTO users (chat_id, username, first_name, last_name, created_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name
+            WHERE users.username IS NOT excluded.username
+               OR users.first_name IS NOT excluded.first_name
+               OR users.last_name IS NOT excluded.last_name""", rows)
 
 def get_or_create_cart(chat_id: int) -> int:
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT id FROM carts WHERE chat_id = ? AND status = 'open' ORDER BY id DESC LIMIT 1", (chat_id,))
-    r = cur.fetchone()
+    r = db.execute("SELECT id FROM carts WHERE chat_id = ? AND status = 'open' ORDER BY id DESC LIMIT 1", (chat_id,)).fetchone()
     if r:
-        cid = r["id"]
-    else:
+        return r["id"]
+    with db.transaction() as cur:
+        # повторная проверка под write-lock: два параллельных клика не создадут две корзины
+        cur.execute("SELECT id FROM carts WHERE chat_id = ? AND status = 'open' ORDER BY id DESC LIMIT 1", (chat_id,))
+        r = cur.fetchone()
+        if r:
+            return r["id"]
         now = datetime.utcnow().isoformat()
         cur.execute("INSERT INTO carts (chat_id, status, created_at, updated_at) VALUES (?, ?, ?, ?)", (chat_id, "open", now, now))
-        cid = cur.lastrowid
-        conn.commit()
-    conn.close()
-    return cid
+        return cur.lastrowid
+
+def _profile_changed(chat_id: Optional[int]):
+    """Сбросить кэш профиля чата после коммита текущей транзакции."""
+    if chat_id is not None:
+        db.after_commit(lambda: profile_views.invalidate(chat_id))
+
+def _cart_chat(cur: sqlite3.Cursor, cart_id: int) -> Optional[int]:
+    cur.execute("SELECT chat_id FROM carts WHERE id = ?", (cart_id,))
+    r = cur.fetchone()
+    return r["chat_id"] if r else None
 
 def add_item_to_cart(cart_id: int, social: str, service_key: str, amount: int, link: str, price_usd: float) -> int:
     now = datetime.utcnow().isoformat()
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("INSERT INTO cart_items (cart_id, social, service_key, amount, price_usd, link, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (cart_id, social, service_key, amount, price_usd, link, now))
-    cur.execute("UPDATE carts SET updated_at = ? WHERE id = ?", (now, cart_id))
-    conn.commit()
-    item_id = cur.lastrowid
-    conn.close()
+    with db.transaction() as cur:
+        cur.execute("INSERT INTO cart_items (cart_id, social, service_key, amount, price_usd, link, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (cart_id, social, service_key, amount, price_usd, link, now))
+        item_id = cur.lastrowid
+        cur.execute("UPDATE carts SET updated_at = ? WHERE id = ?", (now, cart_id))
+        _profile_changed(_cart_chat(cur, cart_id))
+        item = {"id": item_id, "cart_id": cart_id, "social": social, "service_key": service_key, "amount": amount,
+                "price_usd": price_usd, "link": link, "created_at": now}
+        db.after_commit(lambda: cart_repo.item_added(cart_id, item))
     return item_id
 
 def get_cart_items(cart_id: int) -> List[Dict[str, Any]]:
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM cart_items WHERE cart_id = ?", (cart_id,))
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return rows
+    return [dict(r) for r in db.execute("SELECT * FROM cart_items WHERE cart_id = ?", (cart_id,)).fetchall()]
+
+def get_profile_rows(chat_id: int, orders_limit: int = 10) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Позиции открытой корзины и последние заказы чата одним запросом: (items, orders)."""
+    rows = db.execute("""
+        SELECT * FROM (
+            SELECT 'item' AS kind, id, cart_id, social, service_key, amount, price_usd, link, NULL AS status
+            FROM cart_items
+            WHERE cart_id = (SELECT id FROM carts WHERE chat_id = ? AND status = 'open' ORDER BY id DESC LIMIT 1)
+            ORDER BY id)
+        UNION ALL
+        SELECT * FROM (
+            SELECT 'order', id, NULL, social, service_key, amount, price_usd, link, status
+            FROM all_orders WHERE chat_id = ? ORDER BY id DESC LIMIT ?)""", (chat_id, chat_id, orders_limit)).fetchall()
+    items = [dict(r) for r in rows if r["kind"] == "item"]
+    orders = [dict(r) for r in rows if r["kind"] == "order"]
+    return items, orders
 
 def remove_cart_item(item_id: int):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("DELETE FROM cart_items WHERE id = ?", (item_id,))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("SELECT c.id, c.chat_id FROM cart_items ci JOIN carts c ON c.id = ci.cart_id WHERE ci.id = ?", (item_id,))
+        r = cur.fetchone()
+        cur.execute("DELETE FROM cart_items WHERE id = ?", (item_id,))
+        if r:
+            _profile_changed(r["chat_id"])
+            db.after_commit(lambda: cart_repo.item_removed(r["id"], item_id))
 
 def clear_cart(cart_id: int):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("DELETE FROM cart_items WHERE cart_id = ?", (cart_id,))
-    cur.execute("UPDATE carts SET status = ?, updated_at = ? WHERE id = ?", ("cancelled", datetime.utcnow().isoformat(), cart_id))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM cart_items WHERE cart_id = ?", (cart_id,))
+        cur.execute("UPDATE carts SET status = ?, updated_at = ? WHERE id = ?", ("cancelled", datetime.utcnow().isoformat(), cart_id))
+        _profile_changed(_cart_chat(cur, cart_id))
+        db.after_commit(lambda: cart_repo.closed(cart_id))
 
 def mark_cart_paid(cart_id: int):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("UPDATE carts SET status = ?, updated_at = ? WHERE id = ?", ("paid", datetime.utcnow().isoformat(), cart_id))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("UPDATE carts SET status = ?, updated_at = ? WHERE id = ?", ("paid", datetime.utcnow().isoformat(), cart_id))
+        _profile_changed(_cart_chat(cur, cart_id))
+        db.after_commit(lambda: cart_repo.closed(cart_id))
+
+def _rollup_add(cur: sqlite3.Cursor, created_at: str, social: str, service_key: str, asset: Optional[str],
+                status: str, orders: int, revenue_usd: float):
+    """Дельта к rollup_daily; вызывать в транзакции, которая меняет orders."""
+    cur.execute("""
+        INSERT INTO rollup_daily (day, social, service_key, asset, status, orders, revenue_usd) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (day, social, service_key, asset, status) DO UPDATE SET
+            orders = orders + excluded.orders, revenue_usd = revenue_usd + excluded.revenue_usd""",
+                (created_at[:10], social or "", service_key or "", asset or "", status or "", orders, revenue_usd))
+
+def settle_cart(cart_id: int, chat_id: int, invoice_id: Optional[str] = None, asset: Optional[str] = None) -> Optional[int]:
+    """
+    Оплата корзины одной транзакцией: позиции переносятся в orders (status='paid', invoice_id)
+    одним INSERT ... SELECT, корзина помечается оплаченной. Сбой посередине не оставит
+    частично перенесённую корзину. Возвращает число созданных заказов или None, если корзина уже
+    не открыта (оплачена другим счётом, отменена, истекла) — проводить нечего.
+    """
+    now = datetime.utcnow().isoformat()
+    with db.transaction() as cur:
+        cur.execute("UPDATE carts SET status = 'paid', updated_at = ? WHERE id = ? AND status = 'open'", (now, cart_id))
+        if cur.rowcount == 0:
+            return None
+        _profile_changed(chat_id)
+        db.after_commit(lambda: cart_repo.closed(cart_id))
+        cur.execute("""INSERT INTO orders (chat_id, social, service_key, amount, price_usd, link, status, invoice_id, asset, created_at, updated_at)
+                       SELECT ?, social, service_key, amount, price_usd, link, 'paid', ?, ?, ?, ?
+                       FROM cart_items WHERE cart_id = ? ORDER BY id""",
+                    (chat_id, invoice_id, asset, now, now, cart_id))
+        created = cur.rowcount
+        # WHERE true — обязательная оговорка SQLite для upsert поверх INSERT ... SELECT
+        cur.execute("""
+            INSERT INTO rollup_daily (day, social, service_key, asset, status, orders, revenue_usd)
+            SELECT ?, COALESCE(social, ''), COALESCE(service_key, ''), ?, 'paid', COUNT(*), COALESCE(SUM(price_usd), 0)
+            FROM cart_items WHERE cart_id = ? AND true GROUP BY 2, 3
+            ON CONFLICT (day, social, service_key, asset, status) DO UPDATE SET
+                orders = orders + excluded.orders, revenue_usd = revenue_usd + excluded.revenue_usd""",
+                    (now[:10], asset or "", cart_id))
+        return created
 
 def create_order_from_cart_item(chat_id: int, cart_item: dict, status: str = "awaiting_payment") -> int:
     now = datetime.utcnow().isoformat()
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("""INSERT INTO orders (chat_id, social, service_key, amount, price_usd, link, status, created_at, updated_at)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (chat_id, cart_item["social"], cart_item["service_key"], cart_item["amount"], cart_item["price_usd"],
-                 cart_item["link"], status, now, now))
-    oid = cur.lastrowid
-    conn.commit(); conn.close()
-    return oid
+    with db.transaction() as cur:
+        cur.execute("""INSERT INTO orders (chat_id, social, service_key, amount, price_usd, link, status, created_at, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (chat_id, cart_item["social"], cart_item["service_key"], cart_item["amount"], cart_item["price_usd"],
+                     cart_item["link"], status, now, now))
+        _rollup_add(cur, now, cart_item["social"], cart_item["service_key"], None, status, 1, float(cart_item["price_usd"]))
+        _profile_changed(chat_id)
+        return cur.lastrowid
 
 def create_single_order(chat_id:int, social:str, service_key:str, amount:int, price_usd:float, link:str, status:str="awaiting_payment") -> int:
     now = datetime.utcnow().isoformat()
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("""INSERT INTO orders (chat_id, social, service_key, amount, price_usd, link, status, created_at, updated_at)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (chat_id, social, service_key, amount, price_usd, link, status, now, now))
-    oid = cur.lastrowid
-    conn.commit(); conn.close()
-    return oid
+    with db.transaction() as cur:
+        cur.execute("""INSERT INTO orders (chat_id, social, service_key, amount, price_usd, link, status, created_at, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (chat_id, social, service_key, amount, price_usd, link, status, now, now))
+        _rollup_add(cur, now, social, service_key, None, status, 1, float(price_usd))
+        _profile_changed(chat_id)
+        return cur.lastrowid
+
+def get_order(order_id: int) -> Optional[Dict[str, Any]]:
+    r = db.execute("SELECT * FROM all_orders WHERE id = ?", (order_id,)).fetchone()
+    return dict(r) if r else None
+
+def get_recent_orders(chat_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    return [dict(r) for r in db.execute("SELECT * FROM all_orders WHERE chat_id = ? ORDER BY id DESC LIMIT ?", (chat_id, limit)).fetchall()]
+
+ORDER_EXPORT_COLUMNS = ("id", "chat_id", "social", "service_key", "amount", "price_usd", "status",
+                        "invoice_id", "link", "created_at", "updated_at")
+
+def _orders_filter(filters: Dict[str, Any]) -> Tuple[Optional[List[str]], List[Any]]:
+    """
+    WHERE-условия для фильтров {status, social, from, to} (даты — 'YYYY-MM-DD', to включительно).
+    Диапазон дат дополнительно сужается до диапазона id (id и created_at растут вместе) —
+    так keyset по id идёт по индексу, а проверка created_at оставляет результат точным.
+    None вместо условий — под фильтр заведомо ничего не попадает.
+    """
+    where: List[str] = []
+    params: List[Any] = []
+    for col in ("status", "social"):
+        if filters.get(col):
+            where.append(f"{col} = ?")
+            params.append(filters[col])
+    # created_at в списке колонок обязателен: так ORDER BY ... LIMIT 1 по all_orders идёт слиянием двух индексов,
+    # а не сортировкой всего объединения
+    if filters.get("from"):
+        r = db.execute("SELECT id, created_at FROM all_orders WHERE created_at >= ? ORDER BY created_at LIMIT 1", (filters["from"],)).fetchone()
+        if r is None:
+            return None, []
+        where += ["id >= ?", "created_at >= ?"]
+        params += [r["id"], filters["from"]]
+    if filters.get("to"):
+        to_excl = (datetime.strptime(filters["to"], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        r = db.execute("SELECT id, created_at FROM all_orders WHERE created_at < ? ORDER BY created_at DESC LIMIT 1", (to_excl,)).fetchone()
+        if r is None:
+            return None, []
+        where += ["id <= ?", "created_at < ?"]
+        params += [r["id"], to_excl]
+    return where, params
+
+def browse_orders(filters: Dict[str, Any], direction: Optional[str] = None, cursor: int = 0,
+                  limit: int = ADMIN_PAGE_SIZE) -> List[Dict[str, Any]]:
+    """Keyset-страница заказов от новых к старым: '>' — следующая (id < cursor), '<' — предыдущая (id > cursor)."""
+    where, params = _orders_filter(filters)
+    if where is None:
+        return []
+    if direction == "<":
+        where.append("id > ?")
+        params.append(cursor)
+        order = "ASC"
+    else:
+        if direction == ">":
+            where.append("id < ?")
+            params.append(cursor)
+        order = "DESC"
+    sql = "SELECT * FROM all_orders" + (" WHERE " + " AND ".join(where) if where else "") + f" ORDER BY id {order} LIMIT ?"
+    rows = [dict(r) for r in db.execute(sql, params + [limit]).fetchall()]
+    if direction == "<":
+        rows.reverse()
+    return rows
+
+def iter_orders(filters: Dict[str, Any], batch: int = 1000) -> Iterator[sqlite3.Row]:
+    """Все заказы под фильтром от новых к старым курсором через fetchmany — память не зависит от числа строк."""
+    where, params = _orders_filter(filters)
+    if where is None:
+        return
+    sql = f"SELECT {', '.join(ORDER_EXPORT_COLUMNS)} FROM all_orders" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY id DESC"
+    cur = db.connection().cursor()
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
+
+def set_order_status(order_id: int, status: str, asset: Optional[str] = None) -> bool:
+    """
+    Смена статуса (и валюты оплаты) заказа вместе с переносом его строки в rollup_daily. False — менять нечего.
+    Заказ из архива (например, поздняя оплата истёкшего) сначала возвращается в основную БД.
+    """
+    with db.transaction() as cur:
+        cur.execute("SELECT chat_id, social, service_key, price_usd, status, asset, created_at FROM orders WHERE id = ?", (order_id,))
+        r = cur.fetchone()
+        if r is None and ARCHIVE_DB_FILE != "off":
+            cols = ", ".join(name for name, _ in table_columns(cur.connection, "main", "orders"))
+            cur.execute(f"INSERT INTO main.orders ({cols}) SELECT {cols} FROM archive.orders WHERE id = ?", (order_id,))
+            if cur.rowcount:
+                cur.execute("DELETE FROM archive.orders WHERE id = ?", (order_id,))
+                cur.execute("SELECT chat_id, social, service_key, price_usd, status, asset, created_at FROM orders WHERE id = ?", (order_id,))
+                r = cur.fetchone()
+        new_asset = asset or (r["asset"] if r else None)
+        if r is None or (r["status"] == status and r["asset"] == new_asset):
+            return False
+        cur.execute("UPDATE orders SET status = ?, asset = ?, updated_at = ? WHERE id = ?",
+                    (status, new_asset, datetime.utcnow().isoformat(), order_id))
+        created_at = r["created_at"] or ""
+        price = float(r["price_usd"] or 0)
+        _rollup_add(cur, created_at, r["social"], r["service_key"], r["asset"], r["status"], -1, -price)
+        _rollup_add(cur, created_at, r["social"], r["service_key"], new_asset, status, 1, price)
+        _profile_changed(r["chat_id"])
+        return True
+
+def mark_order_paid(order_id: int, asset: Optional[str] = None) -> bool:
+    return set_order_status(order_id, "paid", asset)
+
+def rebuild_rollup_day(day: str):
+    """Пересчёт одного дня rollup_daily из orders (вместе с архивом) — короткая транзакция, писатели ждут её миллисекунды."""
+    next_day = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM rollup_daily WHERE day = ?", (day,))
+        cur.execute("""
+            INSERT INTO rollup_daily (day, social, service_key, asset, status, orders, revenue_usd)
+            SELECT ?, COALESCE(social, ''), COALESCE(service_key, ''), COALESCE(asset, ''), COALESCE(status, ''),
+                   COUNT(*), COALESCE(SUM(price_usd), 0)
+            FROM all_orders WHERE created_at >= ? AND created_at < ?
+            GROUP BY 2, 3, 4, 5""", (day, day, next_day))
+
+def next_order_day(after_day: str) -> Optional[str]:
+    """Следующий день (> after_day), в котором есть заказы, — один поиск по idx_orders_created."""
+    start = (datetime.strptime(after_day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d") if after_day else ""
+    r = db.execute("SELECT created_at FROM all_orders WHERE created_at >= ? ORDER BY created_at LIMIT 1", (start,)).fetchone()
+    return r["created_at"][:10] if r and r["created_at"] else None
+
+def get_rollup_stats(since_day: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Сводка из rollup_daily начиная с since_day: по дням, по соцсетям и по валютам (оплаченные)."""
+    by_day = db.execute("""
+        SELECT day, SUM(orders) AS orders,
+               SUM(CASE WHEN status = 'paid' THEN orders ELSE 0 END) AS paid,
+               SUM(CASE WHEN status = 'paid' THEN revenue_usd ELSE 0 END) AS revenue
+        FROM rollup_daily WHERE day >= ? GROUP BY day ORDER BY day""", (since_day,)).fetchall()
+    by_social = db.execute("""
+        SELECT social, SUM(orders) AS paid, SUM(revenue_usd) AS revenue
+        FROM rollup_daily WHERE day >= ? AND status = 'paid' GROUP BY social ORDER BY revenue DESC""", (since_day,)).fetchall()
+    by_asset = db.execute("""
+        SELECT asset, SUM(orders) AS paid, SUM(revenue_usd) AS revenue
+        FROM rollup_daily WHERE day >= ? AND status = 'paid' GROUP BY asset ORDER BY revenue DESC""", (since_day,)).fetchall()
+    return {"by_day": [dict(r) for r in by_day], "by_social": [dict(r) for r in by_social], "by_asset": [dict(r) for r in by_asset]}
 
 def update_order_invoice(order_id:int, invoice_id:Optional[str], pay_url:Optional[str]):
     now = datetime.utcnow().isoformat()
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("UPDATE orders SET invoice_id = ?, pay_url = ?, updated_at = ? WHERE id = ?", (invoice_id, pay_url, now, order_id))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("UPDATE orders SET invoice_id = ?, pay_url = ?, updated_at = ? WHERE id = ?", (invoice_id, pay_url, now, order_id))
 
 def set_invoice_mapping(invoice_id: str, chat_id: int, order_id: Optional[int] = None, cart_id: Optional[int] = None, raw_payload: Optional[Any] = None):
     now = datetime.utcnow().isoformat()
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO invoices_map (invoice_id, chat_id, order_id, cart_id, raw_payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (invoice_id, chat_id, order_id, cart_id, json.dumps(raw_payload, ensure_ascii=False) if raw_payload else None, now))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("INSERT OR REPLACE INTO invoices_map (invoice_id, chat_id, order_id, cart_id, raw_payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (invoice_id, chat_id, order_id, cart_id, json.dumps(raw_payload, ensure_ascii=False) if raw_payload else None, now))
+    invoice_reconciler.nudge()
+
+def acquire_lease(name: str, ttl: float) -> bool:
+    """
+    Аренда фоновой работы на ttl секунд (строка '<pid>:<до>' в app_meta): в prefork её выполняет один процесс.
+    Владелец продлевает аренду повторным вызовом.
+    """
+    key, me, now = f"lease:{name}", str(os.getpid()), time.time()
+    with db.transaction() as cur:
+        cur.execute("SELECT value FROM app_meta WHERE key = ?", (key,))
+        r = cur.fetchone()
+        if r and r["value"]:
+            owner, _, until = r["value"].partition(":")
+            if owner != me and float(until or 0) > now:
+                return False
+        cur.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)", (key, f"{me}:{now + ttl}"))
+    return True
+
+def release_lease(name: str):
+    """Досрочно отдаёт свою аренду (при остановке процесса)."""
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM app_meta WHERE key = ? AND value LIKE ?", (f"lease:{name}", f"{os.getpid()}:%"))
+
+def get_pending_invoice_ids(limit: int, after: Optional[Tuple[str, str]] = None) -> List[Tuple[str, str]]:
+    """
+    Инвойсы, для которых API ещё не сообщил финальный статус, старые — первыми: [(created_at, invoice_id)].
+    after — ключ последней строки предыдущей выборки (keyset): обход продолжается с этого места.
+    """
+    if after is None:
+        rows = db.execute("SELECT created_at, invoice_id FROM invoices_map WHERE status IS NULL "
+                          "ORDER BY created_at, invoice_id LIMIT ?", (limit,)).fetchall()
+    else:
+        rows = db.execute("SELECT created_at, invoice_id FROM invoices_map WHERE status IS NULL "
+                          "AND (created_at, invoice_id) > (?, ?) ORDER BY created_at, invoice_id LIMIT ?",
+                          (after[0], after[1], limit)).fetchall()
+    return [(r["created_at"], r["invoice_id"]) for r in rows]
+
+def set_invoices_status(invoice_ids: List[str], status: str):
+    with db.transaction() as cur:
+        cur.executemany("UPDATE invoices_map SET status = ? WHERE invoice_id = ? AND status IS NULL",
+                        [(status, i) for i in invoice_ids])
+
+def get_invoice_mapping(invoice_id: str) -> Optional[Dict[str, Any]]:
+    r = db.execute("SELECT * FROM invoices_map WHERE invoice_id = ?", (invoice_id,)).fetchone()
+    return dict(r) if r else None
 
 def list_operators() -> List[Dict[str, Any]]:
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM operators ORDER BY id")
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close(); return rows
+    return [dict(r) for r in db.execute("SELECT * FROM operators ORDER BY id").fetchall()]
 
 def add_operator(chat_id:int, username:Optional[str]=None, display_name:Optional[str]=None):
-    conn = get_db(); cur = conn.cursor()
     now = datetime.utcnow().isoformat()
-    cur.execute("INSERT OR IGNORE INTO operators (chat_id, username, display_name, created_at) VALUES (?, ?, ?, ?)", (chat_id, username, display_name, now))
-    conn.commit(); conn.close()
-    # ensure notification row
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO operator_notifications (operator_chat, message_id, created_at) VALUES (?, ?, ?)", (chat_id, None, now))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("INSERT OR IGNORE INTO operators (chat_id, username, display_name, created_at) VALUES (?, ?, ?, ?)", (chat_id, username, display_name, now))
+        # ensure notification row
+        cur.execute("INSERT OR IGNORE INTO operator_notifications (operator_chat, message_id, created_at) VALUES (?, ?, ?)", (chat_id, None, now))
 
 def remove_operator(chat_id:int):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("DELETE FROM operators WHERE chat_id = ?", (chat_id,))
-    cur.execute("DELETE FROM operator_notifications WHERE operator_chat = ?", (chat_id,))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM operators WHERE chat_id = ?", (chat_id,))
+        cur.execute("DELETE FROM operator_notifications WHERE operator_chat = ?", (chat_id,))
 
 def get_open_requests_count() -> int:
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as c FROM support_requests WHERE status = 'open'")
-    r = cur.fetchone(); conn.close(); return r["c"] if r else 0
+    r = db.execute("SELECT open_count FROM support_stats WHERE id = 1").fetchone()
+    return r["open_count"] if r else 0
+
+def get_support_stats() -> Dict[str, int]:
+    r = db.execute("SELECT open_count, closed_count FROM support_stats WHERE id = 1").fetchone()
+    return {"open": r["open_count"], "closed": r["closed_count"]} if r else {"open": 0, "closed": 0}
 
 def create_support_request(user_chat:int, username:str, text:str) -> int:
     now = datetime.utcnow().isoformat()
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("INSERT INTO support_requests (user_chat, username, text, status, created_at) VALUES (?, ?, ?, ?, ?)", (user_chat, username, text, "open", now))
-    rid = cur.lastrowid
-    cur.execute("INSERT INTO support_messages (req_id, from_chat, to_chat, text, created_at) VALUES (?, ?, ?, ?, ?)", (rid, user_chat, None, text, now))
-    conn.commit(); conn.close(); return rid
+    with db.transaction() as cur:
+        cur.execute("INSERT INTO support_requests (user_chat, username, text, status, created_at) VALUES (?, ?, ?, ?, ?)", (user_chat, username, text, "open", now))
+        rid = cur.lastrowid
+        cur.execute("INSERT INTO support_messages (req_id, from_chat, to_chat, text, created_at) VALUES (?, ?, ?, ?, ?)", (rid, user_chat, None, text, now))
+        cur.execute("UPDATE support_stats SET open_count = open_count + 1 WHERE id = 1")
+    return rid
 
-def get_open_requests(offset:int=0, limit:int=10):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM support_requests WHERE status = 'open' ORDER BY id ASC LIMIT ? OFFSET ?", (limit, offset))
-    rows = [dict(r) for r in cur.fetchall()]; conn.close(); return rows
+def get_open_requests(after_id:int=0, limit:int=10, before_id:Optional[int]=None):
+    """
+    Keyset-страница открытых обращений по возрастанию id: следующие после after_id
+    или (before_id) предыдущие перед ним. Стоимость не зависит от глубины страницы.
+    """
+    if before_id is not None:
+        rows = db.execute("SELECT * FROM support_requests WHERE status = 'open' AND id < ? ORDER BY id DESC LIMIT ?", (before_id, limit)).fetchall()
+        rows.reverse()
+    else:
+        rows = db.execute("SELECT * FROM support_requests WHERE status = 'open' AND id > ? ORDER BY id ASC LIMIT ?", (after_id, limit)).fetchall()
+    return [dict(r) for r in rows]
 
 def get_request_by_id(req_id:int):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM support_requests WHERE id = ?", (req_id,))
-    r = cur.fetchone(); conn.close(); return dict(r) if r else None
+    r = db.execute("SELECT * FROM all_support_requests WHERE id = ?", (req_id,)).fetchone()
+    return dict(r) if r else None
 
 def close_request(req_id:int):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("UPDATE support_requests SET status = 'closed' WHERE id = ?", (req_id,))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("UPDATE support_requests SET status = 'closed' WHERE id = ? AND status = 'open'", (req_id,))
+        if cur.rowcount:
+            cur.execute("UPDATE support_stats SET open_count = open_count - 1, closed_count = closed_count + 1 WHERE id = 1")
 
 def add_support_message(req_id:int, from_chat:int, to_chat:int, text:str):
     now = datetime.utcnow().isoformat()
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("INSERT INTO support_messages (req_id, from_chat, to_chat, text, created_at) VALUES (?, ?, ?, ?, ?)", (req_id, from_chat, to_chat, text, now))
-    conn.commit(); conn.close()
+    with db.transaction() as cur:
+        cur.execute("INSERT INTO support_messages (req_id, from_chat, to_chat, text, created_at) VALUES (?, ?, ?, ?, ?)", (req_id, from_chat, to_chat, text, now))
+
+def get_operator_notifications() -> Dict[int, Optional[int]]:
+    """Все операторы с id их сообщения-уведомления одним запросом."""
+    rows = db.execute("""
+        SELECT o.chat_id, n.message_id FROM operators o
+        LEFT JOIN operator_notifications n ON n.operator_chat = o.chat_id
+        ORDER BY o.id""").fetchall()
+    return {r["chat_id"]: r["message_id"] for r in rows}
+
+def store_operator_notifications(items: Dict[int, Optional[int]]):
+    now = datetime.utcnow().isoformat()
+    with db.transaction() as cur:
+        cur.executemany("INSERT OR REPLACE INTO operator_notifications (operator_chat, message_id, created_at) VALUES (?, ?, ?)",
+                        [(op_chat, msg_id, now) for op_chat, msg_id in items.items()])
+
+# -------------------------
+# Cart aggregate
+# -------------------------
+class Cart:
+    """Открытая корзина в памяти: позиции и сумма. Читать через snapshot(), менять — только CartRepository."""
+    __slots__ = ("id", "chat_id", "status", "items", "total", "lock")
+
+    def __init__(self, cart_id: int, chat_id: int, status: str, items: List[Dict[str, Any]]):
+        self.id = cart_id
+        self.chat_id = chat_id
+        self.status = status
+        self.items = items
+        self.total = sum(float(it["price_usd"]) for it in items)
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> Tuple[List[Dict[str, Any]], float]:
+        with self.lock:
+            return list(self.items), self.total
+
+class CartRepository:
+    """
+    Кэш агрегатов Cart по cart_id (LRU на capacity). Запись идёт через обычные хелперы
+    (add_item_to_cart, remove_cart_item, clear_cart, settle_cart ...) — после коммита они
+    применяют то же изменение к закэшированному агрегату (write-through), так что оформление
+    заказа читает корзину из БД один раз. Поколение на cart_id не даёт положить в кэш
+    агрегат, прочитанный до параллельного изменения.
+    """
+
+    def __init__(self, capacity: int = CART_CACHE_SIZE):
+        self.capacity = capacity
+        self._carts: "OrderedDict[int, Cart]" = OrderedDict()
+        self._gen: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, cart_id: int) -> Optional[Cart]:
+        rows = db.execute("""
+            SELECT c.chat_id AS cart_chat, c.status AS cart_status, ci.*
+            FROM carts c LEFT JOIN cart_items ci ON ci.cart_id = c.id
+            WHERE c.id = ? ORDER BY ci.id""", (cart_id,)).fetchall()
+        if not rows:
+            return None
+        items = [{k: r[k] for k in r.keys() if k not in ("cart_chat", "cart_status")} for r in rows if r["id"] is not None]
+        return Cart(cart_id, rows[0]["cart_chat"], rows[0]["cart_status"], items)
+
+    def get(self, cart_id: int) -> Optional[Cart]:
+        with self._lock:
+            cart = self._carts.get(cart_id)
+            if cart is not None:
+                self._carts.move_to_end(cart_id)
+                return cart
+            gen = self._gen.get(cart_id, 0)
+        cart = self._load(cart_id)
+        if cart is None or cart.status != "open" or self.capacity <= 0:
+            return cart
+        with self._lock:
+            if self._gen.get(cart_id, 0) != gen:
+                return cart
+            cart = self._carts.setdefault(cart_id, cart)
+            while len(self._carts) > self.capacity:
+                evicted, _ = self._carts.popitem(last=False)
+                self._gen.pop(evicted, None)
+        return cart
+
+    def open_snapshot(self, cart_id: int) -> Tuple[List[Dict[str, Any]], float]:
+        """(позиции, сумма) корзины, только пока она открыта: оплаченную, отменённую или истёкшую не выставляем к оплате."""
+        cart = self.get(cart_id)
+        if cart is None:
+            return [], 0.0
+        with cart.lock:
+            return (list(cart.items), cart.total) if cart.status == "open" else ([], 0.0)
+
+    def _cached(self, cart_id: int) -> Optional[Cart]:
+        with self._lock:
+            self._gen[cart_id] = self._gen.get(cart_id, 0) + 1
+            return self._carts.get(cart_id)
+
+    def item_added(self, cart_id: int, item: Dict[str, Any]):
+        cart = self._cached(cart_id)
+        if cart is not None:
+            with cart.lock:
+                cart.items = cart.items + [item]
+                cart.total += float(item["price_usd"])
+
+    def item_removed(self, cart_id: int, item_id: int):
+        cart = self._cached(cart_id)
+        if cart is not None:
+            with cart.lock:
+                cart.items = [it for it in cart.items if it["id"] != item_id]
+                cart.total = sum(float(it["price_usd"]) for it in cart.items)
+
+    def closed(self, cart_id: int):
+        """Корзина оплачена или отменена — агрегат больше не нужен."""
+        with self._lock:
+            self._gen[cart_id] = self._gen.get(cart_id, 0) + 1
+            cart = self._carts.pop(cart_id, None)
+        if cart is not None:
+            with cart.lock:
+                cart.status = "closed"
+
+cart_repo = CartRepository()
 
 # -------------------------
 # CryptoBot helpers (part 1)
 # -------------------------
+class CryptoPayError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None, body: Any = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"error": True, "message": str(self), "status_code": self.status_code, "body": self.body}
+
+class CircuitOpenError(CryptoPayError):
+    """API признан недоступным — не ждём таймаутов, сразу отказываем."""
+
+class CircuitBreaker:
+    """
+    closed -> open после failure_threshold ошибок подряд;
+    через reset_timeout — half-open: пропускается одна пробная попытка,
+    её успех закрывает цепь, ошибка снова открывает.
+    """
+
+    def __init__(self, failure_threshold: int = CRYPTO_API_BREAKER_THRESHOLD, reset_timeout: float = CRYPTO_API_BREAKER_RESET_SEC):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+def normalize_invoice(raw: Any) -> Dict[str, Any]:
+    """Единый вид инвойса CryptoPay вне зависимости от версии API; ответ без invoice_id — CryptoPayError."""
+    if not isinstance(raw, dict) or raw.get("invoice_id") in (None, ""):
+        raise CryptoPayError(f"malformed invoice: {str(raw)[:200]}", body=raw)
+    return {
+        "invoice_id": str(raw["invoice_id"]),
+        "status": raw.get("status"),
+        "asset": raw.get("asset"),
+        "amount": raw.get("amount"),
+        "payload": raw.get("payload"),
+        "pay_url": raw.get("bot_invoice_url") or raw.get("pay_url") or raw.get("mini_app_invoice_url") or raw.get("web_app_invoice_url"),
+        "raw": raw,
+    }
+
+def _request_not_sent(e: requests.RequestException) -> bool:
+    """Соединение не установлено (DNS, отказ, таймаут подключения) — сервер запрос точно не получил."""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+class CryptoPayClient:
+    """
+    Клиент Crypto Pay API поверх общего requests.Session (keep-alive, пул соединений).
+    - повторы на сетевых ошибках, 429 и 5xx с экспоненциальной задержкой и jitter
+    - circuit breaker: при лежащем API отказ без ожидания таймаутов
+    - задержка каждого вызова пишется в метрики cryptopay.<method>
+    base_url подменяется на локальный фейковый сервер в тестах.
+    """
+
+    def __init__(self, token: str, base_url: str = CRYPTO_API_BASE, timeout: Tuple[float, float] = (3.05, 10.0),
+                 max_retries: int = CRYPTO_API_MAX_RETRIES, backoff_base: float = 0.25, backoff_max: float = 4.0,
+                 breaker: Optional[CircuitBreaker] = None, pool_size: int = 16):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        self.session.headers.update({"Crypto-Pay-API-Token": token})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, method: str, params: Optional[Dict[str, Any]] = None, idempotent: bool = True) -> Any:
+        """
+        Возвращает поле result ответа или бросает CryptoPayError.
+        Неидемпотентные методы (createInvoice) повторяются только если запрос точно не обработан:
+        соединение не установлено или ответ 429. Таймаут чтения, обрыв соединения и 5xx не повторяем —
+        запрос мог дойти, и повтор создал бы второй счёт.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{method}: CryptoPay API circuit is open")
+        stats = latency_stats(f"cryptopay.{method}")
+        last_error: Optional[CryptoPayError] = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            started = time.perf_counter()
+            try:
+                r = self.session.post(f"{self.base_url}/{method}", json=params or {}, timeout=self.timeout)
+            except requests.RequestException as e:
+                stats.observe((time.perf_counter() - started) * 1000, error=True)
+                last_error = CryptoPayError(f"{method}: {e}")
+                if not idempotent and not _request_not_sent(e):
+                    self.breaker.record_failure()
+                    raise last_error
+            else:
+                elapsed = (time.perf_counter() - started) * 1000
+                if r.status_code == 429 or r.status_code >= 500:
+                    stats.observe(elapsed, error=True)
+                    last_error = CryptoPayError(f"{method}: HTTP {r.status_code}", r.status_code, r.text[:500])
+                    try:
+                        retry_after = float(r.headers.get("Retry-After"))
+                    except (TypeError, ValueError):
+                        retry_after = None
+                    if not idempotent and r.status_code != 429:
+                        self.breaker.record_failure()
+                        raise last_error
+                else:
+                    try:
+                        j = r.json()
+                    except ValueError:
+                        j = None
+                    # API ответил — с точки зрения breaker'а он жив, даже если запрос отклонён
+                    self.breaker.record_success()
+                    if not isinstance(j, dict) or not j.get("ok"):
+                        stats.observe(elapsed, error=True)
+                        err = j.get("error") if isinstance(j, dict) else None
+                        raise CryptoPayError(f"{method}: {err or 'bad response'}", r.status_code, j if j is not None else r.text[:500])
+                    stats.observe(elapsed)
+                    return j.get("result")
+            self.breaker.record_failure()
+            if attempt >= self.max_retries or self.breaker.state == "open":
+                break
+            time.sleep(self._backoff(attempt, retry_after))
+        raise last_error
+
+    def create_invoice(self, amount: float, asset: str, payload: str, description: str, callback_url: Optional[str] = None) -> Dict[str, Any]:
+        # без expires_in счёт остаётся оплачиваемым бессрочно, а сверка опрашивает его только до финального статуса
+        params = {"amount": str(amount), "asset": asset, "payload": str(payload), "description": description,
+                  "expires_in": int(INVOICE_TTL_HOURS * 3600)}
+        if callback_url:
+            params["callback"] = callback_url
+        return normalize_invoice(self.call("createInvoice", params, idempotent=False))
+
+    def get_invoices(self, invoice_ids: List[str]) -> List[Dict[str, Any]]:
+        # count по умолчанию 100 — без него длинный список обрезался бы
+        result = self.call("getInvoices", {"invoice_ids": ",".join(str(i) for i in invoice_ids), "count": max(1, len(invoice_ids))})
+        items = result.get("items", []) if isinstance(result, dict) else (result or [])
+        return [normalize_invoice(it) for it in items]
+
+    def get_invoice(self, invoice_id: str) -> Optional[Dict[str, Any]]:
+        items = self.get_invoices([invoice_id])
+        return items[0] if items else None
+
+cryptopay = CryptoPayClient(CRYPTOPAY_API_TOKEN)
+
 def create_cryptobot_invoice(amount_value: float, asset: str, payload: str, description: str, callback_url: Optional[str] = None) -> dict:
     """
     Создаёт инвойс через CryptoBot API.
-    Возвращает dict (успех — JSON ответа API, иначе {"error": True, ...})
+    Возвращает dict (успех — normalize_invoice(): invoice_id, pay_url, status, ..., иначе {"error": True, ...})
     """
-    url = CRYPTO_API_BASE + "/createInvoice"
-    headers = {"Crypto-Pay-API-Token": CRYPTOPAY_API_TOKEN, "Content-Type": "application/json"}
-    body = {"amount": str(amount_value), "asset": asset, "payload": str(payload), "description": description}
-    if callback_url:
-        body["callback"] = callback_url
     try:
-        r = requests.post(url, json=body, headers=headers, timeout=20)
-        try:
-            j = r.json()
-        except Exception:
-            return {"error": True, "status_code": r.status_code, "body": r.text}
-        if r.status_code not in (200, 201):
-            return {"error": True, "status_code": r.status_code, "body": j}
-        return j
-    except Exception as e:
-        return {"error": True, "exception": str(e)}
+        return cryptopay.create_invoice(amount_value, asset, payload, description, callback_url=callback_url)
+    except CryptoPayError as e:
+        return e.as_dict()
 
 def get_invoice_info(invoice_id: str) -> dict:
-    url = CRYPTO_API_BASE + "/getInvoice"
-    headers = {"Crypto-Pay-API-Token": CRYPTOPAY_API_TOKEN}
     try:
-        r = requests.get(url, headers=headers, params={"invoiceId": invoice_id}, timeout=15)
-        return r.json()
-    except Exception as e:
-        return {"error": True, "exception": str(e)}
+        return cryptopay.get_invoice(invoice_id) or {"error": True, "message": "invoice not found"}
+    except CryptoPayError as e:
+        return e.as_dict()
 
 # -------------------------
 # QR helper
 # -------------------------
+def _render_qr_png(url: str, box_size: int = 8, border: int = 2) -> bytes:
+    """
+    Минимальная версия QR (fit=True) с коррекцией L — ссылки короткие и показываются на экране,
+    1-битный PNG — в несколько раз меньше RGB-картинки qrcode.make() по умолчанию.
+    Функция уровня модуля, чтобы её можно было отдать в ProcessPoolExecutor.
+    """
+    qr = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=box_size, border=border)
+    qr.add_data(url)
+    qr.make(fit=True)
+    img = qr.make_image().get_image()
+    if img.mode != "1":
+        img = img.convert("1")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+class QRRenderer:
+    """
+    LRU-кэш PNG по pay_url + рендер inline / в пуле потоков / в пуле процессов.
+    Пул ограничивает, сколько ядер одновременно занимает PIL в пике продаж.
+    """
+
+    def __init__(self, mode: str = QR_RENDER_MODE, workers: int = QR_RENDER_WORKERS, cache_size: int = QR_CACHE_SIZE):
+        self.mode = mode
+        self.workers = workers
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.mode == "process":
+                        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    else:
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr")
+        return self._executor
+
+    def _remember(self, url: str, png: bytes):
+        with self._lock:
+            self._cache[url] = png
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def render_async(self, url: str) -> Future:
+        with self._lock:
+            png = self._cache.get(url)
+            if png is not None:
+                self._cache.move_to_end(url)
+        if png is not None:
+            fut: Future = Future()
+            fut.set_result(png)
+            return fut
+        if self.mode == "inline":
+            fut = Future()
+            try:
+                fut.set_result(_render_qr_png(url))
+            except Exception as e:
+                fut.set_exception(e)
+        else:
+            fut = self._get_executor().submit(_render_qr_png, url)
+        fut.add_done_callback(lambda f: f.exception() is None and self._remember(url, f.result()))
+        return fut
+
+    def render(self, url: str) -> bytes:
+        return self.render_async(url).result()
+
+qr_renderer = QRRenderer()
+
 def generate_qr_bytes(url: str) -> bytes:
-    img = qrcode.make(url)
-    buf = io.BytesIO(); img.save(buf, format="PNG"); buf.seek(0)
-    return buf.read()
+    return qr_renderer.render(url)
+
+# -------------------------
+# Background services
+# -------------------------
+# Фоновые потоки не стартуют при импорте: start() каждого сервиса идемпотентен
+# и вызывается из start_background_services() (или лениво при первом использовании).
+_background_services: List[Any] = []
+
+def register_background_service(service):
+    _background_services.append(service)
+    return service
+
+def start_background_services():
+    for service in _background_services:
+        service.start()
+
+def stop_background_services():
+    for service in _background_services:
+        stop = getattr(service, "stop", None)
+        if stop is not None:
+            stop()
+
+# -------------------------
+# Known users (write-behind)
+# -------------------------
+class KnownUsers:
+    """
+    chat_id -> (username, first_name, last_name) последних capacity пользователей, прогревается из users.
+    touch() с неизменным профилем не трогает БД; новые пользователи и смена имени копятся в pending
+    (последний профиль на chat_id) и пишутся пачкой upsert_users() раз в flush_interval.
+    """
+
+    def __init__(self, capacity: int = KNOWN_USERS_CACHE_SIZE, flush_interval: float = USER_FLUSH_SEC):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._profiles: "OrderedDict[int, Tuple[Optional[str], Optional[str], Optional[str]]]" = OrderedDict()
+        self._pending: Dict[int, Tuple[Optional[str], Optional[str], Optional[str], str]] = {}
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[Thread] = None
+        self._warmed = False
+        register_gauge("users.pending_writes", lambda: len(self._pending))
+
+    def warm(self):
+        rows = db.execute("SELECT chat_id, username, first_name, last_name FROM users ORDER BY created_at DESC LIMIT ?",
+                          (self.capacity,)).fetchall()
+        with self._lock:
+            for r in reversed(rows):
+                self._profiles.setdefault(r["chat_id"], (r["username"], r["first_name"], r["last_name"]))
+            self._warmed = True
+
+    def touch(self, chat_id: int, profile: Tuple[Optional[str], Optional[str], Optional[str]]):
+        if not self._warmed:
+            self.start()
+        with self._lock:
+            if self._profiles.get(chat_id) == profile:
+                self._profiles.move_to_end(chat_id)
+                return
+            self._profiles[chat_id] = profile
+            self._profiles.move_to_end(chat_id)
+            while len(self._profiles) > self.capacity:
+                self._profiles.popitem(last=False)
+            self._pending[chat_id] = profile + (datetime.utcnow().isoformat(),)
+
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            upsert_users([(chat_id,) + row for chat_id, row in pending.items()])
+        except Exception:
+            traceback.print_exc()
+            # вернём несохранённое, не затирая более свежие профили
+            with self._lock:
+                for chat_id, row in pending.items():
+                    self._pending.setdefault(chat_id, row)
+            return 0
+        return len(pending)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if not self._warmed:
+                self.warm()
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name="users-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+known_users = register_background_service(KnownUsers())
+atexit.register(known_users.stop)
+
+# -------------------------
+# Rollup backfill
+# -------------------------
+class RollupBackfill:
+    """
+    Досчёт rollup_daily по существующим заказам: по одному дню за короткую транзакцию
+    (курсор в app_meta двигается в ней же), с паузой между днями — писатели не блокируются надолго.
+    Несколько процессов делят работу: шаг перечитывает курсор под write-lock.
+    """
+
+    def __init__(self, pause: float = 0.05):
+        self.pause = pause
+        self._start_lock = threading.Lock()
+        self._thread: Optional[Thread] = None
+        self._stop = threading.Event()
+
+    def step(self) -> bool:
+        """Пересчитать следующий день; False — досчитывать нечего."""
+        with db.transaction() as cur:
+            cur.execute("SELECT value FROM app_meta WHERE key = 'rollup_backfill'")
+            r = cur.fetchone()
+            if r is None:
+                return False
+            day = next_order_day(r["value"] or "")
+            if day is None:
+                cur.execute("DELETE FROM app_meta WHERE key = 'rollup_backfill'")
+                print("Rollup backfill complete")
+                return False
+            rebuild_rollup_day(day)
+            cur.execute("UPDATE app_meta SET value = ? WHERE key = 'rollup_backfill'", (day,))
+        return True
+
+    def request(self):
+        """Пересчитать все дни заново (/stats rebuild)."""
+        with db.transaction() as cur:
+            cur.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('rollup_backfill', '')")
+        self.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set() and self.step():
+                self._stop.wait(self.pause)
+        except Exception:
+            traceback.print_exc()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name="rollup-backfill", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+rollup_backfill = register_background_service(RollupBackfill())
+
+# -------------------------
+# Outbound Telegram scheduler
+# -------------------------
+# Чем меньше номер полосы, тем раньше уходит сообщение при нехватке лимита.
+TG_LANES = ("payment", "interactive", "notify", "broadcast")
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """0 — токен есть; иначе через сколько секунд появится (или закончится пауза после 429)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    """retry_after из ответа 429 Telegram (ApiTelegramException), иначе None."""
+    if getattr(exc, "error_code", None) != 429:
+        return None
+    params = (getattr(exc, "result_json", None) or {}).get("parameters") or {}
+    return float(params.get("retry_after") or 1)
+
+class _OutboundJob:
+    __slots__ = ("lane", "seq", "chat_id", "method", "args", "kwargs", "future", "enqueued", "attempts")
+
+    def __init__(self, lane: int, seq: int, chat_id: int, method: str, args: tuple, kwargs: dict):
+        self.lane = lane
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future: Future = Future()
+        self.enqueued = time.perf_counter()
+        self.attempts = 0
+
+    def key(self) -> Tuple[int, int]:
+        return (self.lane, self.seq)
+
+class TelegramOutbox:
+    """
+    Планировщик исходящих вызовов bot.<method>(chat_id, ...):
+    - общий token bucket на бота и свой на каждый чат (группы — медленнее);
+    - в чате одновременно выполняется не больше одного вызова, очередь чата упорядочена по (полоса, seq);
+    - готовые к отправке чаты выбираются по полосе их головного сообщения: payment раньше notify/broadcast;
+    - 429 — вызов возвращается в очередь чата, чат ставится на паузу retry_after;
+    - метрики: tg.wait.<lane> (время в очереди) и tg.call.<method>.
+    В prefork работает только в бот-процессе — лимиты общие на весь бот.
+    """
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE,
+                 workers: int = TG_SEND_WORKERS, max_retries: int = TG_SEND_MAX_RETRIES):
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(1.0, global_rate / 10))  # маленький burst: лимит Telegram скользящий
+        self._chats: Dict[int, List[Tuple[int, int, _OutboundJob]]] = {}   # chat -> heap очереди
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._inflight: set = set()
+        self._ready: List[Tuple[int, int, int]] = []    # (lane, seq, chat) — лениво проверяется при выборе
+        self._timers: List[Tuple[float, int]] = []      # (когда, chat)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[Thread] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._stop = False
+        self._wait_stats = {lane: latency_stats(f"tg.wait.{lane}") for lane in TG_LANES}
+        register_gauge("tg.outbox.depth", lambda: sum(len(q) for q in list(self._chats.values())))
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self._buckets.get(chat_id)
+        if b is None:
+            b = self._buckets[chat_id] = TokenBucket(TG_GROUP_RATE if chat_id < 0 else TG_CHAT_RATE, TG_CHAT_BURST)
+        return b
+
+    def submit(self, lane: str, chat_id: int, method: str, *args, **kwargs) -> Future:
+        """chat_id — ключ лимитов и очереди; args/kwargs передаются в bot.<method> как есть."""
+        return self._enqueue(lane, chat_id, method, args, kwargs).future
+
+    def _enqueue(self, lane: str, chat_id: int, method: str, args: tuple, kwargs: dict) -> _OutboundJob:
+        self.start()
+        job = _OutboundJob(TG_LANES.index(lane), next(self._seq), chat_id, method, args, kwargs)
+        with self._cond:
+            heapq.heappush(self._chats.setdefault(chat_id, []), (job.lane, job.seq, job))
+            if chat_id not in self._inflight:
+                heapq.heappush(self._ready, (job.lane, job.seq, chat_id))
+            self._cond.notify()
+        return job
+
+    def call(self, lane: str, chat_id: int, method: str, *args, **kwargs):
+        """
+        Синхронный вариант: ждёт отправки и возвращает результат (или пробрасывает исключение Telegram).
+        За TG_SEND_TIMEOUT_SEC не ушёл — снимается с очереди и TimeoutError означает «не отправлено»
+        (запасной вариант вызывающего не продублирует сообщение); уже выполняющийся дожидаемся ещё столько же.
+        """
+        job = self._enqueue(lane, chat_id, method, args, kwargs)
+        try:
+            return job.future.result(timeout=TG_SEND_TIMEOUT_SEC)
+        except FutureTimeoutError:
+            if self.cancel(job):
+                raise
+        return job.future.result(timeout=TG_SEND_TIMEOUT_SEC)
+
+    def cancel(self, job: _OutboundJob) -> bool:
+        """Убирает ещё не начатый вызов из очереди чата; False — он уже выполняется или выполнен."""
+        with self._cond:
+            q = self._chats.get(job.chat_id)
+            if not q or not any(e[2] is job for e in q):
+                return False
+            q[:] = [e for e in q if e[2] is not job]
+            heapq.heapify(q)
+            if not q:
+                del self._chats[job.chat_id]
+            elif job.chat_id not in self._inflight:
+                # запись в _ready указывала на снятый вызов — ставим чат заново по новой голове очереди
+                heapq.heappush(self._ready, (q[0][0], q[0][1], job.chat_id))
+                self._cond.notify()
+        job.future.cancel()
+        return True
+
+    def _next_job(self) -> Tuple[Optional[_OutboundJob], Optional[float]]:
+        """Под self._cond: следующий вызов к отправке или сколько ждать."""
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, chat_id = heapq.heappop(self._timers)
+            q = self._chats.get(chat_id)
+            if q and chat_id not in self._inflight:
+                heapq.heappush(self._ready, (q[0][0], q[0][1], chat_id))
+        while self._ready:
+            g_wait = self._global.wait_time(now)
+            if g_wait > 0:
+                return None, g_wait
+            lane, seq, chat_id = heapq.heappop(self._ready)
+            q = self._chats.get(chat_id)
+            if not q or chat_id in self._inflight or (q[0][0], q[0][1]) != (lane, seq):
+                continue  # устаревшая запись
+            bucket = self._bucket(chat_id)
+            c_wait = bucket.wait_time(now)
+            if c_wait > 0:
+                heapq.heappush(self._timers, (now + c_wait, chat_id))
+                continue
+            bucket.take()
+            self._global.take()
+            job = heapq.heappop(q)[2]
+            if not q:
+                del self._chats[chat_id]
+            self._inflight.add(chat_id)
+            return job, None
+        return None, (self._timers[0][0] - now) if self._timers else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stop:
+                        return
+                    job, wait = self._next_job()
+                    if job is not None:
+                        break
+                    self._cond.wait(wait)
+            self._wait_stats[TG_LANES[job.lane]].observe((time.perf_counter() - job.enqueued) * 1000)
+            self._pool.submit(self._execute, job)
+
+    def _execute(self, job: _OutboundJob):
+        started = time.perf_counter()
+        job.attempts += 1
+        result, error = None, None
+        try:
+            if job.attempts > 1:
+                # повтор после 429: файл (выгрузка заказов) дочитан прошлой попыткой
+                for arg in itertools.chain(job.args, job.kwargs.values()):
+                    if hasattr(arg, "seek"):
+                        arg.seek(0)
+            result = getattr(bot, job.method)(*job.args, **job.kwargs)
+        except Exception as e:
+            error = e
+        latency_stats(f"tg.call.{job.method}").observe((time.perf_counter() - started) * 1000, error=error is not None)
+        retry_after = _retry_after(error) if error is not None else None
+        with self._cond:
+            self._inflight.discard(job.chat_id)
+            if retry_after is not None and job.attempts <= self.max_retries:
+                self._bucket(job.chat_id).blocked_until = time.monotonic() + retry_after
+                heapq.heappush(self._chats.setdefault(job.chat_id, []), (job.lane, job.seq, job))
+                heapq.heappush(self._timers, (time.monotonic() + retry_after, job.chat_id))
+                self._cond.notify()
+                return
+            q = self._chats.get(job.chat_id)
+            if q:
+                heapq.heappush(self._ready, (q[0][0], q[0][1], job.chat_id))
+            elif job.chat_id in self._buckets and len(self._buckets) > 10000:
+                del self._buckets[job.chat_id]
+            self._cond.notify()
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tg-send")
+            self._stop = False
+            self._thread = Thread(target=self._run, name="tg-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+def _target_chat(method: str, args: tuple, kwargs: dict) -> int:
+    if "chat_id" in kwargs:
+        return kwargs["chat_id"]
+    if method == "reply_to":
+        return args[0].chat.id
+    # edit_message_text(text, chat_id, message_id, ...) — чат вторым аргументом
+    return args[1] if method == "edit_message_text" else args[0]
+
+class OutboxLane:
+    """tg.send_message(chat_id, ...) — как bot.send_message, но через очередь с лимитами выбранной полосы."""
+
+    def __init__(self, outbox: TelegramOutbox, lane: str):
+        self._outbox = outbox
+        self._lane = lane
+
+    def __getattr__(self, method: str):
+        def call(*args, **kwargs):
+            return self._outbox.call(self._lane, _target_chat(method, args, kwargs), method, *args, **kwargs)
+        return call
+
+    def post(self, method: str, *args, **kwargs) -> Future:
+        """Без ожидания: ошибка после всех повторов попадёт в лог."""
+        fut = self._outbox.submit(self._lane, _target_chat(method, args, kwargs), method, *args, **kwargs)
+        fut.add_done_callback(_log_outbox_failure)
+        return fut
+
+def _log_outbox_failure(fut: Future):
+    exc = fut.exception()
+    if exc is not None:
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+outbox = register_background_service(TelegramOutbox())
+tg = OutboxLane(outbox, "interactive")
+tg_payment = OutboxLane(outbox, "payment")
+tg_notify = OutboxLane(outbox, "notify")
+tg_broadcast = OutboxLane(outbox, "broadcast")
 
 # -------------------------
 # Price conversion helpers
 # -------------------------
+class RateUnavailableError(Exception):
+    """Курс неизвестен или устарел сильнее RATE_MAX_STALE_SEC — принимать оплату в этой валюте нельзя."""
+
+def coingecko_rate_source() -> Dict[str, float]:
+    """Все поддерживаемые курсы одним запросом simple/price: {asset: usd}."""
+    r = requests.get(COINGECKO_API_BASE + "/simple/price",
+                     params={"ids": ",".join(RATE_ASSET_IDS.values()), "vs_currencies": "usd"}, timeout=8)
+    r.raise_for_status()
+    j = r.json()
+    return {asset: float(j[cg_id]["usd"]) for asset, cg_id in RATE_ASSET_IDS.items() if cg_id in j}
+
+class RateCache:
+    """
+    Кэш курсов с фоновым обновлением (stale-while-revalidate):
+    - моложе ttl — отдаём из кэша;
+    - старше ttl, но моложе max_stale — отдаём из кэша и обновляем в фоне;
+    - старше max_stale (или курса нет вовсе) — RateUnavailableError.
+    source — любая функция () -> {asset: usd}, в тестах подставляется локальная заглушка.
+    """
+
+    def __init__(self, source: Callable[[], Dict[str, float]], ttl: float = RATE_TTL_SEC, max_stale: float = RATE_MAX_STALE_SEC):
+        self.source = source
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._rates: Dict[str, Tuple[float, float]] = {}  # asset -> (usd, fetched_at monotonic)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[Thread] = None
+
+    def refresh(self) -> bool:
+        # один запрос к источнику за раз; параллельные вызовы просто дожидаются его результата
+        with self._refresh_lock:
+            try:
+                rates = self.source()
+            except Exception:
+                traceback.print_exc()
+                return False
+            now = time.monotonic()
+            with self._lock:
+                for asset, usd in rates.items():
+                    if usd > 0:
+                        self._rates[asset.upper()] = (float(usd), now)
+            return True
+
+    def _refresh_async(self):
+        if not self._refresh_lock.locked():
+            Thread(target=self.refresh, daemon=True).start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.ttl)
+
+    def start(self):
+        # get_usd_rate зовёт start() из всех потоков обработчиков — без блокировки стартовало бы несколько обновлений
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name="rate-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get_usd_rate(self, asset: str) -> float:
+        asset = asset.upper()
+        self.start()
+        with self._lock:
+            entry = self._rates.get(asset)
+        if entry is None:
+            # холодный старт: фоновый поток ещё не успел — пробуем синхронно
+            self.refresh()
+            with self._lock:
+                entry = self._rates.get(asset)
+            if entry is None:
+                raise RateUnavailableError(f"no {asset}/USD rate")
+        usd, fetched_at = entry
+        age = time.monotonic() - fetched_at
+        if age > self.max_stale:
+            self._refresh_async()
+            raise RateUnavailableError(f"{asset}/USD rate is {int(age)}s old")
+        if age > self.ttl:
+            self._refresh_async()
+        return usd
+
+rate_cache = register_background_service(RateCache(coingecko_rate_source))
+
 def convert_price_usd_to_asset(price_usd: float, asset: str) -> float:
     asset = asset.upper()
     # USDT ~ 1 USD
     if asset == "USDT":
         return round(price_usd, 6)
-    try:
-        if asset == "TON":
-            r = requests.get("https://api.coingecko.com/api/v3/simple/price", params={"ids": "toncoin", "vs_currencies": "usd"}, timeout=8)
-            j = r.json()
-            ton_usd = float(j["toncoin"]["usd"])
-            return round(price_usd / ton_usd, 6)
-        if asset == "TRX":
-            r = requests.get("https://api.coingecko.com/api/v3/simple/price", params={"ids": "tron", "vs_currencies": "usd"}, timeout=8)
-            j = r.json()
-            trx_usd = float(j["tron"]["usd"])
-            return round(price_usd / trx_usd, 6)
-        return round(price_usd, 6)
-    except Exception:
-        return round(price_usd, 6)
+    if asset not in RATE_ASSET_IDS:
+        raise RateUnavailableError(f"no rate source for {asset}")
+    return round(price_usd / rate_cache.get_usd_rate(asset), 6)
 
 # -------------------------
 # UI helpers (markup builders)
 # -------------------------
-def main_menu_markup() -> types.InlineKeyboardMarkup:
+def build_main_menu_markup() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(types.InlineKeyboardButton("🛒 Магазин", callback_data="menu_shop"))
     kb.add(types.InlineKeyboardButton("🧾 Корзина / Профиль", callback_data="profile"))
@@ -444,14 +2094,14 @@ def main_menu_markup() -> types.InlineKeyboardMarkup:
     kb.add(types.InlineKeyboardButton("📞 Поддержка (лично)", callback_data="support_personal"))
     return kb
 
-def shop_socials_markup() -> types.InlineKeyboardMarkup:
+def build_shop_socials_markup() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
     for s in PRETTY_SOCIALS:
         kb.add(types.InlineKeyboardButton(s, callback_data=f"shop_social::{s}"))
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="back_main"))
     return kb
 
-def services_markup_for_social(social: str) -> types.InlineKeyboardMarkup:
+def build_services_markup(social: str) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=1)
     services = SERVICES.get(social, {})
     for key, info in services.items():
@@ -466,6 +2116,47 @@ def services_markup_for_social(social: str) -> types.InlineKeyboardMarkup:
     kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="shop_socials"))
     return kb
 
+class PrebuiltMarkup(types.JsonSerializable):
+    """Клавиатура, сериализованная один раз: telebot отправляет готовую строку из to_json()."""
+    __slots__ = ("markup", "json")
+
+    def __init__(self, markup: types.InlineKeyboardMarkup):
+        self.markup = markup
+        self.json = markup.to_json()
+
+    def to_json(self) -> str:
+        return self.json
+
+class CatalogViews:
+    """
+    Статичные клавиатуры меню и каталога, собранные из SERVICES один раз.
+    После изменения SERVICES / PRETTY_SOCIALS вызвать rebuild().
+    """
+
+    def __init__(self):
+        self.main_menu: Optional[PrebuiltMarkup] = None
+        self.shop_socials: Optional[PrebuiltMarkup] = None
+        self.services: Dict[str, PrebuiltMarkup] = {}
+        self.rebuild()
+
+    def rebuild(self):
+        services = {social: PrebuiltMarkup(build_services_markup(social)) for social in SERVICES}
+        # каждое поле подменяется целиком — обработчики в других потоках видят старую или новую версию
+        self.main_menu = PrebuiltMarkup(build_main_menu_markup())
+        self.shop_socials = PrebuiltMarkup(build_shop_socials_markup())
+        self.services = services
+
+catalog_views = CatalogViews()
+
+def main_menu_markup() -> PrebuiltMarkup:
+    return catalog_views.main_menu
+
+def shop_socials_markup() -> PrebuiltMarkup:
+    return catalog_views.shop_socials
+
+def services_markup_for_social(social: str) -> PrebuiltMarkup:
+    return catalog_views.services.get(social) or PrebuiltMarkup(build_services_markup(social))
+
 def currency_selection_markup_for_cart(chat_id: int, cart_id: int) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=3)
     for asset in AVAILABLE_ASSETS:
@@ -482,10 +2173,284 @@ def currency_selection_markup_for_order(chat_id: int, order_ref: str) -> types.I
     return kb
 
 # -------------------------
-# In-memory short states
+# Profile read model
+# -------------------------
+class ProfileViews:
+    """
+    Отрисованный профиль (текст + клавиатура) на chat_id. Повторное открытие профиля — без запросов к БД.
+    Сбрасывается хелперами изменения корзины/заказов после коммита (_profile_changed) и по TTL.
+    Поколение на чат защищает от гонки: рендер, начатый до изменения, в кэш не попадёт.
+    """
+
+    def __init__(self, ttl: float = PROFILE_CACHE_TTL_SEC, capacity: int = PROFILE_CACHE_SIZE):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._views: "OrderedDict[int, Tuple[float, str, PrebuiltMarkup]]" = OrderedDict()
+        self._gen: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            self._views.pop(chat_id, None)
+            self._gen[chat_id] = self._gen.get(chat_id, 0) + 1
+
+    def get(self, chat_id: int) -> Tuple[str, PrebuiltMarkup]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._views.get(chat_id)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._views.move_to_end(chat_id)
+                return entry[1], entry[2]
+            gen = self._gen.get(chat_id, 0)
+        text, markup = render_profile(*get_profile_rows(chat_id))
+        if self.ttl > 0:
+            with self._lock:
+                if self._gen.get(chat_id, 0) == gen:
+                    self._views[chat_id] = (now, text, markup)
+                    self._views.move_to_end(chat_id)
+                    while len(self._views) > self.capacity:
+                        evicted, _ = self._views.popitem(last=False)
+                        self._gen.pop(evicted, None)
+        return text, markup
+
+def render_profile(items: List[Dict[str, Any]], orders: List[Dict[str, Any]]) -> Tuple[str, PrebuiltMarkup]:
+    txt_lines = []
+    total = 0.0
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    txt_lines.append("🧾 Ваша корзина:\n")
+    if items:
+        for it in items:
+            title = SERVICES[it['social']][it['service_key']]['title']
+            txt_lines.append(f"#{it['id']} | {it['social']} — {title} x{it['amount']} — ${float(it['price_usd']):.2f}\nLink: {it['link']}\n")
+            kb.add(types.InlineKeyboardButton(f"Удалить #{it['id']}", callback_data=f"cart_remove::{it['id']}"))
+            total += float(it['price_usd'])
+        cart_id = items[0]['cart_id']
+        txt_lines.append(f"\nИтого: ${total:.2f}\n")
+        kb.add(types.InlineKeyboardButton("Оплатить корзину", callback_data=f"cart_pay::{cart_id}"))
+        kb.add(types.InlineKeyboardButton("Очистить корзину", callback_data=f"cart_clear::{cart_id}"))
+    else:
+        txt_lines.append("Корзина пуста.\n")
+    # user orders (recent)
+    if orders:
+        txt_lines.append("\n📋 Последние заказы:\n")
+        for r in orders:
+            title = SERVICES[r['social']][r['service_key']]['title']
+            txt_lines.append(f"#{r['id']} | {r['social']} {title} x{r['amount']} — ${r['price_usd']:.2f} — {r['status']}\n")
+    return "\n".join(txt_lines), PrebuiltMarkup(kb)
+
+profile_views = ProfileViews()
+
+# -------------------------
+# Callback router
+# -------------------------
+class CallbackRouter:
+    """
+    Диспетчер callback_data вместо цепочки if/startswith:
+    - точный ключ ("profile") или префикс до первого '::' ("cart_remove::<id>") — поиск в dict за O(1);
+    - аргументы после префикса разбираются один раз конвертерами маршрута (int, parse_asset, ...),
+      ошибка разбора -> answer_callback_query(error);
+    - на каждый маршрут — счётчик вызовов и гистограмма задержек (метрики callback.<route>).
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, Callable] = {}
+        self._prefix: Dict[str, Tuple[Callable, Tuple[Callable[[str], Any], ...], str]] = {}
+
+    def exact(self, key: str):
+        def deco(fn):
+            self._exact[key] = fn
+            return fn
+        return deco
+
+    def prefix(self, prefix: str, *converters: Callable[[str], Any], error: str = "Неверные данные"):
+        """Последний аргумент забирает остаток строки целиком (в нём может встретиться '::')."""
+        def deco(fn):
+            self._prefix[prefix] = (fn, converters, error)
+            return fn
+        return deco
+
+    def dispatch(self, call: telebot.types.CallbackQuery) -> bool:
+        """False — маршрут не найден."""
+        data = call.data or ""
+        fn = self._exact.get(data)
+        if fn is not None:
+            route, args = data, ()
+        else:
+            head, sep, tail = data.partition("::")
+            entry = self._prefix.get(head) if sep else None
+            if entry is None:
+                return False
+            fn, converters, error = entry
+            route = head + "::"
+            raw = tail.split("::", len(converters) - 1) if converters else []
+            try:
+                if len(raw) != len(converters):
+                    raise ValueError(data)
+                args = tuple(conv(value) for conv, value in zip(converters, raw))
+            except (ValueError, KeyError):
+                bot.answer_callback_query(call.id, error)
+                return True
+        stats = latency_stats(f"callback.{route}")
+        started = time.perf_counter()
+        failed = True
+        try:
+            fn(call, *args)
+            failed = False
+        finally:
+            stats.observe((time.perf_counter() - started) * 1000, error=failed)
+        return True
+
+def parse_asset(value: str) -> str:
+    asset = value.upper()
+    if asset not in AVAILABLE_ASSETS:
+        raise ValueError(value)
+    return asset
+
+def parse_social(value: str) -> str:
+    if value not in SERVICES:
+        raise ValueError(value)
+    return value
+
+def parse_order_ref(value: str) -> Tuple[int, int]:
+    """order_<chatid>_<orderid> -> (chat_id, order_id)."""
+    ref_parts = value.split("_")
+    if len(ref_parts) < 3:
+        raise ValueError(value)
+    # last two parts are chatid and orderid
+    return int(ref_parts[-2]), int(ref_parts[-1])
+
+def parse_page(value: str) -> int:
+    return int(value) if value.isdigit() else 1
+
+def parse_page_cursor(value: str) -> Tuple[int, Optional[str], int]:
+    """'<page>' или '<page>:<'>'|'<'><id>' -> (page, направление, id курсора)."""
+    page, _, cursor = value.partition(":")
+    page_no = parse_page(page)
+    if not cursor:
+        return page_no, None, 0
+    if cursor[0] not in "<>":
+        raise ValueError(value)
+    return page_no, cursor[0], int(cursor[1:])
+
+callbacks = CallbackRouter()
+
+# -------------------------
+# Conversation state stores
 # -------------------------
-user_state: Dict[int, Dict[str, Any]] = {}
-operator_state: Dict[int, Dict[str, Any]] = {}
+# Короткие состояния диалогов (ждём количество, ссылку, текст обращения, ответ оператора).
+# Оба бэкенда дают одинаковый API get / set / pop и забывают брошенные диалоги через ttl.
+class _StateRecord:
+    __slots__ = ("value", "expires_at")
+
+    def __init__(self, value: Dict[str, Any], expires_at: float):
+        self.value = value
+        self.expires_at = expires_at
+
+class MemoryStateStore:
+    """В памяти процесса: TTL + вытеснение давно не использованных (LRU) сверх max_entries."""
+
+    def __init__(self, ttl: float = STATE_TTL_SEC, max_entries: int = STATE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: "OrderedDict[int, _StateRecord]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            rec = self._data.get(key)
+            if rec is None:
+                return None
+            if rec.expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return rec.value
+
+    def set(self, key: int, value: Dict[str, Any]):
+        self._put(key, value, time.monotonic() + self.ttl)
+
+    def _put(self, key: int, value: Optional[Dict[str, Any]], expires_at: float, replace: bool = True):
+        now = time.monotonic()
+        with self._lock:
+            if not replace and key in self._data:
+                return
+            self._data[key] = _StateRecord(value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            # попутно выбрасываем протухшие записи с "холодного" конца
+            for _ in range(2):
+                oldest = next(iter(self._data.items()), None)
+                if oldest is None or oldest[1].expires_at >= now:
+                    break
+                del self._data[oldest[0]]
+
+    def pop(self, key: int, default: Any = None) -> Any:
+        with self._lock:
+            rec = self._data.pop(key, None)
+        if rec is None or rec.expires_at < time.monotonic():
+            return default
+        return rec.value
+
+class SQLiteStateStore(MemoryStateStore):
+    """
+    Таблица conversation_state под LRU в памяти: запись — в БД, затем в память (write-through);
+    промах читается из БД один раз (lazy), запоминается и отсутствие состояния (value None).
+    Состояние переживает редеплой; в prefork им пользуется только бот-процесс, так что память не расходится с БД.
+    Протухшие строки удаляет MaintenanceScheduler.prune_conversation_state.
+    """
+
+    def __init__(self, namespace: str, ttl: float = STATE_TTL_SEC, max_entries: int = STATE_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+        self.namespace = namespace
+
+    def _cached(self, key: int) -> Optional[_StateRecord]:
+        with self._lock:
+            rec = self._data.get(key)
+            if rec is None or rec.expires_at < time.monotonic():
+                return None
+            self._data.move_to_end(key)
+            return rec
+
+    def get(self, key: int) -> Optional[Dict[str, Any]]:
+        rec = self._cached(key)
+        if rec is not None:
+            return rec.value
+        r = db.execute("SELECT value, expires_at FROM conversation_state WHERE namespace = ? AND key = ?", (self.namespace, key)).fetchone()
+        left = r["expires_at"] - time.time() if r is not None else 0
+        value = json.loads(r["value"]) if left > 0 else None
+        # replace=False: параллельный set/pop уже положил более свежее значение
+        self._put(key, value, time.monotonic() + (left if value is not None else self.ttl), replace=False)
+        return value
+
+    def set(self, key: int, value: Dict[str, Any]):
+        with db.transaction() as cur:
+            cur.execute("INSERT OR REPLACE INTO conversation_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                        (self.namespace, key, json.dumps(value, ensure_ascii=False), time.time() + self.ttl))
+        super().set(key, value)
+
+    def pop(self, key: int, default: Any = None) -> Any:
+        rec = self._cached(key)
+        if rec is not None and rec.value is None:
+            return default  # известно, что состояния нет, — без обращения к БД
+        with db.transaction() as cur:
+            cur.execute("SELECT value, expires_at FROM conversation_state WHERE namespace = ? AND key = ?", (self.namespace, key))
+            r = cur.fetchone()
+            if r is not None:
+                cur.execute("DELETE FROM conversation_state WHERE namespace = ? AND key = ?", (self.namespace, key))
+        self._put(key, None, time.monotonic() + self.ttl)
+        if r is None or r["expires_at"] < time.time():
+            return default
+        return json.loads(r["value"])
+
+def make_state_store(namespace: str):
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(namespace)
+    return MemoryStateStore()
+
+user_state = make_state_store("user")
+operator_state = make_state_store("operator")
+admin_state = make_state_store("admin")   # фильтры /sadm
 
 # Ensure initial operators
 for op in INITIAL_OPERATORS:
@@ -500,265 +2465,170 @@ for op in INITIAL_OPERATORS:
 @bot.message_handler(commands=['start'])
 def cmd_start(m: telebot.types.Message):
     ensure_user(m.chat.id, m)
-    bot.send_message(m.chat.id, "🧸 Добро пожаловать! Выберите действие:", reply_markup=main_menu_markup())
+    tg.send_message(m.chat.id, "🧸 Добро пожаловать! Выберите действие:", reply_markup=main_menu_markup())
 
 @bot.callback_query_handler(func=lambda c: True)
 def cb_all(call: telebot.types.CallbackQuery):
     """
-    Главный обработчик callback'ов.
+    Главный обработчик callback'ов: разбор и выбор обработчика — в callbacks (CallbackRouter).
     Используем '::' как разделитель в callback_data, чтобы избежать проблем с '_' в названиях.
     """
     try:
-        data = call.data or ""
-        cid = call.message.chat.id
-        uid = call.from_user.id
+        if not callbacks.dispatch(call):
+            bot.answer_callback_query(call.id, "Неизвестная команда.")
+    except Exception:
+        traceback.print_exc()
+        try:
+            bot.answer_callback_query(call.id, "Ошибка обработки")
+        except Exception:
+            pass
 
-        # navigation
-        if data == "menu_shop":
-            bot.edit_message_text("Выберите соцсеть:", cid, call.message.message_id, reply_markup=shop_socials_markup())
-            return
-        if data == "back_main":
-            bot.edit_message_text("Главное меню:", cid, call.message.message_id, reply_markup=main_menu_markup())
-            return
-        if data == "shop_socials":
-            bot.edit_message_text("Выберите соцсеть:", cid, call.message.message_id, reply_markup=shop_socials_markup())
-            return
+# navigation
+@callbacks.exact("menu_shop")
+@callbacks.exact("shop_socials")
+def cb_shop_socials(call: telebot.types.CallbackQuery):
+    tg.edit_message_text("Выберите соцсеть:", call.message.chat.id, call.message.message_id, reply_markup=shop_socials_markup())
 
-        # support instructions
-        if data == "support_personal":
-            bot.edit_message_text("📨 Чтобы получить помощь в личных сообщениях — найдите оператора в Telegram.\n\nЕсли хотите написать через бота — нажмите «Поддержка (в боте)».", cid, call.message.message_id)
-            return
+@callbacks.exact("back_main")
+def cb_back_main(call: telebot.types.CallbackQuery):
+    tg.edit_message_text("Главное меню:", call.message.chat.id, call.message.message_id, reply_markup=main_menu_markup())
 
-        if data == "support_bot":
-            user_state[cid] = {"awaiting_support_msg": True}
-            bot.send_message(cid, "✉️ Напишите ваше сообщение для поддержки. Оно будет отправлено операторам.")
-            bot.answer_callback_query(call.id)
-            return
+@callbacks.exact("noop")
+def cb_noop(call: telebot.types.CallbackQuery):
+    bot.answer_callback_query(call.id)
 
-        # shop_social::<SocialName>
-        if data.startswith("shop_social::"):
-            social = data.split("::", 1)[1]
-            if social not in SERVICES:
-                bot.answer_callback_query(call.id, "Ошибка: неизвестная соцсеть")
-                return
-            bot.edit_message_text(f"Услуги для {social}:", cid, call.message.message_id, reply_markup=services_markup_for_social(social))
-            return
+# support instructions
+@callbacks.exact("support_personal")
+def cb_support_personal(call: telebot.types.CallbackQuery):
+    tg.edit_message_text("📨 Чтобы получить помощь в личных сообщениях — найдите оператора в Telegram.\n\nЕсли хотите написать через бота — нажмите «Поддержка (в боте)».", call.message.chat.id, call.message.message_id)
 
-        # service::<social>::<key>
-        if data.startswith("service::"):
-            parts = data.split("::")
-            if len(parts) != 3:
-                bot.answer_callback_query(call.id, "Неверные данные сервиса")
-                return
-            _, social, key = parts
-            svc = SERVICES.get(social, {}).get(key)
-            if not svc:
-                bot.answer_callback_query(call.id, "Сервис не найден")
-                return
-            # prepare state for quantity input
-            min_allowed = int(svc.get("min", 1))
-            unit = int(svc.get("unit", 1))
-            price_unit = float(svc.get("price_usd_per_unit", 0.0))
-            user_state[cid] = {"awaiting_qty_for": True, "social": social, "service_key": key,
-                               "min": min_allowed, "unit": unit, "price_unit": price_unit}
-            bot.send_message(cid, f"Вы выбрали: {svc['title']} ({social}). Минимум: {min_allowed}. Введите количество (целое число):")
-            bot.answer_callback_query(call.id)
-            return
+@callbacks.exact("support_bot")
+def cb_support_bot(call: telebot.types.CallbackQuery):
+    cid = call.message.chat.id
+    user_state.set(cid, {"awaiting_support_msg": True})
+    tg.send_message(cid, "✉️ Напишите ваше сообщение для поддержки. Оно будет отправлено операторам.")
+    bot.answer_callback_query(call.id)
 
-        # profile / cart
-        if data == "profile":
-            cart_id = get_or_create_cart(cid)
-            items = get_cart_items(cart_id)
-            txt_lines = []
-            total = 0.0
-            kb = types.InlineKeyboardMarkup(row_width=1)
-            txt_lines.append("🧾 Ваша корзина:\n")
-            if items:
-                for it in items:
-                    title = SERVICES[it['social']][it['service_key']]['title']
-                    txt_lines.append(f"#{it['id']} | {it['social']} — {title} x{it['amount']} — ${float(it['price_usd']):.2f}\nLink: {it['link']}\n")
-                    kb.add(types.InlineKeyboardButton(f"Удалить #{it['id']}", callback_data=f"cart_remove::{it['id']}"))
-                    total += float(it['price_usd'])
-                txt_lines.append(f"\nИтого: ${total:.2f}\n")
-                kb.add(types.InlineKeyboardButton("Оплатить корзину", callback_data=f"cart_pay::{cart_id}"))
-                kb.add(types.InlineKeyboardButton("Очистить корзину", callback_data=f"cart_clear::{cart_id}"))
-            else:
-                txt_lines.append("Корзина пуста.\n")
-            # user orders (recent)
-            conn = get_db(); cur = conn.cursor()
-            cur.execute("SELECT * FROM orders WHERE chat_id = ? ORDER BY id DESC LIMIT 10", (cid,))
-            rows = cur.fetchall(); conn.close()
-            if rows:
-                txt_lines.append("\n📋 Последние заказы:\n")
-                for r in rows:
-                    title = SERVICES[r['social']][r['service_key']]['title']
-                    txt_lines.append(f"#{r['id']} | {r['social']} {title} x{r['amount']} — ${r['price_usd']:.2f} — {r['status']}\n")
-            bot.send_message(cid, "\n".join(txt_lines), reply_markup=kb)
-            bot.answer_callback_query(call.id)
-            return
+# shop_social::<SocialName>
+@callbacks.prefix("shop_social", parse_social, error="Ошибка: неизвестная соцсеть")
+def cb_shop_social(call: telebot.types.CallbackQuery, social: str):
+    tg.edit_message_text(f"Услуги для {social}:", call.message.chat.id, call.message.message_id, reply_markup=services_markup_for_social(social))
 
-        # cart_remove::<item_id>
-        if data.startswith("cart_remove::"):
-            parts = data.split("::")
-            try:
-                item_id = int(parts[1])
-            except Exception:
-                bot.answer_callback_query(call.id, "Ошибка удаления")
-                return
-            remove_cart_item(item_id)
-            bot.answer_callback_query(call.id, "Элемент удалён")
-            # don't try to reconstruct the whole cart here — user can open Корзина снова
-            try:
-                bot.edit_message_text("Элемент удалён. Откройте '🧾 Корзина / Профиль' снова.", cid, call.message.message_id)
-            except Exception:
-                pass
-            return
+# service::<social>::<key>
+@callbacks.prefix("service", str, str, error="Неверные данные сервиса")
+def cb_service(call: telebot.types.CallbackQuery, social: str, key: str):
+    cid = call.message.chat.id
+    svc = SERVICES.get(social, {}).get(key)
+    if not svc:
+        bot.answer_callback_query(call.id, "Сервис не найден")
+        return
+    # prepare state for quantity input
+    min_allowed = int(svc.get("min", 1))
+    unit = int(svc.get("unit", 1))
+    price_unit = float(svc.get("price_usd_per_unit", 0.0))
+    user_state.set(cid, {"awaiting_qty_for": True, "social": social, "service_key": key,
+                         "min": min_allowed, "unit": unit, "price_unit": price_unit})
+    tg.send_message(cid, f"Вы выбрали: {svc['title']} ({social}). Минимум: {min_allowed}. Введите количество (целое число):")
+    bot.answer_callback_query(call.id)
 
-        # cart_clear::<cart_id>
-        if data.startswith("cart_clear::"):
-            parts = data.split("::")
-            try:
-                cart_id = int(parts[1])
-            except Exception:
-                bot.answer_callback_query(call.id, "Ошибка")
-                return
-            clear_cart(cart_id)
-            bot.answer_callback_query(call.id, "Корзина очищена")
-            try:
-                bot.edit_message_text("Корзина очищена. Откройте '🧾 Корзина / Профиль' снова.", cid, call.message.message_id)
-            except Exception:
-                pass
-            return
+# profile / cart
+@callbacks.exact("profile")
+def cb_profile(call: telebot.types.CallbackQuery):
+    cid = call.message.chat.id
+    text, markup = profile_views.get(cid)
+    tg.send_message(cid, text, reply_markup=markup)
+    bot.answer_callback_query(call.id)
 
-        # cart_pay::<cart_id> -> show currency options
-        if data.startswith("cart_pay::"):
-            parts = data.split("::")
-            try:
-                cart_id = int(parts[1])
-            except Exception:
-                bot.answer_callback_query(call.id, "Ошибка")
-                return
-            items = get_cart_items(cart_id)
-            if not items:
-                bot.answer_callback_query(call.id, "Корзина пуста")
-                return
-            total = sum(float(it['price_usd']) for it in items)
-            bot.send_message(cid, f"Сумма к оплате: ${total:.2f}. Выберите валюту:", reply_markup=currency_selection_markup_for_cart(cid, cart_id))
-            bot.answer_callback_query(call.id)
-            return
+# cart_remove::<item_id>
+@callbacks.prefix("cart_remove", int, error="Ошибка удаления")
+def cb_cart_remove(call: telebot.types.CallbackQuery, item_id: int):
+    remove_cart_item(item_id)
+    bot.answer_callback_query(call.id, "Элемент удалён")
+    # don't try to reconstruct the whole cart here — user can open Корзина снова
+    try:
+        tg.edit_message_text("Элемент удалён. Откройте '🧾 Корзина / Профиль' снова.", call.message.chat.id, call.message.message_id)
+    except Exception:
+        pass
 
-        # pay_cart::<chatid>::<cartid>::<asset>
-        if data.startswith("pay_cart::"):
-            # will handle in part 2 (creating invoice + mapping); here only sanity-parse and reply fast
-            parts = data.split("::")
-            if len(parts) != 4:
-                bot.answer_callback_query(call.id, "Неверные данные оплаты")
-                return
-            _, chat_str, cartid_str, asset = parts
-            if not chat_str.isdigit() or not cartid_str.isdigit():
-                bot.answer_callback_query(call.id, "Неправильные идентификаторы")
-                return
-            order_chat = int(chat_str)
-            cart_id = int(cartid_str)
-            items = get_cart_items(cart_id)
-            if not items:
-                bot.answer_callback_query(call.id, "Корзина пуста")
-                return
-            total_usd = sum(float(it['price_usd']) for it in items)
-            # We'll call create invoice and send link in part2; but show immediate ack here
-            bot.answer_callback_query(call.id, "Создаю счёт, проверьте личные сообщения...")
-            # delegate to payment function that will be implemented in part 2 via helper (we can also call here if part2 is sent)
-            # To avoid blocking: create a background thread to call payment function (part2)
-            Thread(target=handle_cart_payment_background, args=(order_chat, cart_id, asset), daemon=True).start()
-            return
+# cart_clear::<cart_id>
+@callbacks.prefix("cart_clear", int, error="Ошибка")
+def cb_cart_clear(call: telebot.types.CallbackQuery, cart_id: int):
+    clear_cart(cart_id)
+    bot.answer_callback_query(call.id, "Корзина очищена")
+    try:
+        tg.edit_message_text("Корзина очищена. Откройте '🧾 Корзина / Профиль' снова.", call.message.chat.id, call.message.message_id)
+    except Exception:
+        pass
 
-        # pay_order::<order_ref>::<asset> - pay single order
-        if data.startswith("pay_order::"):
-            parts = data.split("::")
-            # order_ref expected format: order_<chatid>_<orderid>
-            if len(parts) != 3:
-                bot.answer_callback_query(call.id, "Неверный формат")
-                return
-            _, order_ref, asset = parts
-            # parse order_ref
-            ref_parts = order_ref.split("_")
-            if len(ref_parts) < 3:
-                bot.answer_callback_query(call.id, "Неверный формат заказа")
-                return
-            try:
-                # last two parts are chatid and orderid
-                order_chat = int(ref_parts[-2])
-                order_id = int(ref_parts[-1])
-            except Exception:
-                bot.answer_callback_query(call.id, "Неверный формат заказа")
-                return
-            # spawn background payment (actual invoice creation in part2)
-            bot.answer_callback_query(call.id, "Создаю счёт, проверьте личные сообщения...")
-            Thread(target=handle_single_order_payment_background, args=(order_chat, order_id, asset), daemon=True).start()
-            return
+# cart_pay::<cart_id> -> show currency options
+@callbacks.prefix("cart_pay", int, error="Ошибка")
+def cb_cart_pay(call: telebot.types.CallbackQuery, cart_id: int):
+    cid = call.message.chat.id
+    items, total = cart_repo.open_snapshot(cart_id)
+    if not items:
+        bot.answer_callback_query(call.id, "Корзина пуста или уже закрыта")
+        return
+    tg.send_message(cid, f"Сумма к оплате: ${total:.2f}. Выберите валюту:", reply_markup=currency_selection_markup_for_cart(cid, cart_id))
+    bot.answer_callback_query(call.id)
 
-        # cancel_payment
-        if data == "cancel_payment":
-            bot.answer_callback_query(call.id, "Оплата отменена")
-            try:
-                bot.send_message(cid, "Оплата отменена.", reply_markup=main_menu_markup())
-            except Exception:
-                pass
-            return
+# pay_cart::<chatid>::<cartid>::<asset>
+@callbacks.prefix("pay_cart", int, int, parse_asset, error="Неверные данные оплаты")
+def cb_pay_cart(call: telebot.types.CallbackQuery, order_chat: int, cart_id: int, asset: str):
+    if not cart_repo.open_snapshot(cart_id)[0]:
+        bot.answer_callback_query(call.id, "Корзина пуста или уже закрыта")
+        return
+    submit_payment_job(call, "cart", order_chat, cart_id, asset)
 
-        # operator support navigation
-        if data.startswith("open_requests_page::"):
-            try:
-                page = int(data.split("::")[-1])
-            except Exception:
-                page = 1
-            show_requests_page(call.from_user.id, page, call.message)
-            bot.answer_callback_query(call.id)
-            return
+# pay_order::<order_ref>::<asset> - pay single order, order_ref: order_<chatid>_<orderid>
+@callbacks.prefix("pay_order", parse_order_ref, parse_asset, error="Неверный формат заказа")
+def cb_pay_order(call: telebot.types.CallbackQuery, order_ref: Tuple[int, int], asset: str):
+    order_chat, order_id = order_ref
+    submit_payment_job(call, "order", order_chat, order_id, asset)
 
-        if data.startswith("req::"):
-            try:
-                req_id = int(data.split("::")[1])
-            except Exception:
-                bot.answer_callback_query(call.id, "Bad request id"); return
-            req = get_request_by_id(req_id)
-            if not req or req["status"] != "open":
-                bot.answer_callback_query(call.id, "Обращение не найдено или закрыто"); return
-            text = f"📨 Обращение #{req['id']}\nОт: {req['username']} (id {req['user_chat']})\n\n{req['text']}\n\nНажмите Ответить, чтобы отправить ответ и закрыть обращение."
-            kb = types.InlineKeyboardMarkup(row_width=1)
-            kb.add(types.InlineKeyboardButton("Ответить", callback_data=f"reply_req::{req['id']}"))
-            kb.add(types.InlineKeyboardButton("Назад к списку", callback_data="open_requests_page::1"))
-            try:
-                bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=kb)
-            except Exception:
-                bot.send_message(call.message.chat.id, text, reply_markup=kb)
-            bot.answer_callback_query(call.id)
-            return
+# cancel_payment
+@callbacks.exact("cancel_payment")
+def cb_cancel_payment(call: telebot.types.CallbackQuery):
+    bot.answer_callback_query(call.id, "Оплата отменена")
+    try:
+        tg.send_message(call.message.chat.id, "Оплата отменена.", reply_markup=main_menu_markup())
+    except Exception:
+        pass
 
-        if data.startswith("reply_req::"):
-            try:
-                req_id = int(data.split("::")[-1])
-            except:
-                bot.answer_callback_query(call.id, "Bad conv id"); return
-            if call.from_user.id not in [o["chat_id"] for o in list_operators()]:
-                bot.answer_callback_query(call.id, "У вас нет прав оператора"); return
-            operator_state[call.from_user.id] = {"awaiting_reply_for": req_id, "message_id": call.message.message_id}
-            bot.send_message(call.from_user.id, "Введите ответ для пользователя (сообщение будет отправлено и обращение закроется):")
-            bot.answer_callback_query(call.id)
-            return
+# operator support navigation
+@callbacks.prefix("open_requests_page", parse_page_cursor)
+def cb_open_requests_page(call: telebot.types.CallbackQuery, page_cursor: Tuple[int, Optional[str], int]):
+    show_requests_page(call.from_user.id, *page_cursor, message_reference=call.message)
+    bot.answer_callback_query(call.id)
 
-        # unknown
-        bot.answer_callback_query(call.id, "Неизвестная команда.")
+@callbacks.prefix("req", int, error="Bad request id")
+def cb_req(call: telebot.types.CallbackQuery, req_id: int):
+    req = get_request_by_id(req_id)
+    if not req or req["status"] != "open":
+        bot.answer_callback_query(call.id, "Обращение не найдено или закрыто"); return
+    text = f"📨 Обращение #{req['id']}\nОт: {req['username']} (id {req['user_chat']})\n\n{req['text']}\n\nНажмите Ответить, чтобы отправить ответ и закрыть обращение."
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(types.InlineKeyboardButton("Ответить", callback_data=f"reply_req::{req['id']}"))
+    kb.add(types.InlineKeyboardButton("Назад к списку", callback_data="open_requests_page::1"))
+    try:
+        tg.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=kb)
     except Exception:
-        traceback.print_exc()
-        try:
-            bot.answer_callback_query(call.id, "Ошибка обработки")
-        except Exception:
-            pass
+        tg.send_message(call.message.chat.id, text, reply_markup=kb)
+    bot.answer_callback_query(call.id)
+
+@callbacks.prefix("reply_req", int, error="Bad conv id")
+def cb_reply_req(call: telebot.types.CallbackQuery, req_id: int):
+    if call.from_user.id not in [o["chat_id"] for o in list_operators()]:
+        bot.answer_callback_query(call.id, "У вас нет прав оператора"); return
+    operator_state.set(call.from_user.id, {"awaiting_reply_for": req_id, "message_id": call.message.message_id})
+    tg.send_message(call.from_user.id, "Введите ответ для пользователя (сообщение будет отправлено и обращение закроется):")
+    bot.answer_callback_query(call.id)
 
 # -------------------------
 # Background payment stubs (will be implemented in part 2)
 # -------------------------
+class PaymentJobError(Exception):
+    """Счёт не создан (курс, CryptoPay, ссылка); пользователь уже уведомлён — задача сохраняется как failed."""
+
 def handle_cart_payment_background(order_chat: int, cart_id: int, asset: str):
     """
     Заглушка: реальная логика создания инвойса и отправки ссылки на оплату
@@ -769,16 +2639,20 @@ def handle_cart_payment_background(order_chat: int, cart_id: int, asset: str):
     - отправляем QR/link
     """
     try:
-        items = get_cart_items(cart_id)
+        # задача могла ждать в очереди: корзину за это время могли оплатить другим счётом или отменить
+        items, total_usd = cart_repo.open_snapshot(cart_id)
         if not items:
             try:
-                bot.send_message(order_chat, "Корзина пуста.")
+                tg_payment.send_message(order_chat, "Корзина пуста или уже закрыта.")
             except:
                 pass
             return
-        total_usd = sum(float(it['price_usd']) for it in items)
         # convert -> amount in asset
-        pay_amount = convert_price_usd_to_asset(total_usd, asset.upper())
+        try:
+            pay_amount = convert_price_usd_to_asset(total_usd, asset.upper())
+        except RateUnavailableError as e:
+            tg_payment.send_message(order_chat, f"Курс {asset.upper()} сейчас недоступен. Попробуйте позже или выберите USDT.")
+            raise PaymentJobError(f"rate unavailable: {e}") from e
         order_uid = f"cart_{order_chat}_{cart_id}_{int(time.time())}"
         description = f"Оплата корзины #{cart_id} пользователем {order_chat}"
         callback_url = WEB_DOMAIN.rstrip("/") + "/cryptobot/ipn"
@@ -786,138 +2660,508 @@ def handle_cart_payment_background(order_chat: int, cart_id: int, asset: str):
         resp = create_cryptobot_invoice(pay_amount, asset.upper(), order_uid, description, callback_url=callback_url)
         if isinstance(resp, dict) and resp.get("error"):
             try:
-                bot.send_message(order_chat, f"Ошибка при создании чека: {resp}")
+                tg_payment.send_message(order_chat, f"Ошибка при создании чека: {resp}")
             except:
                 pass
-            return
-        invoice_id = resp.get("invoiceId") or resp.get("id") or resp.get("invoice_id")
-        pay_url = resp.get("pay_url") or resp.get("payment_url") or (resp.get("result", {}).get("pay_url") if isinstance(resp, dict) else None)
+            raise PaymentJobError(f"createInvoice: {resp.get('message')}")
+        invoice_id = resp["invoice_id"]
+        pay_url = resp["pay_url"]
         if invoice_id:
-            set_invoice_mapping(str(invoice_id), order_chat, order_id=None, cart_id=cart_id, raw_payload=resp)
+            set_invoice_mapping(invoice_id, order_chat, order_id=None, cart_id=cart_id, raw_payload=resp["raw"])
         if pay_url:
             try:
                 qr = generate_qr_bytes(pay_url)
-                bot.send_photo(order_chat, qr, caption=f"💳 Оплата корзины #{cart_id} через {asset.upper()}\nСсылка: {pay_url}")
+                tg_payment.send_photo(order_chat, qr, caption=f"💳 Оплата корзины #{cart_id} через {asset.upper()}\nСсылка: {pay_url}")
             except Exception:
-                bot.send_message(order_chat, f"💳 Оплата корзины: {pay_url}")
+                tg_payment.send_message(order_chat, f"💳 Оплата корзины: {pay_url}")
         else:
-            bot.send_message(order_chat, "Не удалось получить ссылку на оплату.")
+            tg_payment.send_message(order_chat, "Не удалось получить ссылку на оплату.")
+            raise PaymentJobError(f"invoice {invoice_id}: no pay_url")
+    except PaymentJobError:
+        raise
     except Exception:
-        traceback.print_exc()
         try:
-            bot.send_message(order_chat, "Ошибка при создании оплаты.")
+            tg_payment.send_message(order_chat, "Ошибка при создании оплаты.")
         except:
             pass
+        raise
 
 def handle_single_order_payment_background(order_chat: int, order_id: int, asset: str):
     """
     Создаёт инвойс для одного заказа (order_id). Логика — аналогична корзине.
     """
     try:
-        conn = get_db(); cur = conn.cursor()
-        cur.execute("SELECT * FROM orders WHERE id = ?", (order_id,))
-        r = cur.fetchone(); conn.close()
+        r = get_order(order_id)
         if not r:
             try:
-                bot.send_message(order_chat, "Заказ не найден.")
+                tg_payment.send_message(order_chat, "Заказ не найден.")
             except:
                 pass
             return
         total_usd = float(r["price_usd"])
-        pay_amount = convert_price_usd_to_asset(total_usd, asset.upper())
+        try:
+            pay_amount = convert_price_usd_to_asset(total_usd, asset.upper())
+        except RateUnavailableError as e:
+            tg_payment.send_message(order_chat, f"Курс {asset.upper()} сейчас недоступен. Попробуйте позже или выберите USDT.")
+            raise PaymentJobError(f"rate unavailable: {e}") from e
         order_uid = f"order_{order_chat}_{order_id}_{int(time.time())}"
         description = f"Оплата заказа #{order_id}"
         callback_url = WEB_DOMAIN.rstrip("/") + "/cryptobot/ipn"
         resp = create_cryptobot_invoice(pay_amount, asset.upper(), order_uid, description, callback_url=callback_url)
         if isinstance(resp, dict) and resp.get("error"):
             try:
-                bot.send_message(order_chat, f"Ошибка при создании чека: {resp}")
+                tg_payment.send_message(order_chat, f"Ошибка при создании чека: {resp}")
             except:
                 pass
-            return
-        invoice_id = resp.get("invoiceId") or resp.get("id") or resp.get("invoice_id")
-        pay_url = resp.get("pay_url") or resp.get("payment_url") or (resp.get("result", {}).get("pay_url") if isinstance(resp, dict) else None)
+            raise PaymentJobError(f"createInvoice: {resp.get('message')}")
+        invoice_id = resp["invoice_id"]
+        pay_url = resp["pay_url"]
         if invoice_id:
-            set_invoice_mapping(str(invoice_id), order_chat, order_id=order_id, cart_id=None, raw_payload=resp)
-            update_order_invoice(order_id, str(invoice_id), pay_url)
+            set_invoice_mapping(invoice_id, order_chat, order_id=order_id, cart_id=None, raw_payload=resp["raw"])
+            update_order_invoice(order_id, invoice_id, pay_url)
         if pay_url:
             try:
                 qr = generate_qr_bytes(pay_url)
-                bot.send_photo(order_chat, qr, caption=f"💳 Оплата заказа #{order_id} через {asset.upper()}\nСсылка: {pay_url}")
+                tg_payment.send_photo(order_chat, qr, caption=f"💳 Оплата заказа #{order_id} через {asset.upper()}\nСсылка: {pay_url}")
             except Exception:
-                bot.send_message(order_chat, f"💳 Оплата заказа: {pay_url}")
+                tg_payment.send_message(order_chat, f"💳 Оплата заказа: {pay_url}")
         else:
-            bot.send_message(order_chat, "Не удалось получить ссылку на оплату.")
+            tg_payment.send_message(order_chat, "Не удалось получить ссылку на оплату.")
+            raise PaymentJobError(f"invoice {invoice_id}: no pay_url")
+    except PaymentJobError:
+        raise
     except Exception:
-        traceback.print_exc()
         try:
-            bot.send_message(order_chat, "Ошибка при создании оплаты.")
+            tg_payment.send_message(order_chat, "Ошибка при создании оплаты.")
         except:
             pass
+        raise
+
+# -------------------------
+# Payment job queue
+# -------------------------
+class PaymentQueueFullError(Exception):
+    pass
+
+class PaymentJobQueue:
+    """
+    Задачи на создание счетов хранятся в payment_jobs и выполняются фиксированным пулом потоков.
+    - дубликаты (тот же чат, корзина/заказ и валюта, задача ещё не завершена) не создают второй счёт
+    - при max_pending незавершённых задач submit() отказывает (PaymentQueueFullError)
+    - задачи переживают редеплой: stop() дожидается текущих задач, recover() возвращает прерванные running -> pending
+    - обработчик сообщает о неудаче исключением (сам уведомив пользователя): задача -> failed, текст — в last_error
+    Воркер забирает задачу из БД под write-lock, поэтому таблицу могут обслуживать несколько процессов.
+    """
+
+    def __init__(self, handlers: Dict[str, Callable[[int, int, str], None]], workers: int = PAYMENT_WORKERS,
+                 max_pending: int = PAYMENT_QUEUE_MAX, poll_interval: float = 2.0):
+        self.handlers = handlers
+        self.workers = workers
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads: List[Thread] = []
+
+    def submit(self, kind: str, chat_id: int, ref_id: int, asset: str) -> Tuple[int, bool]:
+        """Возвращает (job_id, created); created=False — такая задача уже в работе."""
+        now = datetime.utcnow().isoformat()
+        with db.transaction() as cur:
+            cur.execute("SELECT id FROM payment_jobs WHERE kind = ? AND chat_id = ? AND ref_id = ? AND asset = ? AND status IN ('pending', 'running')",
+                        (kind, chat_id, ref_id, asset))
+            r = cur.fetchone()
+            if r:
+                return r["id"], False
+            cur.execute("SELECT COUNT(*) AS c FROM payment_jobs WHERE status IN ('pending', 'running')")
+            if cur.fetchone()["c"] >= self.max_pending:
+                raise PaymentQueueFullError(f"{self.max_pending} payment jobs pending")
+            cur.execute("INSERT INTO payment_jobs (kind, chat_id, ref_id, asset, status, created_at, updated_at) VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+                        (kind, chat_id, ref_id, asset, now, now))
+            job_id = cur.lastrowid
+        self.start()
+        with self._cond:
+            self._cond.notify()
+        return job_id, True
+
+    def recover(self) -> int:
+        """
+        Прерванные задачи — снова в очередь. Вызывать, когда ни один другой процесс их не выполняет:
+        при старте приложения, в prefork — бот-процессом после получения аренды inbox.
+        """
+        with db.transaction() as cur:
+            cur.execute("UPDATE payment_jobs SET status = 'pending', updated_at = ? WHERE status = 'running'", (datetime.utcnow().isoformat(),))
+            return cur.rowcount
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        with db.transaction() as cur:
+            cur.execute("SELECT * FROM payment_jobs WHERE status = 'pending' ORDER BY id LIMIT 1")
+            r = cur.fetchone()
+            if not r:
+                return None
+            cur.execute("UPDATE payment_jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (datetime.utcnow().isoformat(), r["id"]))
+            return dict(r)
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None):
+        with db.transaction() as cur:
+            cur.execute("UPDATE payment_jobs SET status = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                        (status, error, datetime.utcnow().isoformat(), job_id))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception:
+                traceback.print_exc()
+                job = None
+            if job is None:
+                with self._cond:
+                    self._cond.wait(self.poll_interval)
+                continue
+            try:
+                self.handlers[job["kind"]](job["chat_id"], job["ref_id"], job["asset"])
+                self._finish(job["id"], "done")
+            except Exception as e:
+                traceback.print_exc()
+                self._finish(job["id"], "failed", str(e))
+
+    def start(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            t = Thread(target=self._run, name=f"payment-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = DRAIN_TIMEOUT_SEC) -> bool:
+        """Воркеры не берут новых задач; ждём текущие до timeout. False — кто-то не успел (задача останется running)."""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        return not any(t.is_alive() for t in self._threads)
+
+payment_jobs = register_background_service(PaymentJobQueue({
+    "cart": handle_cart_payment_background,
+    "order": handle_single_order_payment_background,
+}))
+
+def submit_payment_job(call: telebot.types.CallbackQuery, kind: str, chat_id: int, ref_id: int, asset: str):
+    try:
+        _, created = payment_jobs.submit(kind, chat_id, ref_id, asset.upper())
+    except PaymentQueueFullError:
+        bot.answer_callback_query(call.id, "Сейчас много заказов, попробуйте через минуту.")
+        return
+    if created:
+        bot.answer_callback_query(call.id, "Создаю счёт, проверьте личные сообщения...")
+    else:
+        bot.answer_callback_query(call.id, "Счёт уже создаётся, подождите...")
 
 # -------------------------
 # Support notifications & pagination
 # -------------------------
-def _store_operator_notification(op_chat:int, msg_id:Optional[int]):
-    conn = get_db(); cur = conn.cursor()
-    now = datetime.utcnow().isoformat()
-    cur.execute("INSERT OR REPLACE INTO operator_notifications (operator_chat, message_id, created_at) VALUES (?, ?, ?)", (op_chat, msg_id, now))
-    conn.commit(); conn.close()
+class OperatorNotifier:
+    """
+    Рассылка «новое обращение» всем операторам вне потока обработчика:
+    - notify() только взводит флаг; всплеск вызовов за debounce секунд склеивается в один проход;
+    - проход: один запрос операторов с их message_id + один COUNT, затем параллельно (pool из workers)
+      edit или send каждому оператору;
+    - op_chat -> (message_id, последний текст) держим в памяти: тот же текст повторно не редактируем;
+    - изменившиеся message_id пишутся одной транзакцией в конце прохода.
+    """
 
-def notify_all_operators_new_request():
-    ops = list_operators()
-    total = get_open_requests_count()
-    for op in ops:
-        op_chat = op["chat_id"]
-        conn = get_db(); cur = conn.cursor()
-        cur.execute("SELECT message_id FROM operator_notifications WHERE operator_chat = ?", (op_chat,))
-        r = cur.fetchone(); conn.close()
-        notif_text = f"🔔 У вас новое обращение ({total} всего)"
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("Перейти к обращениям", callback_data=f"open_requests_page::1"))
+    def __init__(self, debounce: float = NOTIFY_DEBOUNCE_SEC, workers: int = NOTIFY_WORKERS):
+        self.debounce = debounce
+        self.workers = workers
+        self._sent: Dict[int, Tuple[Optional[int], Optional[str]]] = {}
+        self._cond = threading.Condition()
+        self._dirty = False
+        self._stop = False
+        self._start_lock = threading.Lock()
+        self._thread: Optional[Thread] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._stats = latency_stats("notify.round")
+
+    def notify(self):
+        self.start()
+        with self._cond:
+            self._dirty = True
+            self._cond.notify()
+
+    def _deliver(self, op_chat: int, text: str, kb) -> Tuple[int, Optional[int], bool]:
+        """(op_chat, message_id, изменился ли message_id)."""
+        msg_id, last_text = self._sent.get(op_chat, (None, None))
+        if msg_id and last_text == text:
+            return op_chat, msg_id, False
         try:
-            if r and r["message_id"]:
+            if msg_id:
                 try:
-                    bot.edit_message_text(notif_text, op_chat, r["message_id"], reply_markup=kb)
-                except Exception:
-                    sent = bot.send_message(op_chat, notif_text, reply_markup=kb)
-                    _store_operator_notification(op_chat, sent.message_id)
-            else:
-                sent = bot.send_message(op_chat, notif_text, reply_markup=kb)
-                _store_operator_notification(op_chat, sent.message_id)
+                    tg_notify.edit_message_text(text, op_chat, msg_id, reply_markup=kb)
+                    return op_chat, msg_id, False
+                except Exception as e:
+                    if "message is not modified" in str(e):
+                        return op_chat, msg_id, False
+            sent = tg_notify.send_message(op_chat, text, reply_markup=kb)
+            return op_chat, sent.message_id, True
+        except Exception:
+            return op_chat, None, msg_id is not None
+
+    def run_once(self):
+        started = time.perf_counter()
+        failed = False
+        try:
+            ops = get_operator_notifications()
+            text = f"🔔 У вас новое обращение ({get_open_requests_count()} всего)"
+            kb = types.InlineKeyboardMarkup()
+            kb.add(types.InlineKeyboardButton("Перейти к обращениям", callback_data="open_requests_page::1"))
+            # message_id мог смениться в другом процессе (prefork) — тогда текст нам неизвестен
+            self._sent = {op: (db_id, self._sent[op][1] if op in self._sent and self._sent[op][0] == db_id else None)
+                          for op, db_id in ops.items()}
+            changed: Dict[int, Optional[int]] = {}
+            for op_chat, msg_id, is_new in self._pool.map(lambda op: self._deliver(op, text, kb), list(ops)):
+                self._sent[op_chat] = (msg_id, text if msg_id else None)
+                if is_new:
+                    changed[op_chat] = msg_id
+            if changed:
+                store_operator_notifications(changed)
         except Exception:
-            _store_operator_notification(op_chat, None)
+            failed = True
+            traceback.print_exc()
+        finally:
+            self._stats.observe((time.perf_counter() - started) * 1000, error=failed)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+            # окно склейки: вызовы notify() за это время войдут в тот же проход
+            time.sleep(self.debounce)
+            with self._cond:
+                self._dirty = False
+            self.run_once()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="notify")
+            self._stop = False
+            self._thread = Thread(target=self._run, name="operator-notifier", daemon=True)
+            self._thread.start()
 
-def show_requests_page(operator_chat:int, page:int, message_reference=None):
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+operator_notifier = register_background_service(OperatorNotifier())
+
+def notify_all_operators_new_request():
+    operator_notifier.notify()
+
+def show_requests_page(operator_chat:int, page:int, direction:Optional[str]=None, cursor:int=0, message_reference=None):
+    """
+    Страница открытых обращений по курсору id: '>' — после cursor, '<' — перед ним, без курсора — первая.
+    Номер страницы только для отображения, всего — из support_stats.
+    """
     per_page = 5
-    offset = (page-1) * per_page
-    rows = get_open_requests(offset=offset, limit=per_page)
+    if direction == "<":
+        rows = get_open_requests(limit=per_page, before_id=cursor)
+    else:
+        rows = get_open_requests(after_id=cursor if direction == ">" else 0, limit=per_page)
+    if not rows and direction is not None:
+        # курсор устарел (обращения закрыли) — начинаем сначала
+        page, rows = 1, get_open_requests(limit=per_page)
+    if direction is None or not rows:
+        page = 1
     total = get_open_requests_count()
     total_pages = (total + per_page - 1) // per_page if total else 1
+    page = min(max(page, 1), total_pages)
     txt = f"📂 Обращения — страница {page}/{total_pages}\nВсего открытых: {total}\n\nНажмите на обращение, чтобы открыть его."
     kb = types.InlineKeyboardMarkup(row_width=1)
     for r in rows:
         uname = r["username"] or f"id{r['user_chat']}"
         kb.add(types.InlineKeyboardButton(f"{r['id']} | {uname}", callback_data=f"req::{r['id']}"))
     nav = types.InlineKeyboardMarkup(row_width=3)
-    prev_page = page-1 if page>1 else 1
-    next_page = page+1 if page<total_pages else total_pages
-    nav.add(types.InlineKeyboardButton("◀️", callback_data=f"open_requests_page::{prev_page}"),
+    if rows and page > 1:
+        prev_cb = f"open_requests_page::{page-1}:<{rows[0]['id']}"
+    else:
+        prev_cb = "open_requests_page::1"
+    if rows and page < total_pages:
+        next_cb = f"open_requests_page::{page+1}:>{rows[-1]['id']}"
+    else:
+        next_cb = f"open_requests_page::{page}:>{rows[0]['id'] - 1}" if rows else "open_requests_page::1"
+    nav.add(types.InlineKeyboardButton("◀️", callback_data=prev_cb),
             types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data="noop"),
-            types.InlineKeyboardButton("▶️", callback_data=f"open_requests_page::{next_page}"))
+            types.InlineKeyboardButton("▶️", callback_data=next_cb))
     try:
         if message_reference:
-            bot.edit_message_text(txt, operator_chat, message_reference.message_id, reply_markup=kb)
-            bot.send_message(operator_chat, "Навигация:", reply_markup=nav)
+            tg.edit_message_text(txt, operator_chat, message_reference.message_id, reply_markup=kb)
+            tg.send_message(operator_chat, "Навигация:", reply_markup=nav)
         else:
-            bot.send_message(operator_chat, txt, reply_markup=kb)
-            bot.send_message(operator_chat, "Навигация:", reply_markup=nav)
+            tg.send_message(operator_chat, txt, reply_markup=kb)
+            tg.send_message(operator_chat, "Навигация:", reply_markup=nav)
+    except Exception:
+        try:
+            tg.send_message(operator_chat, txt, reply_markup=kb)
+            tg.send_message(operator_chat, "Навигация:", reply_markup=nav)
+        except Exception:
+            pass
+
+# -------------------------
+# Admin order browser (/sadm)
+# -------------------------
+_ORDER_FILTER_KEYS = ("status", "social", "from", "to")
+
+def parse_order_filters(args: List[str]) -> Dict[str, str]:
+    """['status=paid', 'from=2025-01-01', ...] -> фильтры; ValueError на неизвестный ключ или кривую дату."""
+    filters: Dict[str, str] = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in _ORDER_FILTER_KEYS or not value:
+            raise ValueError(arg)
+        if key in ("from", "to"):
+            datetime.strptime(value, "%Y-%m-%d")
+        filters[key] = value
+    return filters
+
+def _describe_filters(filters: Dict[str, str]) -> str:
+    return ", ".join(f"{k}={filters[k]}" for k in _ORDER_FILTER_KEYS if filters.get(k)) or "без фильтров"
+
+def show_orders_page(admin_chat: int, direction: Optional[str] = None, cursor: int = 0, message_reference=None):
+    filters = (admin_state.get(admin_chat) or {}).get("filters", {})
+    rows = browse_orders(filters, direction, cursor)
+    if not rows and direction is not None:
+        # дальше/раньше ничего нет — остаёмся на первой странице
+        rows = browse_orders(filters)
+    lines = [f"Заказы ({_describe_filters(filters)}):\n"]
+    size = len(lines[0])
+    shown: List[Dict[str, Any]] = []
+    for r in rows:
+        svc_title = SERVICES.get(r["social"], {}).get(r["service_key"], {}).get("title", r["service_key"])
+        line = f"#{r['id']} uid:{r['chat_id']} {r['social']} {svc_title} x{r['amount']} — ${r['price_usd']:.2f} — {r['status']} — {(r['created_at'] or '')[:16]}"
+        size += len(line) + 1
+        if size > 3900:   # лимит сообщения Telegram — 4096
+            break
+        lines.append(line)
+        shown.append(r)
+    if not rows:
+        lines.append("Заказов нет.")
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    if shown:
+        # курсоры — по реально показанным строкам: не влезшие в сообщение попадут на следующую страницу
+        kb.add(types.InlineKeyboardButton("◀️ Новее", callback_data=f"sadm::<{shown[0]['id']}"),
+               types.InlineKeyboardButton("Старее ▶️", callback_data=f"sadm::>{shown[-1]['id']}"))
+    kb.add(types.InlineKeyboardButton("⬇️ CSV", callback_data="sadm_export::csv"),
+           types.InlineKeyboardButton("⬇️ JSONL", callback_data="sadm_export::jsonl"))
+    text = "\n".join(lines)
+    if message_reference is not None:
+        try:
+            tg.edit_message_text(text, admin_chat, message_reference.message_id, reply_markup=kb)
+            return
+        except Exception:
+            pass
+    tg.send_message(admin_chat, text, reply_markup=kb)
+
+_exports_running: set = set()
+_exports_lock = threading.Lock()
+
+def export_orders(admin_chat: int, filters: Dict[str, str], fmt: str):
+    """
+    Выгрузка всех заказов под фильтром документом: строки идут курсором (iter_orders) прямо в
+    SpooledTemporaryFile — до EXPORT_SPOOL_BYTES в памяти, дальше на диске.
+    Файл передаётся задаче outbox и закрывается по её завершению (_export_sent), а не на выходе
+    отсюда: загрузка может идти дольше TG_SEND_TIMEOUT_SEC и повторяться после 429.
+    """
+    started = time.perf_counter()
+    count = 0
+    raw = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES, mode="w+b")
+    sending = False
+    try:
+        out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        writer = csv.writer(out) if fmt == "csv" else None
+        if writer:
+            writer.writerow(ORDER_EXPORT_COLUMNS)
+        for row in iter_orders(filters):
+            if writer:
+                writer.writerow(tuple(row))
+            else:
+                out.write(json.dumps(dict(zip(ORDER_EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+            count += 1
+        out.flush()
+        out.detach()
+        size = raw.tell()
+        if size > 49 * 1024 * 1024:   # лимит Bot API на отправку файла — 50 МБ
+            tg.send_message(admin_chat, f"Выгрузка слишком большая ({size // (1024 * 1024)} МБ, {count} заказов). Сузьте фильтр.")
+            return
+        raw.seek(0)
+        name = f"orders_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        fut = tg.post("send_document", admin_chat, raw, visible_file_name=name,
+                      caption=f"{count} заказов ({_describe_filters(filters)})")
+        sending = True
+        fut.add_done_callback(lambda f: _export_sent(f, raw, admin_chat))
     except Exception:
+        traceback.print_exc()
         try:
-            bot.send_message(operator_chat, txt, reply_markup=kb)
-            bot.send_message(operator_chat, "Навигация:", reply_markup=nav)
+            tg.send_message(admin_chat, "Ошибка выгрузки.")
         except Exception:
             pass
+    finally:
+        latency_stats("admin.export").observe((time.perf_counter() - started) * 1000)
+        db.close()   # поток выгрузки одноразовый
+        if not sending:
+            raw.close()
+            with _exports_lock:
+                _exports_running.discard(admin_chat)
+
+def _export_sent(fut: Future, raw, admin_chat: int):
+    """Документ выгрузки отправлен или окончательно не ушёл: файл больше не нужен, можно следующую выгрузку."""
+    raw.close()
+    with _exports_lock:
+        _exports_running.discard(admin_chat)
+    if fut.cancelled() or fut.exception() is not None:
+        tg.post("send_message", admin_chat, "Ошибка выгрузки.")
+
+def parse_admin_cursor(value: str) -> Tuple[str, int]:
+    if not value or value[0] not in "<>":
+        raise ValueError(value)
+    return value[0], int(value[1:])
+
+def parse_export_format(value: str) -> str:
+    if value not in ("csv", "jsonl"):
+        raise ValueError(value)
+    return value
+
+# sadm::<'<'|'>'><id>
+@callbacks.prefix("sadm", parse_admin_cursor)
+def cb_sadm_page(call: telebot.types.CallbackQuery, cursor: Tuple[str, int]):
+    if call.from_user.id not in ADMIN_IDS:
+        bot.answer_callback_query(call.id, "Нет прав."); return
+    show_orders_page(call.message.chat.id, *cursor, message_reference=call.message)
+    bot.answer_callback_query(call.id)
+
+# sadm_export::<csv|jsonl>
+@callbacks.prefix("sadm_export", parse_export_format)
+def cb_sadm_export(call: telebot.types.CallbackQuery, fmt: str):
+    if call.from_user.id not in ADMIN_IDS:
+        bot.answer_callback_query(call.id, "Нет прав."); return
+    cid = call.message.chat.id
+    with _exports_lock:
+        if cid in _exports_running:
+            bot.answer_callback_query(call.id, "Выгрузка уже идёт...")
+            return
+        _exports_running.add(cid)
+    filters = (admin_state.get(cid) or {}).get("filters", {})
+    Thread(target=export_orders, args=(cid, filters, fmt), name="orders-export", daemon=True).start()
+    bot.answer_callback_query(call.id, "Готовлю файл...")
 
 # -------------------------
 # Text message handler (orders, support, admin)
@@ -932,70 +3176,94 @@ def handle_text(m: telebot.types.Message):
         # ADMIN: add operator
         if text.startswith("/add_operator"):
             if m.from_user.id not in ADMIN_IDS:
-                bot.reply_to(m, "Нет прав.")
+                tg.reply_to(m, "Нет прав.")
                 return
             parts = text.split()
             if len(parts) != 2:
-                bot.reply_to(m, "Использование: /add_operator <chat_id>")
+                tg.reply_to(m, "Использование: /add_operator <chat_id>")
                 return
             try:
                 new_id = int(parts[1])
             except:
-                bot.reply_to(m, "Bad id")
+                tg.reply_to(m, "Bad id")
                 return
             add_operator(new_id, username=None, display_name=None)
-            bot.reply_to(m, f"Добавлен оператор {new_id}")
+            tg.reply_to(m, f"Добавлен оператор {new_id}")
             return
 
         # ADMIN: remove operator
         if text.startswith("/operator_remove"):
             if m.from_user.id not in ADMIN_IDS:
-                bot.reply_to(m, "Нет прав.")
+                tg.reply_to(m, "Нет прав.")
                 return
             parts = text.split()
             if len(parts) != 2:
-                bot.reply_to(m, "Использование: /operator_remove <chat_id>")
+                tg.reply_to(m, "Использование: /operator_remove <chat_id>")
                 return
             try:
                 rem = int(parts[1])
             except:
-                bot.reply_to(m, "Bad id")
+                tg.reply_to(m, "Bad id")
                 return
             remove_operator(rem)
-            bot.reply_to(m, f"Удалён оператор {rem}")
+            tg.reply_to(m, f"Удалён оператор {rem}")
             return
 
         # ADMIN: list operators
         if text.startswith("/operators_check"):
             if m.from_user.id not in ADMIN_IDS:
-                bot.reply_to(m, "Нет прав.")
+                tg.reply_to(m, "Нет прав.")
                 return
             ops = list_operators()
             if not ops:
-                bot.reply_to(m, "Нет операторов.")
+                tg.reply_to(m, "Нет операторов.")
                 return
             s = "Операторы:\n"
             for o in ops:
                 s += f"- id: {o['chat_id']}, username: {o['username'] or '—'}, name: {o['display_name'] or '—'}\n"
-            bot.reply_to(m, s)
+            tg.reply_to(m, s)
+            return
+
+        # ADMIN: sales stats from rollups — /stats [days] | /stats rebuild
+        if text.startswith("/stats"):
+            if m.from_user.id not in ADMIN_IDS:
+                tg.reply_to(m, "Нет прав.")
+                return
+            arg = text.split()[1] if len(text.split()) > 1 else "7"
+            if arg == "rebuild":
+                rollup_backfill.request()
+                tg.reply_to(m, "Пересчёт статистики запущен.")
+                return
+            if not arg.isdigit() or not 1 <= int(arg) <= 366:
+                tg.reply_to(m, "Использование: /stats [дней, 1-366] | /stats rebuild")
+                return
+            since = (datetime.utcnow() - timedelta(days=int(arg) - 1)).strftime("%Y-%m-%d")
+            st = get_rollup_stats(since)
+            lines = [f"📊 Статистика с {since}:\n", "День — заказов / оплачено / выручка"]
+            lines += [f"{r['day']} — {r['orders']} / {r['paid']} / ${r['revenue']:.2f}" for r in st["by_day"]]
+            lines.append(f"\nИтого оплачено: {sum(r['paid'] for r in st['by_day'])} на ${sum(r['revenue'] for r in st['by_day']):.2f}")
+            if st["by_social"]:
+                lines.append("\nПо соцсетям:")
+                lines += [f"{r['social']}: {r['paid']} — ${r['revenue']:.2f}" for r in st["by_social"]]
+            if st["by_asset"]:
+                lines.append("\nПо валютам:")
+                lines += [f"{r['asset'] or '—'}: {r['paid']} — ${r['revenue']:.2f}" for r in st["by_asset"]]
+            tg.reply_to(m, "\n".join(lines)[:4000])
             return
 
-        # ADMIN: show recent orders
+        # ADMIN: browse orders
         if text.startswith("/sadm"):
             if m.from_user.id not in ADMIN_IDS:
-                bot.reply_to(m, "Нет прав.")
+                tg.reply_to(m, "Нет прав.")
                 return
-            conn = get_db(); cur = conn.cursor()
-            cur.execute("SELECT id, chat_id, social, service_key, amount, price_usd, status FROM orders ORDER BY id DESC LIMIT 200")
-            rows = cur.fetchall(); conn.close()
-            if not rows:
-                bot.reply_to(m, "Заказов нет.")
+            # /sadm [status=paid] [social=Instagram] [from=YYYY-MM-DD] [to=YYYY-MM-DD]
+            try:
+                filters = parse_order_filters(text.split()[1:])
+            except ValueError:
+                tg.reply_to(m, "Использование: /sadm [status=...] [social=...] [from=YYYY-MM-DD] [to=YYYY-MM-DD]")
                 return
-            txt = "Последние заказы:\n\n"
-            for r in rows:
-                svc_title = SERVICES.get(r["social"],{}).get(r["service_key"],{}).get("title", r["service_key"])
-                txt += f"#{r['id']} uid:{r['chat_id']} {r['social']} {svc_title} x{r['amount']} — ${r['price_usd']:.2f} — {r['status']}\n"
-            bot.reply_to(m, txt)
+            admin_state.set(cid, {"filters": filters})
+            show_orders_page(cid)
             return
 
         # USER: states
@@ -1004,41 +3272,41 @@ def handle_text(m: telebot.types.Message):
         # awaiting quantity
         if state and state.get("awaiting_qty_for"):
             if not text.isdigit():
-                bot.reply_to(m, "Введите целое число.")
+                tg.reply_to(m, "Введите целое число.")
                 return
             qty = int(text)
             minq = state.get("min", 1)
             if qty < minq:
-                bot.reply_to(m, f"Минимум {minq}")
+                tg.reply_to(m, f"Минимум {minq}")
                 return
             unit = state.get("unit", 1)
             price_unit = float(state.get("price_unit", 0.0))
             price = price_unit * (qty / unit)
             price = round(price, 2)
             # ask link
-            user_state[cid] = {"awaiting_link_for": True, "social": state["social"], "service_key": state["service_key"], "quantity": qty, "price_usd": price}
-            bot.reply_to(m, f"Цена: ${price:.2f}. Теперь отправьте ссылку на аккаунт/пост/канал (http/https):")
+            user_state.set(cid, {"awaiting_link_for": True, "social": state["social"], "service_key": state["service_key"], "quantity": qty, "price_usd": price})
+            tg.reply_to(m, f"Цена: ${price:.2f}. Теперь отправьте ссылку на аккаунт/пост/канал (http/https):")
             return
 
         # awaiting link
         if state and state.get("awaiting_link_for"):
             link = text
             if not (link.startswith("http://") or link.startswith("https://")):
-                bot.reply_to(m, "Неверная ссылка. Должна начинаться с http/https")
+                tg.reply_to(m, "Неверная ссылка. Должна начинаться с http/https")
                 return
             social = state["social"]; service_key = state["service_key"]; qty = state["quantity"]; price = float(state["price_usd"])
             cart_id = get_or_create_cart(cid)
             add_item_to_cart(cart_id, social, service_key, qty, link, price)
             user_state.pop(cid, None)
-            bot.reply_to(m, f"✅ Товар добавлен в корзину. Цена: ${price:.2f}\nПерейти в неё можно через '🧾 Корзина / Профиль'", reply_markup=main_menu_markup())
+            tg.reply_to(m, f"✅ Товар добавлен в корзину. Цена: ${price:.2f}\nПерейти в неё можно через '🧾 Корзина / Профиль'", reply_markup=main_menu_markup())
             return
 
         # awaiting support message
         if state and state.get("awaiting_support_msg"):
             user_state.pop(cid, None)
             uname = m.from_user.username or f"id{cid}"
-            rid = create_support_request(cid, uname, text)
-            bot.reply_to(m, "✅ Ваше обращение отправлено. Ожидайте ответа.")
+            create_support_request(cid, uname, text)
+            tg.reply_to(m, "✅ Ваше обращение отправлено. Ожидайте ответа.")
             notify_all_operators_new_request()
             return
 
@@ -1048,27 +3316,27 @@ def handle_text(m: telebot.types.Message):
             req_id = opstate["awaiting_reply_for"]
             req = get_request_by_id(req_id)
             if not req:
-                bot.reply_to(m, "Обращение не найдено.")
+                tg.reply_to(m, "Обращение не найдено.")
                 operator_state.pop(cid, None)
                 return
             reply_text = text
             try:
-                bot.send_message(req["user_chat"], f"💬 Ответ от поддержки:\n{reply_text}")
+                tg.send_message(req["user_chat"], f"💬 Ответ от поддержки:\n{reply_text}")
             except Exception:
                 pass
             add_support_message(req_id, cid, req["user_chat"], reply_text)
             close_request(req_id)
-            bot.reply_to(m, "Ответ отправлен и обращение закрыто.")
+            tg.reply_to(m, "Ответ отправлен и обращение закрыто.")
             operator_state.pop(cid, None)
             notify_all_operators_new_request()
             return
 
         # fallback
-        bot.send_message(cid, "Не понял. Нажми /start для меню.")
+        tg.send_message(cid, "Не понял. Нажми /start для меню.")
     except Exception:
         traceback.print_exc()
         try:
-            bot.reply_to(m, "Внутренняя ошибка.")
+            tg.reply_to(m, "Внутренняя ошибка.")
         except:
             pass
 
@@ -1094,9 +3362,19 @@ SaleTest_full_part2.py — часть 2/2
 
 import os
 import json
+import glob
+import hmac
+import gzip
+import queue
+import shutil
+import atexit
+import signal
+import select
+import socket
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import request, jsonify
+from werkzeug.serving import make_server
 
 # Flask и bot уже объявлены в части 1
 # Используем их напрямую
@@ -1104,100 +3382,882 @@ from flask import request, jsonify
 # -------------------------
 # Logging utility
 # -------------------------
+class AsyncJsonlWriter:
+    """
+    JSONL-лог вне пути запроса:
+    - write() только кладёт запись в ограниченную очередь (переполнение — запись отбрасывается и считается в dropped);
+    - поток-писатель пишет пачками, fsync — не чаще раза в fsync_interval;
+    - ротация по размеру и по времени, ротированные сегменты сжимаются gzip, старше backups штук удаляются;
+    - flush() / close() — дописать всё из очереди (close вызывается при выходе процесса).
+    """
+
+    def __init__(self, path: str, max_queue: int = 10000, batch_size: int = 500, fsync_interval: float = 1.0,
+                 max_bytes: int = IPN_LOG_MAX_BYTES, rotate_interval: float = IPN_LOG_ROTATE_SEC, backups: int = IPN_LOG_BACKUPS):
+        self.path = path
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.dropped = 0
+        self._q: "queue.Queue[Any]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[Thread] = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._opened_at = 0.0
+        self._last_fsync = 0.0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = Thread(target=self._run, name="jsonl-writer", daemon=True)
+            self._thread.start()
+
+    def write(self, record: Dict[str, Any]) -> bool:
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        try:
+            self._q.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Ждёт, пока всё, что было в очереди на момент вызова, окажется на диске."""
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        try:
+            self._q.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 5.0):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._q.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    stop = close
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._opened_at = time.time()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        rotated = f"{self.path}.{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}"
+        os.replace(self.path, rotated)
+        self._open()
+        Thread(target=self._compress, args=(rotated,), daemon=True).start()
+
+    def _compress(self, rotated: str):
+        try:
+            with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+            for old in sorted(glob.glob(glob.escape(self.path) + ".*.gz"))[:-self.backups or None]:
+                os.remove(old)
+        except Exception:
+            traceback.print_exc()
+
+    def _run(self):
+        self._open()
+        stop = False
+        while not stop:
+            try:
+                items = [self._q.get(timeout=self.fsync_interval)]
+            except queue.Empty:
+                items = []
+            while items and len(items) < self.batch_size:
+                try:
+                    items.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            waiters = []
+            for it in items:
+                if it is None:
+                    stop = True
+                elif isinstance(it, threading.Event):
+                    waiters.append(it)
+                else:
+                    lines.append(json.dumps(it, ensure_ascii=False) + "\n")
+            try:
+                if lines:
+                    self._file.write("".join(lines))
+                if waiters or stop or (lines and time.monotonic() - self._last_fsync >= self.fsync_interval):
+                    self._sync()
+                size = self._file.tell()
+                if size >= self.max_bytes or (size and time.time() - self._opened_at >= self.rotate_interval):
+                    self._rotate()
+            except Exception:
+                traceback.print_exc()
+            for w in waiters:
+                w.set()
+        self._file.close()
+
+ipn_log = register_background_service(AsyncJsonlWriter(IPN_LOG_FILE))
+atexit.register(ipn_log.close)
+
 def log_ipn_event(data: dict):
-    try:
-        with open(IPN_LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(json.dumps({"time": datetime.utcnow().isoformat(), "data": data}, ensure_ascii=False) + "\n")
-    except Exception:
-        traceback.print_exc()
+    # только постановка в очередь — диск не влияет на время ответа вебхука
+    ipn_log.write({"time": datetime.utcnow().isoformat(), "data": data})
+
+
+# -------------------------
+# Payment settlement (idempotent)
+# -------------------------
+class ProcessedInvoiceCache:
+    """Ограниченное множество уже проведённых invoice_id: дубликаты IPN отвечаются без обращения к БД."""
+
+    def __init__(self, capacity: int = PROCESSED_INVOICES_CACHE_SIZE):
+        self.capacity = capacity
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, invoice_id: str) -> bool:
+        with self._lock:
+            return invoice_id in self._ids
+
+    def add(self, invoice_id: str):
+        with self._lock:
+            self._ids[invoice_id] = None
+            self._ids.move_to_end(invoice_id)
+            while len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+
+processed_invoices = ProcessedInvoiceCache()
+
+def settle_invoice(inv: Dict[str, Any], amount: Any, asset: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Claim-then-settle в одной IMMEDIATE-транзакции: сначала INSERT OR IGNORE в processed_invoices,
+    затем проводка корзины/заказа. Конкурентные дубликаты сериализуются write-lock'ом,
+    видят уже вставленную строку и получают None — оплата проводится ровно один раз.
+    """
+    invoice_id = inv["invoice_id"]
+    with db.transaction() as cur:
+        cur.execute("INSERT OR IGNORE INTO processed_invoices (invoice_id, chat_id, order_id, cart_id, amount, asset, processed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (invoice_id, inv["chat_id"], inv["order_id"], inv["cart_id"], str(amount), asset, datetime.utcnow().isoformat()))
+        if cur.rowcount == 0:
+            return None
+        cart_orders = settle_cart(inv["cart_id"], inv["chat_id"], invoice_id, asset) if inv["cart_id"] else None
+        order_paid = mark_order_paid(inv["order_id"], asset) if inv["order_id"] else False
+        cur.execute("UPDATE invoices_map SET status = 'paid' WHERE invoice_id = ?", (invoice_id,))
+    return {"cart_orders": cart_orders, "order_paid": order_paid}
+
+def alert_admins(text: str):
+    for admin in ADMIN_IDS:
+        tg_payment.post("send_message", admin, text)
+
+def process_paid_invoice(invoice_id: str, amount: Any, asset: Optional[str]) -> str:
+    """
+    Проводит оплаченный инвойс и уведомляет пользователя.
+    Возвращает "settled", "duplicate", "unknown" (инвойса нет в invoices_map) или "unapplied" —
+    деньги получены, но корзина уже не открыта / заказ уже оплачен: оплата записана в processed_invoices,
+    администратор получает уведомление для ручного разбора.
+    """
+    if invoice_id in processed_invoices:
+        return "duplicate"
+    inv = get_invoice_mapping(invoice_id)
+    if not inv:
+        return "unknown"
+    result = settle_invoice(inv, amount, asset)
+    processed_invoices.add(invoice_id)
+    if result is None:
+        return "duplicate"
+
+    chat_id = inv["chat_id"]
+    order_id = inv["order_id"]
+    cart_id = inv["cart_id"]
+    if (cart_id and result["cart_orders"] is None) or (order_id and not result["order_paid"]):
+        target = f"корзина #{cart_id}" if cart_id else f"заказ #{order_id}"
+        alert_admins(f"⚠️ Оплата без проводки: инвойс {invoice_id}, {amount} {asset}, чат {chat_id}, {target} "
+                     f"уже не ожидает оплаты. Нужен ручной разбор (заказ вручную или возврат).")
+        tg_payment.post("send_message", chat_id, f"Оплата {amount} {asset} получена, но {target} уже не ожидает оплаты. "
+                        "Администратор свяжется с вами.", reply_markup=main_menu_markup())
+        return "unapplied"
+    # если это корзина — все позиции уже перенесены в orders
+    # подтверждения — без ожидания, в приоритетной полосе (повторы после 429 делает outbox)
+    if cart_id and result["cart_orders"] is not None:
+        tg_payment.post("send_message", chat_id, f"✅ Оплата корзины #{cart_id} на сумму {amount} {asset} получена!\nЗаказы будут выполнены в ближайшее время.", reply_markup=main_menu_markup())
+    # если это одиночный заказ
+    if order_id:
+        tg_payment.post("send_message", chat_id, f"✅ Оплата заказа #{order_id} ({amount} {asset}) подтверждена!\nЗаказ принят в работу.", reply_markup=main_menu_markup())
+    return "settled"
+
+# -------------------------
+# Invoice reconciliation (lost IPN)
+# -------------------------
+class InvoiceReconciler:
+    """
+    Подстраховка IPN: инвойсы из invoices_map без финального статуса проверяются пачками
+    по RECONCILE_BATCH одним getInvoices(invoice_ids=...) на пачку — до тех пор, пока API не вернёт
+    paid или expired (счёт создаётся с expires_in, см. INVOICE_TTL_HOURS).
+    Оплаченные проводятся тем же process_paid_invoice, что и IPN (дубль безопасен), истёкшие
+    помечаются и больше не опрашиваются.
+    Ожидающие обходятся по кругу от старых к новым окнами по RECONCILE_BATCH * 50 (курсор — ключ
+    последней строки окна), так что при любом хвосте каждый инвойс рано или поздно опрашивается.
+    Интервал: нет ожидающих — RECONCILE_IDLE_SEC (новый инвойс будит раньше, nudge());
+    чем больше ожидающих, тем ближе к RECONCILE_MIN_SEC; ошибки API — экспоненциальная пауза.
+    В prefork сверяет один процесс — владелец аренды в app_meta.
+    """
+
+    def __init__(self, client: CryptoPayClient, batch: int = RECONCILE_BATCH):
+        self.client = client
+        self.batch = batch
+        self.pending = 0
+        self._errors = 0
+        self._cursor: Optional[Tuple[str, str]] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[Thread] = None
+        self._stats = latency_stats("reconcile.run")
+        register_gauge("reconcile.pending", lambda: self.pending)
+
+    def next_interval(self, pending: int) -> float:
+        if pending == 0:
+            return RECONCILE_IDLE_SEC
+        load = min(1.0, pending / float(self.batch))
+        return RECONCILE_MAX_SEC - (RECONCILE_MAX_SEC - RECONCILE_MIN_SEC) * load
+
+    def run_once(self) -> float:
+        """Один проход сверки; возвращает паузу до следующего."""
+        if not acquire_lease("reconciler", RECONCILE_IDLE_SEC + RECONCILE_MAX_SEC):
+            return RECONCILE_MAX_SEC
+        window = self.batch * 50
+        rows = get_pending_invoice_ids(window, self._cursor)
+        if not rows and self._cursor is not None:
+            rows = get_pending_invoice_ids(window)
+        # неполное окно — хвост пройден, следующий проход снова с самых старых
+        self._cursor = rows[-1] if len(rows) == window else None
+        ids = [invoice_id for _, invoice_id in rows]
+        self.pending = len(ids)
+        if not ids:
+            return self.next_interval(0)
+        started = time.perf_counter()
+        settled, expired = 0, []
+        try:
+            for i in range(0, len(ids), self.batch):
+                for inv in self.client.get_invoices(ids[i:i + self.batch]):
+                    status = (inv["status"] or "").lower()
+                    if status == "paid":
+                        raw = inv["raw"]
+                        amount = raw.get("paid_amount") or inv["amount"]
+                        asset = raw.get("paid_asset") or inv["asset"]
+                        result = process_paid_invoice(inv["invoice_id"], amount, asset)
+                        if result in ("settled", "unapplied"):
+                            settled += 1
+                            log_ipn_event({"source": "reconciler", "invoice_id": inv["invoice_id"], "status": "paid",
+                                           "amount": amount, "asset": asset, "result": result})
+                    elif status == "expired":
+                        expired.append(inv["invoice_id"])
+        except CryptoPayError:
+            traceback.print_exc()
+            self._errors += 1
+            self._stats.observe((time.perf_counter() - started) * 1000, error=True)
+            return min(RECONCILE_IDLE_SEC, RECONCILE_MIN_SEC * 2 ** self._errors)
+        finally:
+            if expired:
+                set_invoices_status(expired, "expired")
+        self._errors = 0
+        self._stats.observe((time.perf_counter() - started) * 1000)
+        if settled:
+            print(f"[reconciler] settled {settled} invoice(s) missed by IPN")
+        self.pending = len(ids) - settled - len(expired)
+        return self.next_interval(self.pending)
+
+    def nudge(self):
+        """Появился новый инвойс — выйти из долгого ожидания."""
+        self._wake.set()
+
+    def _run(self):
+        interval = RECONCILE_MIN_SEC
+        while not self._stop.is_set():
+            if self._wake.wait(interval):
+                self._wake.clear()
+                # оплату только что созданного счёта раньше чем через MIN проверять незачем
+                if self._stop.wait(RECONCILE_MIN_SEC):
+                    return
+            if self._stop.is_set():
+                return
+            try:
+                interval = self.run_once()
+            except Exception:
+                traceback.print_exc()
+                interval = RECONCILE_MAX_SEC
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name="invoice-reconciler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+invoice_reconciler = register_background_service(InvoiceReconciler(cryptopay))
+
+# -------------------------
+# Maintenance (sweeper + incremental vacuum)
+# -------------------------
+def _ago(**delta) -> str:
+    return (datetime.utcnow() - timedelta(**delta)).isoformat()
+
+class MaintenanceScheduler:
+    """
+    Раз в SWEEP_INTERVAL_SEC (один процесс — по аренде):
+    - задачи очистки: каждая — пачки по SWEEP_BATCH строк, каждая пачка — своя короткая транзакция,
+      между пачками пауза SWEEP_PAUSE_SEC, чтобы писатели не ждали;
+    - затем PRAGMA incremental_vacuum шагами по VACUUM_STEP_PAGES страниц — освобождённые
+      страницы возвращаются ОС без долгой блокировки.
+    Отчёт последнего прохода (строки по задачам, байты) — в метрике maintenance.last и в логе.
+    """
+
+    def __init__(self, interval: float = SWEEP_INTERVAL_SEC, batch: int = SWEEP_BATCH, pause: float = SWEEP_PAUSE_SEC):
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self.last_report: Dict[str, Any] = {}
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[Thread] = None
+        register_gauge("maintenance.last", lambda: self.last_report)
+
+    def _batches(self, step: Callable[[sqlite3.Cursor], int]) -> int:
+        """Повторяет step (одна транзакция, не больше batch строк) пока он что-то делает."""
+        total = 0
+        while not self._stop.is_set():
+            with db.transaction() as cur:
+                n = step(cur)
+            total += n
+            if n < self.batch:
+                break
+            self._stop.wait(self.pause)
+        return total
+
+    def _ids(self, cur: sqlite3.Cursor, sql: str, params: tuple) -> List[Any]:
+        cur.execute(sql + " LIMIT ?", params + (self.batch,))
+        return [r[0] for r in cur.fetchall()]
+
+    def expire_carts(self, cur: sqlite3.Cursor) -> int:
+        # корзину с неоплаченным инвойсом не трогаем: оплата может прийти позже, settle_cart нужны её позиции
+        rows = cur.execute("""SELECT id, chat_id FROM carts c WHERE status = 'open' AND updated_at < ?
+                                  AND NOT EXISTS (SELECT 1 FROM invoices_map m WHERE m.cart_id = c.id AND m.status IS NULL)
+                              LIMIT ?""", (_ago(days=CART_TTL_DAYS), self.batch)).fetchall()
+        now = datetime.utcnow().isoformat()
+        for r in rows:
+            cur.execute("UPDATE carts SET status = 'expired', updated_at = ? WHERE id = ?", (now, r["id"]))
+            cur.execute("DELETE FROM cart_items WHERE cart_id = ?", (r["id"],))
+            _profile_changed(r["chat_id"])
+            db.after_commit(lambda cart_id=r["id"]: cart_repo.closed(cart_id))
+        return len(rows)
+
+    def prune_closed_carts(self, cur: sqlite3.Cursor) -> int:
+        # позиции оплаченных корзин уже перенесены в orders; на корзину может ссылаться только старый инвойс
+        ids = self._ids(cur, "SELECT id FROM carts WHERE status != 'open' AND updated_at < ?", (_ago(days=RETENTION_DAYS),))
+        cur.executemany("DELETE FROM cart_items WHERE cart_id = ?", [(i,) for i in ids])
+        cur.executemany("DELETE FROM carts WHERE id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    def expire_unpaid_orders(self, cur: sqlite3.Cursor) -> int:
+        ids = self._ids(cur, "SELECT id FROM orders WHERE status = 'awaiting_payment' AND created_at < ? ORDER BY id",
+                        (_ago(hours=ORDER_PAYMENT_TTL_HOURS),))
+        for order_id in ids:
+            set_order_status(order_id, "expired")   # вложенная транзакция — в той же пачке, вместе с rollup_daily
+        return len(ids)
+
+    def strip_invoice_payloads(self, cur: sqlite3.Cursor) -> int:
+        # статус инвойса (paid/expired) ставят только IPN и сверка по ответу API; у финальных raw_payload больше не нужен
+        ids = self._ids(cur, """SELECT invoice_id FROM invoices_map
+                                WHERE status IS NOT NULL AND raw_payload IS NOT NULL AND created_at < ?""",
+                        (_ago(hours=INVOICE_PAYLOAD_KEEP_HOURS),))
+        cur.executemany("UPDATE invoices_map SET raw_payload = NULL WHERE invoice_id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    def prune_invoices(self, cur: sqlite3.Cursor) -> int:
+        # оплаченные остаются в processed_invoices (идемпотентность IPN), сама привязка уже не нужна
+        ids = self._ids(cur, "SELECT invoice_id FROM invoices_map WHERE created_at < ? AND status IS NOT NULL",
+                        (_ago(days=RETENTION_DAYS),))
+        cur.executemany("DELETE FROM invoices_map WHERE invoice_id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    def prune_payment_jobs(self, cur: sqlite3.Cursor) -> int:
+        ids = self._ids(cur, "SELECT id FROM payment_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                        (_ago(days=RETENTION_DAYS),))
+        cur.executemany("DELETE FROM payment_jobs WHERE id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    def prune_conversation_state(self, cur: sqlite3.Cursor) -> int:
+        cur.execute("""DELETE FROM conversation_state WHERE rowid IN (
+                           SELECT rowid FROM conversation_state WHERE expires_at < ? LIMIT ?)""", (time.time(), self.batch))
+        return cur.rowcount
 
+    def vacuum(self) -> Dict[str, int]:
+        """incremental_vacuum шагами; каждый шаг — отдельная короткая запись."""
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:   # 2 = INCREMENTAL
+            print("[maintenance] auto_vacuum is not INCREMENTAL, freed pages stay in the file: "
+                  "stop the bot and run `python SaleTest.py vacuum` once")
+            return {"freed_bytes": 0, "free_pages_left": db.execute("PRAGMA freelist_count").fetchone()[0]}
+        before = free = db.execute("PRAGMA freelist_count").fetchone()[0]
+        while free and not self._stop.is_set():
+            # через execute() модуль sqlite3 делает один sqlite3_step — освобождается одна страница; executescript дорабатывает до конца
+            db.connection().executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})")
+            left = db.execute("PRAGMA freelist_count").fetchone()[0]
+            if left >= free:
+                break
+            free = left
+            self._stop.wait(self.pause)
+        return {"freed_bytes": (before - free) * page_size, "free_pages_left": free}
+
+    def run_once(self) -> Dict[str, Any]:
+        if not acquire_lease("maintenance", self.interval * 2):
+            return {}
+        started = time.perf_counter()
+        report: Dict[str, Any] = {"at": datetime.utcnow().isoformat(), "rows": {}}
+        # корзина с инвойсом без финального статуса не истекает: пока API не сообщил expired, его ещё могут оплатить
+        for task in (self.strip_invoice_payloads, self.expire_carts, self.prune_closed_carts, self.expire_unpaid_orders,
+                     self.prune_invoices, self.prune_payment_jobs, self.prune_conversation_state):
+            try:
+                report["rows"][task.__name__] = self._batches(task)
+            except Exception:
+                traceback.print_exc()
+                report["rows"][task.__name__] = None
+        try:
+            db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+            report.update(self.vacuum())
+            report["db_bytes"] = os.path.getsize(DB_FILE)
+        except Exception:
+            traceback.print_exc()
+        report["took_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self.last_report = report
+        print(f"[maintenance] {report}")
+        return report
+
+    def _run(self):
+        # первый проход — не в момент старта, когда и так много работы
+        while not self._stop.wait(min(60.0, self.interval)):
+            try:
+                self.run_once()
+            except Exception:
+                traceback.print_exc()
+            if self._stop.wait(max(0.0, self.interval - 60.0)):
+                return
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name="maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+maintenance = register_background_service(MaintenanceScheduler())
+
+# -------------------------
+# Archival (hot/cold)
+# -------------------------
+class ArchiveMover:
+    """
+    Раз в ARCHIVE_INTERVAL_SEC (один процесс — по аренде) переносит в архивный файл строки старше ARCHIVE_AFTER_DAYS:
+    - заказы в финальном статусе (paid, expired);
+    - закрытые обращения вместе с их сообщениями.
+    Пачка из ARCHIVE_BATCH строк — одна транзакция: INSERT OR REPLACE в архив и DELETE из основной БД,
+    так что читатели не видят промежуточного состояния, а строка не меняется между копированием и удалением.
+    В WAL коммит через ATTACH атомарен для каждого файла, но не для обоих сразу: файлы фиксируются по порядку схем,
+    main — первым. Поэтому переносим на отдельном соединении, где main — архив, а основная БД подключена как live:
+    сбой посреди коммита оставит дубль (all_* его не покажут, следующий проход перезапишет и удалит), но не потерю.
+    rollup_daily, support_stats и счётчики AUTOINCREMENT остаются в основной БД — id не переиспользуются.
+    Освободившиеся страницы основной БД возвращает incremental_vacuum в MaintenanceScheduler.
+    """
+
+    ORDER_STATUSES = ("paid", "expired")
+
+    def __init__(self, interval: float = ARCHIVE_INTERVAL_SEC, batch: int = ARCHIVE_BATCH, pause: float = SWEEP_PAUSE_SEC):
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self.last_report: Dict[str, Any] = {}
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[Thread] = None
+        register_gauge("archive.last", lambda: self.last_report)
+
+    def _connect(self) -> sqlite3.Connection:
+        db.connection()   # схема архива синхронизирована attach_archive
+        conn = sqlite3.connect(ARCHIVE_DB_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("ATTACH DATABASE ? AS live", (DB_FILE,))
+        return conn
+
+    def _move(self, conn: sqlite3.Connection, table: str, where: str, params: tuple,
+              children: Tuple[Tuple[str, str], ...] = ()) -> int:
+        """Одна пачка: table по id, children — (таблица, колонка-ссылка на id). Возвращает число перенесённых строк table."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = [r[0] for r in conn.execute(f"SELECT id FROM live.{table} WHERE {where} ORDER BY id LIMIT ?", params + (self.batch,))]
+            if ids:
+                marks = ", ".join("?" * len(ids))
+                for tbl, key in ((table, "id"),) + children:
+                    cols = ", ".join(r[1] for r in conn.execute(f"PRAGMA live.table_info({tbl})"))
+                    conn.execute(f"INSERT OR REPLACE INTO main.{tbl} ({cols}) SELECT {cols} FROM live.{tbl} WHERE {key} IN ({marks})", ids)
+                    conn.execute(f"DELETE FROM live.{tbl} WHERE {key} IN ({marks})", ids)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(ids)
+
+    def _drain(self, *args, **kwargs) -> int:
+        total = 0
+        while not self._stop.is_set():
+            n = self._move(*args, **kwargs)
+            total += n
+            if n < self.batch:
+                break
+            self._stop.wait(self.pause)
+        return total
+
+    def run_once(self) -> Dict[str, Any]:
+        if ARCHIVE_DB_FILE == "off" or not acquire_lease("archive", self.interval * 2):
+            return {}
+        started = time.perf_counter()
+        cutoff = _ago(days=ARCHIVE_AFTER_DAYS)
+        statuses = ", ".join("?" * len(self.ORDER_STATUSES))
+        report: Dict[str, Any] = {"at": datetime.utcnow().isoformat(), "cutoff": cutoff}
+        conn = self._connect()
+        try:
+            report["orders"] = self._drain(conn, "orders", f"status IN ({statuses}) AND created_at < ?", self.ORDER_STATUSES + (cutoff,))
+            report["support_requests"] = self._drain(conn, "support_requests", "status = 'closed' AND created_at < ?", (cutoff,),
+                                                     children=(("support_messages", "req_id"),))
+        finally:
+            conn.close()
+        report["took_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self.last_report = report
+        print(f"[archive] {report}")
+        return report
+
+    def _run(self):
+        while not self._stop.wait(min(120.0, self.interval)):
+            try:
+                self.run_once()
+            except Exception:
+                traceback.print_exc()
+            if self._stop.wait(max(0.0, self.interval - 120.0)):
+                return
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name="archive", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+archiver = register_background_service(ArchiveMover())
 
 # -------------------------
 # Payment confirmation (IPN endpoint)
 # -------------------------
+def handle_ipn(payload: Any) -> Tuple[Dict[str, Any], int]:
+    """
+    Разбор и проведение уведомления CryptoBot: (тело ответа, HTTP-код).
+    Повторные доставки одного инвойса безопасны — см. process_paid_invoice.
+    """
+    log_ipn_event(payload)
+
+    if not isinstance(payload, dict):
+        return {"ok": False, "error": "Invalid JSON"}, 400
+
+    status = payload.get("status")
+    invoice_id = str(payload.get("invoice_id") or payload.get("invoiceId") or "")
+    amount = float(payload.get("amount", 0))
+    asset = payload.get("asset")
+
+    # Нам важны invoice_id и status == "paid"
+    if not invoice_id:
+        return {"ok": False, "error": "Missing invoice_id"}, 400
+
+    if status and status.lower() == "paid":
+        result = process_paid_invoice(invoice_id, amount, asset)
+        if result == "unknown":
+            return {"ok": False, "error": "Unknown invoice"}, 404
+        if result == "duplicate":
+            return {"ok": True, "duplicate": True}, 200
+
+    return {"ok": True}, 200
+
 @app.route("/cryptobot/ipn", methods=["POST"])
 def cryptobot_ipn():
     """
     Обработчик уведомлений от CryptoBot.
     Приходит JSON с данными инвойса и статусом.
+    В HTTP-воркере prefork уведомление только сохраняется в inbox — проводит его бот-процесс.
     """
     try:
-        payload = request.get_json(force=True)
-        log_ipn_event(payload)
-
-        if not isinstance(payload, dict):
-            return jsonify({"ok": False, "error": "Invalid JSON"}), 400
-
-        status = payload.get("status")
-        invoice_id = str(payload.get("invoice_id") or payload.get("invoiceId") or "")
-        amount = float(payload.get("amount", 0))
-        asset = payload.get("asset")
-        payload_str = str(payload.get("payload", ""))
-
-        # Нам важны invoice_id и status == "paid"
-        if not invoice_id:
-            return jsonify({"ok": False, "error": "Missing invoice_id"}), 400
-
-        if status and status.lower() == "paid":
-            # Найдём invoice_id в базе
-            conn = get_db()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM invoices_map WHERE invoice_id = ?", (invoice_id,))
-            inv = cur.fetchone()
-            conn.close()
+        if inbox.forward:
+            inbox.put("ipn", request.get_data(as_text=True))
+            return jsonify({"ok": True})
+        body, code = handle_ipn(request.get_json(force=True))
+        return jsonify(body), code
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+# -------------------------
+# Webhook ingestion for Telegram updates
+# -------------------------
+def _update_chat_id(update: telebot.types.Update) -> int:
+    for attr in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = getattr(update, attr, None)
+        if msg is not None:
+            return msg.chat.id
+    cq = getattr(update, "callback_query", None)
+    if cq is not None:
+        return cq.message.chat.id if cq.message is not None else cq.from_user.id
+    for attr in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query", "my_chat_member", "chat_member", "chat_join_request"):
+        obj = getattr(update, attr, None)
+        if obj is not None and getattr(obj, "from_user", None) is not None:
+            return obj.from_user.id
+    return update.update_id
+
+class UpdateDispatcher:
+    """
+    Приём апдейтов без ожидания обработчиков: webhook только ставит апдейт в очередь.
+    У каждого из N воркеров своя очередь, чат закреплён за воркером по chat_id % N —
+    апдейты одного чата обрабатываются строго по порядку, разных чатов — параллельно.
+    Метрики: updates.queue_depth, updates.lag (приём -> начало обработки), updates.handle.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, max_queue: int = UPDATE_QUEUE_MAX):
+        self.workers = workers
+        self._queues: List["queue.Queue[Any]"] = [queue.Queue(maxsize=max_queue) for _ in range(workers)]
+        self._threads: List[Thread] = []
+        self._start_lock = threading.Lock()
+        self._lag = latency_stats("updates.lag")
+        self._handle = latency_stats("updates.handle")
+        register_gauge("updates.queue_depth", self.depth)
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def drain(self, timeout: float) -> bool:
+        """Ждёт, пока воркеры разберут очереди (при остановке процесса)."""
+        deadline = time.monotonic() + timeout
+        while any(q.unfinished_tasks for q in self._queues):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def start(self):
+        with self._start_lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if self._threads:
+                return
+            for i, q in enumerate(self._queues):
+                t = Thread(target=self._run, args=(q,), name=f"update-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, update: telebot.types.Update) -> bool:
+        """False — очередь воркера переполнена (вебхук отвечает ошибкой, Telegram доставит апдейт повторно)."""
+        self.start()
+        q = self._queues[_update_chat_id(update) % self.workers]
+        try:
+            q.put_nowait((time.perf_counter(), update))
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self, q: "queue.Queue[Any]"):
+        while True:
+            received, update = q.get()
+            started = time.perf_counter()
+            self._lag.observe((started - received) * 1000)
+            failed = False
+            try:
+                bot.process_new_updates([update])
+            except Exception:
+                failed = True
+                traceback.print_exc()
+            self._handle.observe((time.perf_counter() - started) * 1000, error=failed)
+            q.task_done()
 
-            if not inv:
-                return jsonify({"ok": False, "error": "Unknown invoice"}), 404
+update_dispatcher = UpdateDispatcher()
 
-            chat_id = inv["chat_id"]
-            order_id = inv["order_id"]
-            cart_id = inv["cart_id"]
+class UpdateInbox:
+    """
+    prefork: HTTP-воркеры не обрабатывают апдейты и IPN сами — только записывают их в таблицу inbox
+    (ответ 200 — после коммита) и будят бот-процесс байтом в общий pipe.
+    Единственный бот-процесс (аренда 'inbox') разбирает inbox по порядку id: апдейты — в свой
+    UpdateDispatcher (порядок внутри чата сохраняется), IPN — handle_ipn. Поэтому очереди чатов,
+    лимиты Telegram, склейка уведомлений операторам и прочие фоновые службы — в одном экземпляре.
+    Метрика: inbox.lag (приём воркером -> передача в обработку).
+    """
+
+    def __init__(self, batch: int = INBOX_BATCH, poll: float = INBOX_POLL_SEC, lease_ttl: float = INBOX_LEASE_SEC):
+        self.batch = batch
+        self.poll = poll
+        self.lease_ttl = lease_ttl
+        self.forward = False    # True в HTTP-воркерах prefork
+        self.on_lease: Optional[Callable[[], Any]] = None  # вызывается, когда процесс впервые получил аренду
+        self._wake_r: Optional[int] = None
+        self._wake_w: Optional[int] = None
+        self._stop = threading.Event()
+        self._paused = threading.Event()
+        self._thread: Optional[Thread] = None
+        self._lag = latency_stats("inbox.lag")
+
+    def open_wake_pipe(self):
+        """В мастере до fork: pipe наследуют и воркеры, и бот-процесс."""
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)   # байт может забрать бот-процесс старого поколения
+        os.set_blocking(self._wake_w, False)
+
+    def put(self, kind: str, payload: str):
+        with db.transaction() as cur:
+            cur.execute("INSERT INTO inbox (kind, payload, received_at) VALUES (?, ?, ?)", (kind, payload, time.time()))
+        if self._wake_w is not None:
+            try:
+                os.write(self._wake_w, b"\0")
+            except BlockingIOError:
+                pass    # pipe полон — бот-процесс и так не спит
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name="inbox", daemon=True)
+            self._thread.start()
+
+    def pause(self):
+        """Перестаёт брать новое, но продолжает продлевать аренду — пока процесс дорабатывает начатое."""
+        self._paused.set()
+
+    def stop(self, timeout: float = 5.0):
+        """Останавливает поток; аренду отдаёт вызывающий (release_lease) — когда начатое доработано."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _wait(self, timeout: float):
+        if self._wake_r is None:
+            self._stop.wait(timeout)
+            return
+        if select.select([self._wake_r], [], [], timeout)[0]:
+            try:
+                os.read(self._wake_r, 4096)
+            except BlockingIOError:
+                pass
+
+    def _run(self):
+        renew_at, holding = 0.0, False
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() >= renew_at:
+                    if not acquire_lease("inbox", self.lease_ttl):
+                        self._stop.wait(1.0)    # бот-процесс прошлого поколения ещё дорабатывает
+                        continue
+                    renew_at = time.monotonic() + self.lease_ttl / 3
+                    if not holding:
+                        holding = True
+                        if self.on_lease is not None:
+                            self.on_lease()
+                if self._paused.is_set():
+                    self._stop.wait(1.0)
+                    continue
+                taken, blocked = self._consume()
+                if blocked:
+                    self._stop.wait(0.05)
+                elif taken < self.batch:
+                    self._wait(self.poll)
+            except Exception:
+                traceback.print_exc()
+                self._stop.wait(1.0)
 
-            # если это корзина — закрываем все позиции
-            if cart_id:
+    def _consume(self) -> Tuple[int, bool]:
+        rows = db.execute("SELECT id, kind, payload, received_at FROM inbox ORDER BY id LIMIT ?", (self.batch,)).fetchall()
+        done, blocked = None, False
+        for r in rows:
+            if r["kind"] == "update":
                 try:
-                    items = get_cart_items(cart_id)
-                    for it in items:
-                        create_order_from_cart_item(chat_id, it, status="paid")
-                    mark_cart_paid(cart_id)
-                    try:
-                        bot.send_message(chat_id, f"✅ Оплата корзины #{cart_id} на сумму {amount} {asset} получена!\nЗаказы будут выполнены в ближайшее время.", reply_markup=main_menu_markup())
-                    except Exception:
-                        pass
+                    update = telebot.types.Update.de_json(r["payload"])
                 except Exception:
                     traceback.print_exc()
-
-            # если это одиночный заказ
-            if order_id:
-                conn = get_db()
-                cur = conn.cursor()
-                cur.execute("UPDATE orders SET status = 'paid', updated_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), order_id))
-                conn.commit()
-                conn.close()
+                    update = None
+                if update is not None and not update_dispatcher.submit(update):
+                    blocked = True  # очередь воркера полна — остаток подождёт в inbox
+                    break
+            else:
                 try:
-                    bot.send_message(chat_id, f"✅ Оплата заказа #{order_id} ({amount} {asset}) подтверждена!\nЗаказ принят в работу.", reply_markup=main_menu_markup())
+                    handle_ipn(json.loads(r["payload"]))
                 except Exception:
-                    pass
+                    # оплаченный инвойс, не проведённый здесь, доведёт InvoiceReconciler
+                    traceback.print_exc()
+            self._lag.observe((time.time() - r["received_at"]) * 1000)
+            done = r["id"]
+        if done is not None:
+            with db.transaction() as cur:
+                cur.execute("DELETE FROM inbox WHERE id <= ?", (done,))
+        return len(rows), blocked
 
-        return jsonify({"ok": True})
-    except Exception as e:
-        traceback.print_exc()
-        return jsonify({"ok": False, "error": str(e)}), 500
+inbox = UpdateInbox()
 
+def publish_metrics():
+    """Бот-процесс prefork: снимок метрик в app_meta — его отдаёт /metrics любого HTTP-воркера."""
+    with db.transaction() as cur:
+        cur.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('metrics:bot', ?)",
+                    (json.dumps(metrics_snapshot(), ensure_ascii=False),))
 
-# -------------------------
-# Webhook route for Telegram updates
-# -------------------------
 @app.route(f"/{BOT_TOKEN}", methods=["POST"])
 def webhook_update():
+    if inbox.forward:
+        inbox.put("update", request.get_data(as_text=True))
+        return "ok", 200
     try:
-        update = request.get_data().decode("utf-8")
-        bot.process_new_updates([telebot.types.Update.de_json(update)])
+        update = telebot.types.Update.de_json(request.get_data().decode("utf-8"))
     except Exception:
         traceback.print_exc()
+        return "ok", 200
+    if not update_dispatcher.submit(update):
+        return "busy", 503
     return "ok", 200
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not METRICS_TOKEN or not hmac.compare_digest(request.args.get("token", "").encode(), METRICS_TOKEN.encode()):
+        return "forbidden", 403
+    if inbox.forward:
+        r = db.execute("SELECT value FROM app_meta WHERE key = 'metrics:bot'").fetchone()
+        return jsonify({"worker": metrics_snapshot(), "bot": json.loads(r["value"]) if r else None})
+    return jsonify(metrics_snapshot())
+
+
 @app.route("/", methods=["GET", "HEAD"])
 def index():
     return "SaleTest bot alive.", 200
@@ -1221,16 +4281,184 @@ def run_polling():
     bot.infinity_polling(timeout=60, long_polling_timeout=20)
 
 
+# -------------------------
+# Production serving (prefork)
+# -------------------------
+def _prefork_worker(sock: socket.socket, index: int) -> int:
+    """
+    HTTP-воркер: своё соединение с БД, общий слушающий сокет. Апдейты и IPN только пишет в inbox,
+    фоновых служб не запускает — они живут в бот-процессе (_prefork_bot).
+    SIGTERM — перестать принимать соединения, дождаться текущих запросов, выйти.
+    """
+    srv = make_server("0.0.0.0", PORT, app, threaded=True, fd=sock.fileno())
+    srv.socket.setblocking(False)   # несколько процессов в accept(): проигравший не должен зависнуть
+    srv.daemon_threads = False      # server_close() дождётся запросов в работе
+
+    def _on_term(signum, frame):
+        Thread(target=srv.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _on_term)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    inbox.forward = True
+    print(f"[worker {index} pid {os.getpid()}] serving on port {PORT}")
+    try:
+        srv.serve_forever()
+    finally:
+        srv.server_close()
+    return 0
+
+def _prefork_bot() -> int:
+    """
+    Бот-процесс: без HTTP, разбирает inbox и держит единственные экземпляры UpdateDispatcher,
+    TelegramOutbox, OperatorNotifier, KnownUsers, RateCache и остальных фоновых служб.
+    SIGTERM — перестать брать новое из inbox, доработать очередь апдейтов и задачи счетов, отдать аренду inbox.
+    Её ждёт бот-процесс нового поколения: так порядок внутри чата сохраняется и при перезагрузке, а его
+    payment_jobs.recover() (при получении аренды) не вернёт в очередь задачу, которую ещё выполняет старый.
+    Не успели за DRAIN_TIMEOUT_SEC — аренда не отдаётся: мастер добьёт процесс, она истечёт сама.
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    inbox.on_lease = payment_jobs.recover
+    start_background_services()
+    inbox.start()
+    print(f"[bot pid {os.getpid()}] consuming inbox")
+    while not stop.wait(METRICS_PUBLISH_SEC):
+        try:
+            publish_metrics()
+        except Exception:
+            traceback.print_exc()
+    inbox.pause()
+    drained = update_dispatcher.drain(DRAIN_TIMEOUT_SEC) and payment_jobs.stop(DRAIN_TIMEOUT_SEC)
+    inbox.stop()
+    if drained:
+        release_lease("inbox")
+    stop_background_services()  # в т.ч. outbox и ipn_log.close()
+    return 0
+
+def serve_prefork(workers: int = WEB_WORKERS):
+    """
+    Мастер-процесс: модуль уже импортирован (init_db, операторы, TeleBot — один раз здесь),
+    открывает сокет и форкает N готовых HTTP-воркеров, которые делят его, и один бот-процесс (индекс -1).
+    - упавший воркер перезапускается
+    - SIGHUP: плавная перезагрузка — новое поколение воркеров, старым SIGTERM (дорабатывают текущие запросы)
+    - SIGTERM / SIGINT: остановка с ожиданием воркеров до DRAIN_TIMEOUT_SEC
+    """
+    sock = socket.create_server(("0.0.0.0", PORT), backlog=2048)
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    inbox.open_wake_pipe()
+    db.close()  # соединение мастера не должно попасть в воркеры
+    children: Dict[int, int] = {}   # pid -> index (-1 — бот-процесс)
+    retiring: Dict[int, float] = {}  # pid -> когда отправлен SIGTERM
+    flags = {"stop": False, "reload": False}
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = _prefork_bot() if index < 0 else _prefork_worker(sock, index)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def _on_stop(signum, frame):
+        flags["stop"] = True
+
+    def _on_reload(signum, frame):
+        flags["reload"] = True
+
+    signal.signal(signal.SIGTERM, _on_stop)
+    signal.signal(signal.SIGINT, _on_stop)
+    signal.signal(signal.SIGHUP, _on_reload)
+
+    for i in range(-1, workers):
+        spawn(i)
+    print(f"[master pid {os.getpid()}] {workers} workers + bot process on port {PORT}")
+
+    while not flags["stop"]:
+        if flags["reload"]:
+            flags["reload"] = False
+            old = dict(children)
+            children.clear()
+            for i in range(-1, workers):
+                spawn(i)
+            for pid in old:
+                retiring[pid] = time.monotonic()
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            print(f"[master] reloaded, {len(old)} old workers draining")
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid and pid in children:
+            index = children.pop(pid)
+            print(f"[master] worker {index} (pid {pid}) exited with {status}, restarting")
+            time.sleep(1)
+            spawn(index)
+        elif pid:
+            retiring.pop(pid, None)
+        # старое поколение, не уложившееся в DRAIN_TIMEOUT_SEC, добиваем
+        for rpid, since in list(retiring.items()):
+            if time.monotonic() - since > DRAIN_TIMEOUT_SEC:
+                try:
+                    os.kill(rpid, signal.SIGKILL)
+                except ProcessLookupError:
+                    retiring.pop(rpid, None)
+        if not pid:
+            time.sleep(0.2)
+
+    print("[master] stopping, draining workers...")
+    for pid in list(children) + list(retiring):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + DRAIN_TIMEOUT_SEC
+    while time.monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if not pid:
+            time.sleep(0.1)
+    for pid in list(children) + list(retiring):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    sock.close()
+
 # -------------------------
 # Flask launcher
 # -------------------------
 if __name__ == "__main__":
+    if sys.argv[1:] == ["vacuum"]:
+        vacuum_db()
+        sys.exit(0)
     try:
         if USE_WEBHOOK:
             setup_webhook()
-            print("Starting Flask webhook server on port 10000...")
-            app.run(host="0.0.0.0", port=10000)
+            if SERVE_MODE == "prefork":
+                serve_prefork()
+            else:
+                payment_jobs.recover()
+                start_background_services()
+                print(f"Starting Flask webhook server on port {PORT}...")
+                app.run(host="0.0.0.0", port=PORT)
         else:
+            payment_jobs.recover()
+            start_background_services()
             run_polling()
     except KeyboardInterrupt:
         print("Bot stopped manually.")
@@ -0,0 +1,25 @@
+"""Общая подготовка бенчмарков: SaleTest импортируется с БД и логами во временном каталоге."""
+import os
+import sys
+import tempfile
+import time
+
+TMP_DIR = tempfile.mkdtemp(prefix="saletest-bench-")
+os.environ.setdefault("DB_FILE", os.path.join(TMP_DIR, "bench.sqlite"))
+os.environ.setdefault("IPN_LOG_FILE", os.path.join(TMP_DIR, "ipn_log.jsonl"))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_app():
+    """Модуль бота; импорт после настройки окружения выше."""
+    import SaleTest
+    return SaleTest
+
+
+def per_call_ms(fn, reps: int) -> float:
+    """Среднее время одного вызова fn() в миллисекундах."""
+    started = time.perf_counter()
+    for _ in range(reps):
+        fn()
+    return (time.perf_counter() - started) / reps * 1000
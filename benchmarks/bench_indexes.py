@@ -0,0 +1,79 @@
+"""
+user-002: время горячих запросов до и после индексов миграции 2 при росте orders.
+Запуск: python benchmarks/bench_indexes.py [--max-rows 10000000]
+Остальные таблицы растут пропорционально orders (корзин — 1/5, обращений — 1/20).
+"""
+import argparse
+import os
+import random
+import sqlite3
+
+from _common import TMP_DIR, load_app, per_call_ms
+
+S = load_app()
+
+QUERIES = {
+    "open cart": ("SELECT id FROM carts WHERE chat_id = ? AND status = 'open' ORDER BY id DESC LIMIT 1", "chat"),
+    "cart items": ("SELECT * FROM cart_items WHERE cart_id = ?", "cart"),
+    "user orders": ("SELECT * FROM orders WHERE chat_id = ? ORDER BY id DESC LIMIT 10", "chat"),
+    "open requests": ("SELECT * FROM support_requests WHERE status = 'open' ORDER BY id LIMIT 20", None),
+    "request messages": ("SELECT * FROM support_messages WHERE req_id = ? ORDER BY id", "req"),
+}
+
+
+def fill(conn: sqlite3.Connection, orders: int):
+    users, carts, requests_ = max(1000, orders // 20), orders // 5, orders // 20
+    now = "2025-01-01T00:00:00"
+    rnd = random.Random(orders)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO orders (chat_id, social, service_key, amount, price_usd, link, status, created_at, updated_at) VALUES (?, 'TikTok', 'sub', 100, 1.5, 'https://t/x', 'paid', ?, ?)",
+                     ((rnd.randrange(users), now, now) for _ in range(orders)))
+    conn.executemany("INSERT INTO carts (chat_id, status, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                     ((rnd.randrange(users), "open" if rnd.random() < 0.05 else "paid", now, now) for _ in range(carts)))
+    conn.executemany("INSERT INTO cart_items (cart_id, social, service_key, amount, price_usd, link, created_at) VALUES (?, 'TikTok', 'sub', 100, 1.5, 'https://t/x', ?)",
+                     ((rnd.randrange(1, carts + 1), now) for _ in range(carts * 3)))
+    conn.executemany("INSERT INTO support_requests (user_chat, username, text, status, created_at) VALUES (?, 'u', 'help', ?, ?)",
+                     ((rnd.randrange(users), "open" if rnd.random() < 0.01 else "closed", now) for _ in range(requests_)))
+    conn.executemany("INSERT INTO support_messages (req_id, from_chat, to_chat, text, created_at) VALUES (?, 1, 2, 'msg', ?)",
+                     ((rnd.randrange(1, requests_ + 1), now) for _ in range(requests_ * 4)))
+    conn.commit()
+    return {"chat": users, "cart": carts, "req": requests_}
+
+
+def measure(conn: sqlite3.Connection, bounds, reps: int):
+    out = {}
+    for name, (sql, param) in QUERIES.items():
+        def run():
+            conn.execute(sql, (random.randrange(1, bounds[param] + 1),) if param else ()).fetchall()
+        out[name] = per_call_ms(run, reps)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+    sizes = [n for n in (10_000, 100_000, 1_000_000, 10_000_000) if n <= args.max_rows]
+    print(f"{'orders':>10}  {'query':<17} {'no index, ms':>13} {'migration 2, ms':>16}")
+    for n in sizes:
+        path = os.path.join(TMP_DIR, f"idx_{n}.sqlite")
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        for stmt in S._SCHEMA_V1:
+            conn.execute(stmt)
+        bounds = fill(conn, n)
+        # полный скан 10M строк — секунды на запрос, повторов меньше
+        before = measure(conn, bounds, reps=max(2, 200_000 // n))
+        for stmt in S._SCHEMA_V2:
+            conn.execute(stmt)
+        conn.execute("ANALYZE")
+        after = measure(conn, bounds, reps=2000)
+        for name in QUERIES:
+            print(f"{n:>10}  {name:<17} {before[name]:>13.3f} {after[name]:>16.4f}", flush=True)
+        conn.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
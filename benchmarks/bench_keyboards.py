@@ -0,0 +1,28 @@
+"""
+user-008: стоимость клавиатуры на один callback — сборка InlineKeyboardMarkup и сериализация
+на каждый клик (до) против готовой PrebuiltMarkup из CatalogViews (после).
+Запуск: python benchmarks/bench_keyboards.py
+"""
+from _common import load_app, per_call_ms
+
+S = load_app()
+
+REPS = 20000
+
+
+def main():
+    social = next(iter(S.SERVICES))
+    cases = [
+        ("main menu", S.build_main_menu_markup, S.main_menu_markup),
+        ("socials", S.build_shop_socials_markup, S.shop_socials_markup),
+        (f"services ({social})", lambda: S.build_services_markup(social), lambda: S.services_markup_for_social(social)),
+    ]
+    print(f"{'keyboard':<24} {'build+json, us':>15} {'prebuilt, us':>13}")
+    for name, build, prebuilt in cases:
+        before = per_call_ms(lambda: build().to_json(), REPS) * 1000
+        after = per_call_ms(lambda: prebuilt().to_json(), REPS) * 1000
+        print(f"{name:<24} {before:>15.2f} {after:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+user-005: время рендера и размер PNG одного QR до (qrcode.make + PNG по умолчанию) и после
+(_render_qr_png: минимальная версия, коррекция L, 1-битный PNG; повтор ссылки — из кэша QRRenderer).
+Запуск: python benchmarks/bench_qr.py
+"""
+import io
+
+import qrcode
+
+from _common import load_app, per_call_ms
+
+S = load_app()
+
+URLS = [f"https://t.me/CryptoBot?start=IV{n:012d}" for n in range(200)]
+
+
+def legacy_qr_bytes(url: str) -> bytes:
+    # прежний generate_qr_bytes
+    img = qrcode.make(url)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def bench(name: str, render):
+    it = iter(URLS * 10)
+    ms = per_call_ms(lambda: render(next(it)), len(URLS))
+    size = sum(len(render(u)) for u in URLS[:20]) / 20
+    print(f"{name:<32} {ms:>8.3f} ms/QR {size:>8.0f} bytes/QR")
+
+
+def main():
+    bench("qrcode.make (before)", legacy_qr_bytes)
+    bench("_render_qr_png (after)", S._render_qr_png)
+    renderer = S.QRRenderer(mode="inline", cache_size=len(URLS))
+    for u in URLS:
+        renderer.render(u)
+    bench("QRRenderer, cached pay_url", renderer.render)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+user-009: проводка оплаченной корзины в зависимости от её размера — по заказу на позицию
+с отдельными коммитами (до) против settle_cart одной транзакцией с INSERT ... SELECT (после).
+Запуск: python benchmarks/bench_settlement.py
+"""
+import itertools
+import time
+
+from _common import load_app
+
+S = load_app()
+
+SIZES = (1, 5, 10, 30, 100)
+ROUNDS = 20
+_chat_ids = itertools.count(900001)
+
+
+def make_cart(items: int):
+    chat_id = next(_chat_ids)
+    cart_id = S.get_or_create_cart(chat_id)
+    for i in range(items):
+        S.add_item_to_cart(cart_id, "TikTok", "sub", 100 + i, f"https://tiktok.com/@u{i}", (100 + i) * S.SERVICES["TikTok"]["sub"]["price_usd_per_unit"])
+    return chat_id, cart_id
+
+
+def per_item_commits(chat_id: int, cart_id: int):
+    # прежний путь cryptobot_ipn
+    for item in S.get_cart_items(cart_id):
+        S.create_order_from_cart_item(chat_id, item, status="paid")
+    S.mark_cart_paid(cart_id)
+
+
+def bulk(chat_id: int, cart_id: int):
+    S.settle_cart(cart_id, chat_id, "bench-invoice", "USDT")
+
+
+def timed(settle, items: int) -> float:
+    total = 0.0
+    for _ in range(ROUNDS):
+        chat_id, cart_id = make_cart(items)
+        started = time.perf_counter()
+        settle(chat_id, cart_id)
+        total += time.perf_counter() - started
+    return total / ROUNDS * 1000
+
+
+def main():
+    print(f"{'items':>6} {'per-item commits, ms':>21} {'settle_cart, ms':>16}")
+    for n in SIZES:
+        print(f"{n:>6} {timed(per_item_commits, n):>21.2f} {timed(bulk, n):>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
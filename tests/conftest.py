@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# SaleTest при импорте открывает БД и читает конфиг из окружения — всё во временный каталог
+_tmp = tempfile.mkdtemp(prefix="saletest-")
+os.environ.setdefault("DB_FILE", os.path.join(_tmp, "test.sqlite"))
+os.environ.setdefault("IPN_LOG_FILE", os.path.join(_tmp, "ipn_log.jsonl"))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import SaleTest  # noqa: E402
+
+
+class SentMessages:
+    """Подмена OutboxLane: вместо Telegram запоминает отправленное."""
+
+    def __init__(self):
+        self.calls = []
+
+    def post(self, method, *args, **kwargs):
+        self.calls.append((method, args, kwargs))
+
+    def to(self, chat_id):
+        return [c for c in self.calls if c[1] and c[1][0] == chat_id]
+
+
+@pytest.fixture
+def app():
+    return SaleTest
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    box = SentMessages()
+    monkeypatch.setattr(SaleTest, "tg_payment", box)
+    return box
+
+
+class FakeCryptoPay:
+    """
+    Локальный Crypto Pay API для CryptoPayClient(base_url=...).
+    script — ответы на следующие запросы по порядку: "503", "429", "abort" (обрыв без ответа),
+    "null" (ok с result: null); когда script пуст — обычная обработка createInvoice / getInvoices.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.script = []
+        self.invoices = {}
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                fake._handle(self, self.path.rsplit("/", 1)[-1], body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add_invoice(self, invoice_id, status="active", **fields):
+        self.invoices[str(invoice_id)] = dict({"invoice_id": int(invoice_id), "status": status, "asset": "USDT",
+                                               "amount": "1", "bot_invoice_url": f"https://t.me/CryptoBot?start=IV{invoice_id}"}, **fields)
+
+    def methods(self):
+        return [m for m, _ in self.calls]
+
+    def _handle(self, h, method, body):
+        with self._lock:
+            self.calls.append((method, body))
+            action = self.script.pop(0) if self.script else None
+        if action == "abort":
+            h.close_connection = True
+            return
+        if action in ("503", "429"):
+            h.send_response(int(action))
+            h.send_header("Retry-After", "0")
+            h.send_header("Content-Length", "0")
+            h.end_headers()
+            return
+        if action == "null":
+            result = None
+        elif method == "createInvoice":
+            with self._lock:
+                invoice_id = 1000 + len(self.invoices)
+                self.add_invoice(invoice_id, asset=body["asset"], amount=body["amount"], payload=body.get("payload"))
+            result = self.invoices[str(invoice_id)]
+        elif method == "getInvoices":
+            ids = [i for i in str(body.get("invoice_ids", "")).split(",") if i]
+            items = [self.invoices[i] for i in ids if i in self.invoices]
+            result = {"items": items[:int(body.get("count") or 100)]}
+        else:
+            result = None
+        out = json.dumps({"ok": True, "result": result}).encode()
+        h.send_response(200)
+        h.send_header("Content-Type", "application/json")
+        h.send_header("Content-Length", str(len(out)))
+        h.end_headers()
+        h.wfile.write(out)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def cryptopay_api():
+    fake = FakeCryptoPay()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def cryptopay_client(app, cryptopay_api):
+    return app.CryptoPayClient("test-token", base_url=cryptopay_api.url, max_retries=2, backoff_base=0.001,
+                               breaker=app.CircuitBreaker(failure_threshold=10, reset_timeout=60))
@@ -0,0 +1,83 @@
+import socket
+import time
+
+import pytest
+
+
+def test_create_invoice(app, cryptopay_api, cryptopay_client):
+    inv = cryptopay_client.create_invoice(12.5, "USDT", "cart:1", "Оплата корзины")
+    assert inv["invoice_id"] == "1000"
+    assert inv["pay_url"] == "https://t.me/CryptoBot?start=IV1000"
+    assert cryptopay_api.calls[0][1]["amount"] == "12.5"
+    assert cryptopay_api.calls[0][1]["expires_in"] == int(app.INVOICE_TTL_HOURS * 3600)
+
+
+@pytest.mark.parametrize("failure", ["503", "abort"])
+def test_create_invoice_not_retried_when_request_may_have_arrived(app, cryptopay_api, cryptopay_client, failure):
+    # 5xx и обрыв после отправки: счёт мог быть создан — повтор дал бы второй
+    cryptopay_api.script = [failure]
+    with pytest.raises(app.CryptoPayError):
+        cryptopay_client.create_invoice(1, "USDT", "cart:1", "x")
+    assert cryptopay_api.methods() == ["createInvoice"]
+
+
+def test_create_invoice_retried_after_429(app, cryptopay_api, cryptopay_client):
+    cryptopay_api.script = ["429"]
+    assert cryptopay_client.create_invoice(1, "USDT", "cart:1", "x")["invoice_id"]
+    assert cryptopay_api.methods() == ["createInvoice", "createInvoice"]
+
+
+def test_create_invoice_retried_when_connection_refused(app):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]   # порт свободен и никем не слушается
+    client = app.CryptoPayClient("t", base_url=f"http://127.0.0.1:{port}", max_retries=2, backoff_base=0.001,
+                                 breaker=app.CircuitBreaker(failure_threshold=10))
+    stats = app.latency_stats("cryptopay.createInvoice")
+    before = stats.count
+    with pytest.raises(app.CryptoPayError):
+        client.create_invoice(1, "USDT", "cart:1", "x")
+    assert stats.count - before == 3
+
+
+@pytest.mark.parametrize("failure", ["503", "abort"])
+def test_idempotent_call_retried(app, cryptopay_api, cryptopay_client, failure):
+    cryptopay_api.add_invoice(7, status="paid")
+    cryptopay_api.script = [failure]
+    assert [i["status"] for i in cryptopay_client.get_invoices(["7"])] == ["paid"]
+    assert cryptopay_api.methods() == ["getInvoices", "getInvoices"]
+
+
+def test_null_result_raises(app, cryptopay_api, cryptopay_client):
+    cryptopay_api.script = ["null"]
+    with pytest.raises(app.CryptoPayError):
+        cryptopay_client.create_invoice(1, "USDT", "cart:1", "x")
+    with pytest.raises(app.CryptoPayError):
+        app.normalize_invoice({"status": "active"})
+
+
+def test_circuit_breaker_states(app, cryptopay_api):
+    breaker = app.CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    client = app.CryptoPayClient("t", base_url=cryptopay_api.url, max_retries=0, breaker=breaker)
+    cryptopay_api.add_invoice(1)
+
+    cryptopay_api.script = ["503", "503"]
+    for _ in range(2):
+        with pytest.raises(app.CryptoPayError):
+            client.get_invoices(["1"])
+    assert breaker.state == "open"
+    with pytest.raises(app.CircuitOpenError):
+        client.get_invoices(["1"])
+    assert len(cryptopay_api.calls) == 2  # открытая цепь не ходит в сеть
+
+    # half-open: одна пробная попытка; ошибка снова открывает цепь
+    time.sleep(0.25)
+    cryptopay_api.script = ["503"]
+    with pytest.raises(app.CryptoPayError):
+        client.get_invoices(["1"])
+    assert breaker.state == "open"
+
+    # успешная проба закрывает цепь
+    time.sleep(0.25)
+    assert client.get_invoices(["1"])
+    assert breaker.state == "closed"
@@ -0,0 +1,74 @@
+import threading
+
+
+class RetryAfter(Exception):
+    """Как ApiTelegramException на 429."""
+    error_code = 429
+    result_json = {"parameters": {"retry_after": 0.01}}
+
+
+class FakeBot:
+    def __init__(self, fail_first=0):
+        self.fail_first = fail_first
+        self.uploads = []
+        self.messages = []
+        self.messaged = threading.Event()
+
+    def send_document(self, chat_id, document, **kwargs):
+        self.uploads.append(document.read())
+        if len(self.uploads) <= self.fail_first:
+            raise RetryAfter()
+        return "ok"
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+        self.messaged.set()
+
+
+def _export(app, monkeypatch, bot, admin_chat, max_retries=5, reply=False):
+    monkeypatch.setattr(app, "bot", bot)
+    outbox = app.TelegramOutbox(global_rate=1000, max_retries=max_retries)
+    monkeypatch.setattr(app, "tg", app.OutboxLane(outbox, "interactive"))
+    done, files = threading.Event(), []
+    sent = app._export_sent
+
+    def export_sent(fut, raw, chat_id):
+        files.append(raw)
+        sent(fut, raw, chat_id)
+        done.set()
+
+    monkeypatch.setattr(app, "_export_sent", export_sent)
+    app._exports_running.add(admin_chat)
+    app.export_orders(admin_chat, {}, "csv")
+    assert done.wait(5)
+    if reply:
+        assert bot.messaged.wait(5)
+    outbox.stop()
+    return files[0]
+
+
+def test_export_file_outlives_the_call_and_is_reread_after_429(app, monkeypatch):
+    chat_id = 730001
+    app.create_single_order(chat_id, "Telegram", "sub", 10, 0.8, "https://t.me/export")
+    bot = FakeBot(fail_first=1)
+
+    raw = _export(app, monkeypatch, bot, 99)
+
+    assert len(bot.uploads) == 2
+    assert bot.uploads[1] == bot.uploads[0]
+    assert bot.uploads[1].startswith(",".join(app.ORDER_EXPORT_COLUMNS).encode())
+    assert b"https://t.me/export" in bot.uploads[1]
+    assert raw.closed
+    assert 99 not in app._exports_running
+    assert bot.messages == []
+
+
+def test_failed_export_upload_releases_the_file(app, monkeypatch):
+    bot = FakeBot(fail_first=10)
+
+    raw = _export(app, monkeypatch, bot, 98, max_retries=0, reply=True)
+
+    assert len(bot.uploads) == 1
+    assert raw.closed
+    assert 98 not in app._exports_running
+    assert bot.messages == [(98, "Ошибка выгрузки.")]
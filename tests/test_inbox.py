@@ -0,0 +1,92 @@
+import json
+import random
+import threading
+import time
+
+import pytest
+
+
+class FakeBot:
+    """bot.process_new_updates: записывает (chat_id, update_id) в порядке обработки."""
+
+    def __init__(self):
+        self.handled = []
+        self._lock = threading.Lock()
+
+    def process_new_updates(self, updates):
+        for u in updates:
+            time.sleep(random.random() * 0.002)
+            with self._lock:
+                self.handled.append((u.message.chat.id, u.update_id))
+
+    def order(self, chat_id):
+        return [update_id for c, update_id in self.handled if c == chat_id]
+
+
+def _update(update_id, chat_id):
+    return json.dumps({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "hi",
+        "chat": {"id": chat_id, "type": "private"}, "from": {"id": chat_id, "is_bot": False, "first_name": "u"}}})
+
+
+@pytest.fixture
+def fake_bot(app, monkeypatch):
+    with app.db.transaction() as cur:
+        cur.execute("DELETE FROM inbox")
+    bot = FakeBot()
+    monkeypatch.setattr(app, "bot", bot)
+    return bot
+
+
+def _consume_all(app, inbox, dispatcher):
+    for _ in range(1000):
+        if not app.db.execute("SELECT COUNT(*) FROM inbox").fetchone()[0]:
+            break
+        _, blocked = inbox._consume()
+        if blocked:
+            time.sleep(0.005)
+    assert dispatcher.drain(5)
+
+
+def test_updates_of_one_chat_are_handled_in_order(app, fake_bot, monkeypatch):
+    dispatcher = app.UpdateDispatcher(workers=4)
+    monkeypatch.setattr(app, "update_dispatcher", dispatcher)
+    inbox = app.UpdateInbox(batch=25)
+    chats = [101, 102, 103, 104, 105, 106]
+    for n in range(240):
+        inbox.put("update", _update(n, chats[n % len(chats)]))
+
+    _consume_all(app, inbox, dispatcher)
+
+    assert len(fake_bot.handled) == 240
+    for i, chat_id in enumerate(chats):
+        assert fake_bot.order(chat_id) == list(range(i, 240, len(chats)))
+
+
+def test_full_worker_queue_leaves_the_rest_in_inbox(app, fake_bot, monkeypatch):
+    dispatcher = app.UpdateDispatcher(workers=2, max_queue=2)
+    monkeypatch.setattr(app, "update_dispatcher", dispatcher)
+    inbox = app.UpdateInbox(batch=50)
+    for n in range(60):
+        inbox.put("update", _update(n, 200 + n % 3))
+
+    _, blocked = inbox._consume()
+    assert blocked
+    assert app.db.execute("SELECT COUNT(*) FROM inbox").fetchone()[0] > 0
+
+    _consume_all(app, inbox, dispatcher)
+    for chat_id in (200, 201, 202):
+        assert fake_bot.order(chat_id) == list(range(chat_id - 200, 60, 3))
+
+
+def test_ipn_rows_go_to_handle_ipn_in_inbox_order(app, fake_bot, monkeypatch):
+    seen = []
+    monkeypatch.setattr(app, "handle_ipn", lambda payload: seen.append(payload["n"]))
+    inbox = app.UpdateInbox()
+    for n in range(5):
+        inbox.put("ipn", json.dumps({"n": n}))
+
+    inbox._consume()
+
+    assert seen == [0, 1, 2, 3, 4]
+    assert app.db.execute("SELECT COUNT(*) FROM inbox").fetchone()[0] == 0
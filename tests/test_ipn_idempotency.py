@@ -0,0 +1,85 @@
+import itertools
+import threading
+
+DELIVERIES = 32
+_chat_ids = itertools.count(700001)
+
+
+def _deliver_concurrently(app, invoice_id, amount="61.20", asset="USDT", n=DELIVERIES):
+    """n потоков одновременно проводят один и тот же инвойс (повторные доставки IPN)."""
+    barrier = threading.Barrier(n)
+    results, errors = [], []
+
+    def deliver():
+        try:
+            barrier.wait()
+            results.append(app.process_paid_invoice(invoice_id, amount, asset))
+        except Exception as e:  # pragma: no cover - попадёт в assert ниже
+            errors.append(e)
+
+    threads = [threading.Thread(target=deliver) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    return results
+
+
+def _cart_invoice(app, invoice_id, items=5):
+    chat_id = next(_chat_ids)
+    cart_id = app.get_or_create_cart(chat_id)
+    for i in range(items):
+        amount = 100 + i
+        price = round(amount * app.SERVICES["TikTok"]["sub"]["price_usd_per_unit"], 2)
+        app.add_item_to_cart(cart_id, "TikTok", "sub", amount, f"https://tiktok.com/@user{i}", price)
+    app.set_invoice_mapping(invoice_id, chat_id, cart_id=cart_id)
+    return chat_id, cart_id
+
+
+def _count(app, sql, *params):
+    return app.db.execute(sql, params).fetchone()[0]
+
+
+def test_concurrent_duplicate_cart_ipns_settle_once(app, sent):
+    chat_id, cart_id = _cart_invoice(app, "stress-cart", items=5)
+
+    results = _deliver_concurrently(app, "stress-cart")
+
+    assert results.count("settled") == 1
+    assert results.count("duplicate") == DELIVERIES - 1
+    assert _count(app, "SELECT COUNT(*) FROM orders WHERE invoice_id = ?", "stress-cart") == 5
+    assert _count(app, "SELECT COUNT(*) FROM processed_invoices WHERE invoice_id = ?", "stress-cart") == 1
+    assert app.db.execute("SELECT status FROM carts WHERE id = ?", (cart_id,)).fetchone()[0] == "paid"
+    assert len(sent.to(chat_id)) == 1
+
+
+def test_concurrent_duplicate_order_ipns_settle_once(app, sent):
+    chat_id = next(_chat_ids)
+    order_id = app.create_single_order(chat_id, "Instagram", "like", 100, 5.0, "https://instagram.com/p/single")
+    app.set_invoice_mapping("stress-order", chat_id, order_id=order_id)
+
+    results = _deliver_concurrently(app, "stress-order", amount="5.00")
+
+    assert results.count("settled") == 1
+    assert results.count("duplicate") == DELIVERIES - 1
+    assert app.db.execute("SELECT status FROM orders WHERE id = ?", (order_id,)).fetchone()[0] == "paid"
+    assert len(sent.to(chat_id)) == 1
+
+
+def test_duplicate_after_restart_is_answered_from_db(app, sent, monkeypatch):
+    chat_id, _ = _cart_invoice(app, "stress-restart", items=3)
+    assert app.process_paid_invoice("stress-restart", "36.36", "USDT") == "settled"
+
+    # новый процесс: кэш проведённых инвойсов пуст, дубликаты ловит processed_invoices
+    monkeypatch.setattr(app, "processed_invoices", app.ProcessedInvoiceCache())
+    results = _deliver_concurrently(app, "stress-restart", amount="36.36")
+
+    assert results == ["duplicate"] * DELIVERIES
+    assert _count(app, "SELECT COUNT(*) FROM orders WHERE invoice_id = ?", "stress-restart") == 3
+    assert len(sent.to(chat_id)) == 1
+
+
+def test_unknown_invoice_is_not_settled(app, sent):
+    assert set(_deliver_concurrently(app, "stress-unknown", n=8)) == {"unknown"}
+    assert _count(app, "SELECT COUNT(*) FROM processed_invoices WHERE invoice_id = ?", "stress-unknown") == 0
@@ -0,0 +1,149 @@
+import random
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+
+class RetryAfter(Exception):
+    """Как ApiTelegramException на 429."""
+    error_code = 429
+
+    def __init__(self, retry_after=0.02):
+        super().__init__("Too Many Requests")
+        self.result_json = {"parameters": {"retry_after": retry_after}}
+
+
+class FakeBot:
+    """bot.send_message: записывает (chat_id, text); в одном чате вызовы не должны пересекаться."""
+
+    def __init__(self):
+        self.sent = []
+        self.busy = set()
+        self.overlaps = 0
+        self.fail_once = set()      # тексты, на которые первый раз отвечаем 429
+        self.hold = {}              # текст -> Event, до которого вызов не завершается
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._lock:
+            if chat_id in self.busy:
+                self.overlaps += 1
+            self.busy.add(chat_id)
+        try:
+            if text in self.hold:
+                self.hold[text].wait(5)
+            time.sleep(random.random() * 0.002)
+            if text in self.fail_once:
+                self.fail_once.discard(text)
+                raise RetryAfter()
+            with self._lock:
+                self.sent.append((chat_id, text))
+            return text
+        finally:
+            with self._lock:
+                self.busy.discard(chat_id)
+
+    def texts(self, chat_id):
+        return [t for c, t in self.sent if c == chat_id]
+
+
+def _wait(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def fake_bot(app, monkeypatch):
+    bot = FakeBot()
+    monkeypatch.setattr(app, "bot", bot)
+    monkeypatch.setattr(app, "TG_CHAT_RATE", 1000)
+    monkeypatch.setattr(app, "TG_CHAT_BURST", 1000)
+    return bot
+
+
+@pytest.fixture
+def outbox(app, fake_bot):
+    box = app.TelegramOutbox(global_rate=10000, workers=8)
+    yield box
+    box.stop()
+
+
+def test_messages_of_one_chat_keep_their_order(outbox, fake_bot):
+    chats = range(1, 9)
+    futures = [outbox.submit("notify", chat_id, "send_message", chat_id, f"{chat_id}:{i}")
+               for i in range(30) for chat_id in chats]
+    for f in futures:
+        f.result(5)
+
+    for chat_id in chats:
+        assert fake_bot.texts(chat_id) == [f"{chat_id}:{i}" for i in range(30)]
+    assert fake_bot.overlaps == 0
+
+
+def test_payment_lane_overtakes_queued_broadcast(outbox, fake_bot):
+    fake_bot.hold["first"] = threading.Event()
+    first = outbox.submit("broadcast", 5, "send_message", 5, "first")
+    _wait(lambda: 5 in fake_bot.busy)
+    broadcast = [outbox.submit("broadcast", 5, "send_message", 5, f"b{i}") for i in range(3)]
+    payment = outbox.submit("payment", 5, "send_message", 5, "paid")
+    fake_bot.hold["first"].set()
+    for f in [first, payment] + broadcast:
+        f.result(5)
+
+    assert fake_bot.texts(5) == ["first", "paid", "b0", "b1", "b2"]
+
+
+def test_429_requeues_the_call_ahead_of_the_rest_of_the_chat(outbox, fake_bot):
+    fake_bot.fail_once.add("m0")
+    futures = [outbox.submit("interactive", 7, "send_message", 7, f"m{i}") for i in range(5)]
+
+    assert [f.result(5) for f in futures] == [f"m{i}" for i in range(5)]
+    assert fake_bot.texts(7) == [f"m{i}" for i in range(5)]
+
+
+def test_429_gives_up_after_max_retries(app, monkeypatch):
+    class AlwaysLimited:
+        calls = 0
+
+        def send_message(self, chat_id, text, **kwargs):
+            self.calls += 1
+            raise RetryAfter(0.001)
+
+    bot = AlwaysLimited()
+    monkeypatch.setattr(app, "bot", bot)
+    box = app.TelegramOutbox(global_rate=10000, max_retries=2)
+    fut = box.submit("interactive", 8, "send_message", 8, "x")
+    with pytest.raises(RetryAfter):
+        fut.result(5)
+    box.stop()
+    assert bot.calls == 3
+
+
+def test_caller_timeout_cancels_queued_call(app, outbox, fake_bot, monkeypatch):
+    monkeypatch.setattr(app, "TG_SEND_TIMEOUT_SEC", 0.1)
+    fake_bot.hold["slow"] = threading.Event()
+    slow = outbox.submit("interactive", 9, "send_message", 9, "slow")
+    _wait(lambda: 9 in fake_bot.busy)
+
+    # чат занят: второй вызов не начнётся до таймаута вызывающего и снимается с очереди
+    with pytest.raises(FutureTimeoutError):
+        outbox.call("interactive", 9, "send_message", 9, "late")
+    fake_bot.hold["slow"].set()
+    slow.result(5)
+    assert outbox.submit("interactive", 9, "send_message", 9, "next").result(5) == "next"
+
+    assert fake_bot.texts(9) == ["slow", "next"]
+
+
+def test_caller_timeout_waits_for_call_already_running(app, outbox, fake_bot, monkeypatch):
+    monkeypatch.setattr(app, "TG_SEND_TIMEOUT_SEC", 0.1)
+    fake_bot.hold["running"] = threading.Event()
+    threading.Timer(0.15, fake_bot.hold["running"].set).start()
+
+    # уже ушедший в Telegram вызов не отменить — ждём его результат, а не отвечаем «не отправлено»
+    assert outbox.call("interactive", 10, "send_message", 10, "running") == "running"
+    assert fake_bot.texts(10) == ["running"]
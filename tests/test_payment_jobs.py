@@ -0,0 +1,65 @@
+import itertools
+import threading
+import time
+
+_chat_ids = itertools.count(710001)
+
+
+def _status(app, job_id):
+    return app.db.execute("SELECT status FROM payment_jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+
+def _queue(app, handler):
+    return app.PaymentJobQueue({"cart": handler}, workers=2, poll_interval=0.05)
+
+
+def test_stop_waits_for_running_job(app):
+    started = threading.Event()
+
+    def slow(chat_id, ref_id, asset):
+        started.set()
+        time.sleep(0.3)
+
+    q = _queue(app, slow)
+    job_id, created = q.submit("cart", next(_chat_ids), 1, "USDT")
+    assert created and started.wait(2)
+
+    assert q.stop(timeout=5) is True
+    assert _status(app, job_id) == "done"
+
+
+def test_stop_gives_up_after_timeout(app):
+    release, started = threading.Event(), threading.Event()
+
+    def stuck(chat_id, ref_id, asset):
+        started.set()
+        release.wait(5)
+
+    chat_id = next(_chat_ids)
+    q = _queue(app, stuck)
+    job_id, _ = q.submit("cart", chat_id, 2, "USDT")
+    assert started.wait(2)
+
+    assert q.stop(timeout=0.1) is False
+    assert _status(app, job_id) == "running"
+    assert q.submit("cart", chat_id, 2, "USDT") == (job_id, False)
+    release.set()
+    assert q.stop(timeout=2) is True
+
+
+def test_job_of_killed_process_is_recovered(app):
+    chat_id = next(_chat_ids)
+    # процесс убит посреди задачи: строка осталась running и держит dedup-индекс
+    with app.db.transaction() as cur:
+        cur.execute("INSERT INTO payment_jobs (kind, chat_id, ref_id, asset, status, created_at, updated_at) "
+                    "VALUES ('cart', ?, 3, 'USDT', 'running', '2026-01-01T00:00:00', '2026-01-01T00:00:00')", (chat_id,))
+        job_id = cur.lastrowid
+    done = threading.Event()
+    q = _queue(app, lambda *a: done.set())
+    assert q.submit("cart", chat_id, 3, "USDT") == (job_id, False)
+
+    assert q.recover() >= 1
+    q.start()
+    assert done.wait(2)
+    assert q.stop(timeout=2) is True
+    assert _status(app, job_id) == "done"
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+
+class Source:
+    """Источник курсов: считает запросы, может падать."""
+
+    def __init__(self, rate=5.0):
+        self.rate = rate
+        self.calls = 0
+        self.fail = False
+        self.called = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.called.set()
+        if self.fail:
+            raise RuntimeError("rate source is down")
+        return {"ton": self.rate}
+
+
+@pytest.fixture
+def cache(app):
+    caches = []
+
+    def make(source, **kw):
+        caches.append(app.RateCache(source, **dict({"ttl": 60, "max_stale": 300}, **kw)))
+        return caches[-1]
+
+    yield make
+    for c in caches:
+        c.stop()
+
+
+def _age(cache, asset, seconds):
+    usd, _ = cache._rates[asset]
+    cache._rates[asset] = (usd, time.monotonic() - seconds)
+
+
+def _wait(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_fresh_rate_is_served_from_cache(cache):
+    source = Source()
+    c = cache(source)
+    assert c.get_usd_rate("TON") == 5.0
+    _wait(lambda: c._thread is not None and source.calls >= 1)
+    calls = source.calls
+
+    assert c.get_usd_rate("ton") == 5.0
+    assert source.calls == calls
+
+
+def test_stale_rate_is_served_while_refreshed_in_background(cache):
+    source = Source()
+    c = cache(source)
+    c.get_usd_rate("TON")
+    _age(c, "TON", 120)
+    source.rate = 6.0
+
+    assert c.get_usd_rate("TON") == 5.0   # старше ttl: ответ сразу, без ожидания источника
+    _wait(lambda: c._rates["TON"][0] == 6.0)
+    assert c.get_usd_rate("TON") == 6.0
+
+
+def test_rate_older_than_max_stale_is_unavailable(app, cache):
+    source = Source()
+    c = cache(source)
+    c.get_usd_rate("TON")
+    source.fail = True
+    source.called.clear()
+    _age(c, "TON", 301)
+
+    with pytest.raises(app.RateUnavailableError):
+        c.get_usd_rate("TON")
+    assert source.called.wait(2)   # обновление всё равно запрошено
+
+
+def test_unknown_rate_is_unavailable(app, cache):
+    source = Source()
+    source.fail = True
+    with pytest.raises(app.RateUnavailableError):
+        cache(source).get_usd_rate("TON")
+
+
+def test_concurrent_start_runs_one_refresher(cache):
+    source = Source()
+    c = cache(source)
+    barrier = threading.Barrier(16)
+
+    def start():
+        barrier.wait()
+        c.start()
+
+    threads = [threading.Thread(target=start) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert source.called.wait(2)
+    time.sleep(0.05)
+    assert source.calls == 1   # каждый лишний поток обновления сразу сходил бы к источнику
@@ -0,0 +1,128 @@
+import itertools
+
+import pytest
+
+_chat_ids = itertools.count(720001)
+_invoice_ids = itertools.count(5001)
+
+
+@pytest.fixture(autouse=True)
+def no_pending(app):
+    # ожидающие инвойсы других тестов не должны попадать в окно сверки
+    app.set_invoices_status([r[1] for r in app.get_pending_invoice_ids(10 ** 6)], "expired")
+
+
+def _pending_invoice(app, api, status="active", items=2, **fields):
+    chat_id = next(_chat_ids)
+    cart_id = app.get_or_create_cart(chat_id)
+    for i in range(items):
+        app.add_item_to_cart(cart_id, "TikTok", "sub", 100, f"https://tiktok.com/@rec{i}", 12.0)
+    invoice_id = str(next(_invoice_ids))
+    app.set_invoice_mapping(invoice_id, chat_id, cart_id=cart_id)
+    api.add_invoice(invoice_id, status, **fields)
+    return invoice_id, chat_id, cart_id
+
+
+def _paid(amount="24"):
+    return {"paid_amount": amount, "paid_asset": "USDT"}
+
+
+def _polled(api):
+    return [body["invoice_ids"].split(",") for method, body in api.calls if method == "getInvoices"]
+
+
+def _map_status(app, invoice_id):
+    return app.get_invoice_mapping(invoice_id)["status"]
+
+
+def _orders(app, invoice_id):
+    return app.db.execute("SELECT COUNT(*) FROM orders WHERE invoice_id = ?", (invoice_id,)).fetchone()[0]
+
+
+def test_pending_invoices_are_polled_in_batches_oldest_first(app, cryptopay_api, cryptopay_client):
+    ids = [_pending_invoice(app, cryptopay_api, items=0)[0] for _ in range(7)]
+
+    app.InvoiceReconciler(cryptopay_client, batch=3).run_once()
+
+    assert _polled(cryptopay_api) == [ids[0:3], ids[3:6], ids[6:7]]
+    assert [body["count"] for _, body in cryptopay_api.calls] == [3, 3, 1]
+
+
+def test_backlog_larger_than_window_is_polled_round_robin(app, cryptopay_api, cryptopay_client):
+    reconciler = app.InvoiceReconciler(cryptopay_client, batch=1)  # окно — 50 инвойсов
+    ids = [_pending_invoice(app, cryptopay_api, items=0)[0] for _ in range(60)]
+
+    def one_pass():
+        cryptopay_api.calls.clear()
+        reconciler.run_once()
+        return [i for batch in _polled(cryptopay_api) for i in batch]
+
+    assert one_pass() == ids[:50]
+    assert one_pass() == ids[50:]
+    assert one_pass() == ids[:50]
+
+
+def test_paid_invoice_is_settled(app, cryptopay_api, cryptopay_client, sent):
+    invoice_id, chat_id, cart_id = _pending_invoice(app, cryptopay_api, "paid", **_paid())
+
+    app.InvoiceReconciler(cryptopay_client, batch=10).run_once()
+
+    assert _orders(app, invoice_id) == 2
+    assert _map_status(app, invoice_id) == "paid"
+    assert app.db.execute("SELECT status FROM carts WHERE id = ?", (cart_id,)).fetchone()[0] == "paid"
+    assert len(sent.to(chat_id)) == 1
+
+
+def test_paid_invoice_settled_by_racing_ipn_is_duplicate(app, cryptopay_api, cryptopay_client, sent, monkeypatch):
+    invoice_id, chat_id, _ = _pending_invoice(app, cryptopay_api, "paid", **_paid())
+    results = []
+    process = app.process_paid_invoice
+    fetch = cryptopay_client.get_invoices
+
+    def recorded(*args):
+        results.append(process(*args))
+        return results[-1]
+
+    def get_invoices_then_ipn(ids):
+        items = fetch(ids)
+        # IPN приходит, пока ответ getInvoices ещё не разобран
+        recorded(invoice_id, "24", "USDT")
+        return items
+
+    monkeypatch.setattr(cryptopay_client, "get_invoices", get_invoices_then_ipn)
+    monkeypatch.setattr(app, "process_paid_invoice", recorded)
+
+    app.InvoiceReconciler(cryptopay_client, batch=10).run_once()
+
+    assert results == ["settled", "duplicate"]
+    assert _orders(app, invoice_id) == 2
+    assert len(sent.to(chat_id)) == 1
+
+
+def test_expired_invoice_is_marked_and_not_polled_again(app, cryptopay_api, cryptopay_client):
+    invoice_id, _, _ = _pending_invoice(app, cryptopay_api, "expired")
+    reconciler = app.InvoiceReconciler(cryptopay_client, batch=10)
+
+    reconciler.run_once()
+    assert _map_status(app, invoice_id) == "expired"
+    assert _orders(app, invoice_id) == 0
+
+    cryptopay_api.calls.clear()
+    assert reconciler.run_once() == app.RECONCILE_IDLE_SEC
+    assert cryptopay_api.calls == []
+
+
+def test_payment_for_closed_cart_is_unapplied(app, cryptopay_api, cryptopay_client, sent, monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_IDS", {42})
+    invoice_id, chat_id, cart_id = _pending_invoice(app, cryptopay_api, "paid", **_paid())
+    # корзину успел закрыть sweeper, пока счёт ждал оплаты
+    with app.db.transaction() as cur:
+        cur.execute("UPDATE carts SET status = 'expired' WHERE id = ?", (cart_id,))
+
+    app.InvoiceReconciler(cryptopay_client, batch=10).run_once()
+
+    assert _orders(app, invoice_id) == 0
+    assert _map_status(app, invoice_id) == "paid"
+    assert app.db.execute("SELECT COUNT(*) FROM processed_invoices WHERE invoice_id = ?", (invoice_id,)).fetchone()[0] == 1
+    assert len(sent.to(42)) == 1 and invoice_id in sent.to(42)[0][1][1]
+    assert len(sent.to(chat_id)) == 1